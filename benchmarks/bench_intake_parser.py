@@ -0,0 +1,120 @@
+"""Micro-benchmark of the Intake Request parser against the original split/replace chains and the email package, on large HTML bodies.
+
+Usage:
+    python benchmarks/bench_intake_parser.py [--sizes 64 512 4096] [--repeat 5]
+
+Sizes are the approximate HTML body size in KiB.
+"""
+# Import the command line, path and timing modules
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+# Import the email building and parsing modules
+from email import policy
+from email.parser import BytesParser
+from email.charset import Charset, QP
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-function"))
+from intake_parser import parseIntakeMessage, findBodyPart  # noqa: E402
+
+
+def buildIntakeEmail(bodyKiB):
+    """
+    Builds a ServiceNow-like Intake Request email with a quoted-printable HTML body of roughly 'bodyKiB' KiB
+
+    Returns:
+    ----------
+    rawEmail : bytes
+    """
+    header = ("<html><body><p>Request Name: Capacity review for the payments platform<br>"
+              "GBL#: GBL0042<br>PyxIS#: PX-7781<br>"
+              "Link: <a href=\"https://servicenow.example.com/nav_to.do?uri=sc_task.do?sys_id=abc123\">open</a><br>")
+    row = "<tr><td class=\"cell\">Requirement detail</td><td style=\"width=50%\">Value = 42</td></tr>\n"
+    rows = row * max(1, (bodyKiB * 1024) // len(row))
+    html = header + "<table>" + rows + "</table></body></html>"
+
+    message = MIMEMultipart("alternative")
+    message["From"] = "servicenow@example.com"
+    message["Subject"] = "TASK0123456 Intake Request assigned to your group"
+    message.attach(MIMEText("Request Name: Capacity review for the payments platform", "plain", "utf-8"))
+    # quoted-printable, like the ServiceNow emails
+    quotedPrintable = Charset("utf-8")
+    quotedPrintable.body_encoding = QP
+    htmlPart = MIMEText("", "html")
+    del htmlPart["Content-Transfer-Encoding"]
+    htmlPart.set_payload(html, quotedPrintable)
+    message.attach(htmlPart)
+    return message.as_bytes()
+
+
+def legacyParse(rawEmail):
+    """
+    The original messageData + WICardData string processing, kept here as the baseline
+    """
+    raw_email = rawEmail.decode("utf-8")
+    body_email = raw_email.split("MIME-Version: 1.0")[1]
+    Subject = raw_email.split("Subject: ")[1].split("Content-Type: ")[0]
+    filtered_body = body_email.replace("=", "").replace("\r", "").replace("\n", "").replace("\t", "")
+    try:
+        TITLE = filtered_body.split("Request Name: ")[1].split("<br>")[0]
+    except IndexError:
+        TITLE = "NEW VSTS WORK ITEM"
+    GBL = filtered_body.split("GBL#: ")[1].split("<br>")[0] if filtered_body.find("GBL#: ") > -1 else None
+    PYXIS = filtered_body.split("PyxIS#: ")[1].split("<br>")[0] if filtered_body.find("PyxIS#: ") > -1 else None
+    TASK = Subject.split("TASK")[1].split(" ")[0]
+    return TITLE, filtered_body, TASK, GBL, PYXIS
+
+
+def emailPackageBody(rawEmail):
+    """
+    The HTML body (text/plain as a fallback) decoded by the email package, the alternative to findBodyPart + decodeBody
+    """
+    return BytesParser(policy=policy.default).parsebytes(rawEmail).get_body(("html", "plain")).get_content()
+
+
+def peakMemory(function, argument):
+    """
+    Returns the peak traced allocation size, in bytes, of a single call
+    """
+    tracemalloc.start()
+    function(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argumentParser.add_argument("--sizes", type=int, nargs="+", default=[64, 512, 4096])
+    argumentParser.add_argument("--repeat", type=int, default=5)
+    arguments = argumentParser.parse_args()
+
+    # "find part ms" is the offset walk of findBodyPart alone, "email pkg ms" the email package locating and decoding the same part
+    print("%8s  %12s  %12s  %12s  %12s  %12s  %12s" % ("KiB", "legacy ms", "parser ms", "find part ms", "email pkg ms",
+                                                      "legacy peak", "parser peak"))
+    for bodyKiB in arguments.sizes:
+        rawEmail = buildIntakeEmail(bodyKiB)
+        legacySeconds = min(timeit.repeat(lambda: legacyParse(rawEmail), number=1, repeat=arguments.repeat))
+        parserSeconds = min(timeit.repeat(lambda: parseIntakeMessage(rawEmail), number=1, repeat=arguments.repeat))
+        findSeconds = min(timeit.repeat(lambda: findBodyPart(rawEmail), number=1, repeat=arguments.repeat))
+        emailPackageSeconds = min(timeit.repeat(lambda: emailPackageBody(rawEmail), number=1, repeat=arguments.repeat))
+        print("%8d  %12.2f  %12.2f  %12.2f  %12.2f  %11.1fM  %11.1fM" % (
+            bodyKiB, legacySeconds * 1000, parserSeconds * 1000, findSeconds * 1000, emailPackageSeconds * 1000,
+            peakMemory(legacyParse, rawEmail) / 1048576.0, peakMemory(parseIntakeMessage, rawEmail) / 1048576.0))
+
+    # the legacy chain strips every "=" and leaves the quoted-printable soft line breaks in place
+    rawEmail = buildIntakeEmail(4)
+    record = parseIntakeMessage(rawEmail)
+    legacyDescription = legacyParse(rawEmail)[1]
+    print("\nURL intact - legacy: %s, parser: %s" % (
+        "sys_id=abc123" in legacyDescription, "sys_id=abc123" in record.description))
+    print("Parsed: TASK%s %r GBL=%s PyxIS=%s" % (record.task, record.title, record.gbl, record.pyxis))
+
+
+if __name__ == "__main__":
+    main()
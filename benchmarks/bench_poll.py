@@ -0,0 +1,146 @@
+"""End-to-end benchmark of one lambda_handler poll against in-process IMAP, VSTS REST and S3 stand-ins.
+
+Usage:
+    python benchmarks/bench_poll.py [--emails 10 100 1000] [--id-gaps 0 1000] [--latency-ms 20] [--body-kib 8] [--attachment-kib 0] [--capacity 0] [--verbose]
+
+Every combination of email count and work item ID gap runs one cold poll (no connection kept from the previous run)
+over a freshly seeded INBOX. One email in five is a notification the poll must skip. The report shows emails/sec,
+the round trips of each stage and the peak traced memory. With --capacity the VSTS stand-in throttles (429 with
+Retry-After) the requests beyond that many at a time, as Azure DevOps does under load; "throttled" counts the refused calls. The VSTS round trips per email must not grow with the
+ID gap (the old parentToChildConnection ID scan did); when they do the benchmark exits with status 1.
+Memory is traced during the timed poll, which slows it down: compare the figures with each other, not with production.
+
+The Lambda dependencies (boto3, vstsclient) must be installed; S3, KMS, IMAP and VSTS are never contacted.
+"""
+# Import the command line, path and timing modules
+import argparse
+import contextlib
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_services import (buildIntakeEmail, FakeIMAPServer, FakeVstsServer, FakeS3Client, FakeS3Resource,
+                           FakeKMSClient, FakeSMTPModule, FakeLambdaContext)
+
+lambdaDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-function")
+sys.path.insert(0, lambdaDirectory)
+
+# Address the seeded Intake Requests are sent from
+SENDER = "servicenow@example.com"
+
+
+def loadGenerator(imapServer, vstsServer, s3Client):
+    """
+    Imports the Lambda function with its Environment Variables pointed at the stand-ins
+
+    Returns:
+    ----------
+    generator : module
+    """
+    environment = {
+        "emailHostName": "127.0.0.1", "imapSSL": "false", "imapPort": str(imapServer.port),
+        # the KMS stand-in returns the decoded ciphertext as is: "YmVuY2htYXJr" -> "benchmark"
+        "emailUserName": "benchmark", "emailPassword": "YmVuY2htYXJr",
+        "vstsWIAccount": "benchmark.visualstudio.com", "vstsWIAcToken": "YmVuY2htYXJr", "vstsBaseUrl": vstsServer.baseUrl,
+        "TOKEN_CHANGE_DATE": time.strftime("Year: %Y Month: %m Day: %d"),
+        "scEmailSearch": SENDER, "senderEmailAddress": SENDER, "recipientEmailAddress": SENDER, "smtpEmailUserName": SENDER,
+    }
+    for name, value in environment.items():
+        os.environ.setdefault(name, value)
+    # the stand-ins always win over the caller's environment, the tuning variables (vstsEmailsPerBatch, ...) do not
+    for name in ("emailHostName", "imapSSL", "imapPort", "vstsBaseUrl"):
+        os.environ[name] = environment[name]
+
+    spec = importlib.util.spec_from_file_location("vsts_work_item_generator",
+                                                  os.path.join(lambdaDirectory, "vsts_work_item_generator-aws_lambda.py"))
+    generator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generator)
+
+    generator.s3 = FakeS3Resource(s3Client)
+    generator.secretsProvider.kmsClient = FakeKMSClient()
+    generator.smtplib = FakeSMTPModule()
+    return generator
+
+
+def runPoll(generator, imapServer, vstsServer, s3Client, emailCount, idGap, latency, bodyKiB, capacity=0, attachmentKiB=0, verbose=False):
+    """
+    Seeds the stand-ins and runs one cold lambda_handler poll
+
+    Returns:
+    ----------
+    result : dict
+    """
+    rawMessages = [buildIntakeEmail(number, SENDER, bodyKiB, number % 5 != 4, attachmentKiB) for number in range(emailCount)]
+    intakeCount = sum(1 for number in range(emailCount) if number % 5 != 4)
+    imapServer.reset(rawMessages)
+    vstsServer.reset(latency, idGap, capacity)
+    s3Client.objects.clear()
+    s3Client.counts.clear()
+
+    # cold start: no pooled connection, no cached run state
+    generator.connectionManager = generator.ConnectionManager()
+    cacheDirectory = tempfile.mkdtemp(prefix="bench_poll_")
+    generator.runStateStore = generator.RunStateStore(s3Client, generator.bucket_name, generator.s3_path_runState,
+                                                      os.path.join(cacheDirectory, "RunState.json"))
+    generator.outboxStore = generator.OutboxStore(s3Client, generator.bucket_name, generator.outboxS3KeyEnvVar,
+                                                  os.path.join(cacheDirectory, "Outbox.sqlite"))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        tracemalloc.start()
+        start = time.perf_counter()
+        generator.lambda_handler({}, FakeLambdaContext())
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    created = len(vstsServer.workItems)
+    if created != 2 * intakeCount or vstsServer.linkCount() != intakeCount:
+        raise AssertionError("expected %d work items and %d links, got %d and %d" % (
+            2 * intakeCount, intakeCount, created, vstsServer.linkCount()))
+    return {"seconds": seconds, "peak": peak, "intake": intakeCount,
+            "imap": dict(imapServer.counts), "vsts": dict(vstsServer.counts), "s3": dict(s3Client.counts)}
+
+
+def formatCounts(counts):
+    return " ".join("%s=%d" % (name.lower().replace(" ", "_"), count) for name, count in sorted(counts.items())) or "-"
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argumentParser.add_argument("--emails", type=int, nargs="+", default=[10, 100, 1000])
+    argumentParser.add_argument("--id-gaps", type=int, nargs="+", default=[0, 1000])
+    argumentParser.add_argument("--latency-ms", type=float, default=20.0, help="VSTS round trip latency")
+    argumentParser.add_argument("--body-kib", type=int, default=8)
+    argumentParser.add_argument("--attachment-kib", type=int, default=0, help="Size of an attachment added to every email")
+    argumentParser.add_argument("--capacity", type=int, default=0, help="VSTS requests served at the same time, 0 for no limit")
+    argumentParser.add_argument("--verbose", action="store_true", help="Show the output of the Lambda function")
+    arguments = argumentParser.parse_args()
+
+    imapServer = FakeIMAPServer().start()
+    vstsServer = FakeVstsServer().start()
+    s3Client = FakeS3Client()
+    generator = loadGenerator(imapServer, vstsServer, s3Client)
+
+    print("%7s  %7s  %9s  %10s  %9s  %s" % ("emails", "id gap", "seconds", "emails/s", "peak MiB", "round trips"))
+    vstsCallsPerEmail = {}
+    for emailCount in arguments.emails:
+        for idGap in arguments.id_gaps:
+            result = runPoll(generator, imapServer, vstsServer, s3Client, emailCount, idGap,
+                             arguments.latency_ms / 1000.0, arguments.body_kib, arguments.capacity, arguments.attachment_kib, arguments.verbose)
+            print("%7d  %7d  %9.3f  %10.1f  %9.1f  imap[%s] vsts[%s] s3[%s]" % (
+                emailCount, idGap, result["seconds"], emailCount / result["seconds"], result["peak"] / 1048576.0,
+                formatCounts(result["imap"]), formatCounts(result["vsts"]), formatCounts(result["s3"])))
+            acceptedCalls = sum(count for stage, count in result["vsts"].items() if stage != "throttled")
+            vstsCallsPerEmail.setdefault(emailCount, {})[idGap] = acceptedCalls / float(max(result["intake"], 1))
+
+    regressions = [emailCount for emailCount, perGap in vstsCallsPerEmail.items() if len(set(perGap.values())) > 1]
+    for emailCount in regressions:
+        print("REGRESSION: VSTS round trips per email depend on the ID gap for %d emails: %s" % (emailCount, vstsCallsPerEmail[emailCount]))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
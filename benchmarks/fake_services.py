@@ -0,0 +1,728 @@
+"""In-process stand-ins for the IMAP server, the VSTS REST API, S3, KMS and SMTP, used by the offline benchmarks.
+
+Every stand-in counts the round trips it serves, so a benchmark can report how many calls each stage of a poll made.
+"""
+# Import the JSON, regular expression, threading and socket wait modules
+import json
+import re
+import threading
+import select
+import time
+import smtplib
+
+# Import the server modules
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from urllib.parse import urlsplit, unquote
+
+# Import the email building modules
+from datetime import datetime
+from email.charset import Charset, QP
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from email import message_from_bytes
+from email.utils import format_datetime
+
+# Import the AWS error module
+from botocore.exceptions import ClientError
+
+
+def buildIntakeEmail(taskNumber, sender, bodyKiB=8, intake=True, attachmentKiB=0):
+    """
+    Builds a ServiceNow-like email with a quoted-printable HTML body of roughly 'bodyKiB' KiB,
+    optionally followed by a binary attachment of 'attachmentKiB' KiB
+
+    Parameters:
+    ----------
+    taskNumber : int
+    sender : str
+        Example: "servicenow@example.com"
+    bodyKiB : int
+    intake : bool
+        False builds a notification whose Subject does not start with "TASK", which the poll must skip
+    attachmentKiB : int
+    ----------
+
+    Returns:
+    ----------
+    rawEmail : bytes
+    """
+    task = "TASK%07d" % taskNumber
+    header = ("<html><body><p>Request Name: Synthetic request " + task + "<br>"
+              "GBL#: GBL%04d<br>PyxIS#: PX-%04d<br>" % (taskNumber % 10000, taskNumber % 10000))
+    row = "<tr><td class=\"cell\">Requirement detail</td><td style=\"width=50%\">Value = 42</td></tr>\n"
+    html = header + "<table>" + row * max(1, (bodyKiB * 1024) // len(row)) + "</table></body></html>"
+
+    message = MIMEMultipart("mixed" if attachmentKiB else "alternative")
+    message["From"] = "ServiceNow <" + sender + ">"
+    message["Date"] = format_datetime(datetime.now().astimezone())
+    message["Subject"] = (task + " Intake Request assigned to your group") if intake else ("RITM%07d has been updated" % taskNumber)
+    quotedPrintable = Charset("utf-8")
+    quotedPrintable.body_encoding = QP
+    htmlPart = MIMEText("", "html")
+    del htmlPart["Content-Transfer-Encoding"]
+    htmlPart.set_payload(html, quotedPrintable)
+    message.attach(htmlPart)
+    if attachmentKiB:
+        attachment = MIMEApplication(bytes(range(256)) * (attachmentKiB * 4), "octet-stream")
+        attachment.add_header("Content-Disposition", "attachment", filename="screenshot.bin")
+        message.attach(attachment)
+    return message.as_bytes()
+
+
+def quoteIMAP(value):
+    return "NIL" if value is None else '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def bodyStructure(part):
+    """
+    Renders the IMAP BODYSTRUCTURE of a parsed MIME part
+    """
+    if part.is_multipart():
+        boundary = part.get_boundary()
+        return ("(" + "".join(bodyStructure(child) for child in part.get_payload()) + " " + quoteIMAP(part.get_content_subtype()) +
+                " (" + quoteIMAP("boundary") + " " + quoteIMAP(boundary) + ") NIL NIL)")
+    parameters = part.get_params()[1:] if part.get_params() else []
+    parameterList = "(" + " ".join(quoteIMAP(name) + " " + quoteIMAP(value) for name, value in parameters) + ")" if parameters else "NIL"
+    payload = part.get_payload()
+    size = len(payload.encode("utf-8", "surrogateescape"))
+    disposition = part.get_content_disposition()
+    dispositionList = "(" + quoteIMAP(disposition) + " NIL)" if disposition else "NIL"
+    fields = [quoteIMAP(part.get_content_maintype()), quoteIMAP(part.get_content_subtype()), parameterList, "NIL", "NIL",
+              quoteIMAP(part.get("Content-Transfer-Encoding", "7bit")), str(size)]
+    if part.get_content_maintype() == "text":
+        fields.append(str(payload.count("\n")))
+    fields += ["NIL", dispositionList, "NIL"]
+    return "(" + " ".join(fields) + ")"
+
+
+def bodySection(part, section):
+    """
+    Returns the encoded content of a numbered body section, Example: "1.2"
+    """
+    for number in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part.get_payload().encode("utf-8", "surrogateescape")
+
+
+class FakeMessage(object):
+    __slots__ = ("uid", "raw", "sender", "date", "subject", "mime")
+
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        headerBlock = raw.split(b"\n\n", 1)[0].decode("utf-8", "replace")
+        self.sender = re.search(r'^From: (.*)$', headerBlock, re.M).group(1).strip()
+        self.date = re.search(r'^Date: (.*)$', headerBlock, re.M).group(1).strip()
+        self.subject = re.search(r'^Subject: (.*)$', headerBlock, re.M).group(1).strip()
+        # parsed up front, so the server side is not counted in the memory traced during a poll
+        self.mime = message_from_bytes(raw)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    Plain-text IMAP4rev1 server holding one INBOX in memory, with the commands the generator uses:
+    CAPABILITY, LOGIN, SELECT, STATUS, NOOP, UID SEARCH, (UID) FETCH, UID MOVE, IDLE, CLOSE and LOGOUT.
+
+    Parameters:
+    ----------
+    latency : float
+        Seconds added to every command
+    ----------
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    # Capabilities advertised before and after LOGIN: like most servers, MOVE and the other extensions only once authenticated
+    greetingCapabilities = "IMAP4rev1 AUTH=PLAIN"
+    capabilities = "IMAP4rev1 MOVE UIDPLUS IDLE"
+    # True: the LOGIN completion carries a [CAPABILITY ...] response code, False: the client has to ask with CAPABILITY
+    loginCapabilityCode = True
+
+    def __init__(self, latency=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), FakeIMAPHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.reset([])
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def reset(self, rawMessages, uidValidity=None):
+        """
+        Replaces the INBOX with 'rawMessages' (UIDs 1..n) and clears the archive and the counters
+        """
+        with self.lock:
+            self.uidValidity = uidValidity or int(time.time())
+            self.inbox = [FakeMessage(index + 1, raw) for index, raw in enumerate(rawMessages)]
+            self.nextUID = len(self.inbox) + 1
+            self.archived = {}
+            self.counts = Counter()
+            self.closingIdle = False
+
+    def deliver(self, raw):
+        """
+        Adds a message to the INBOX, reported to the idling sessions with an EXISTS response
+        """
+        with self.lock:
+            self.inbox.append(FakeMessage(self.nextUID, raw))
+            self.nextUID += 1
+
+    def closeIdleSessions(self):
+        """
+        Ends every idling session with a BYE response, as a server shutting down would
+        """
+        with self.lock:
+            self.closingIdle = True
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+
+def parseSequenceSet(sequenceSet, highest):
+    """
+    Expands an IMAP sequence set, Example: "1,4:6,9:*"
+    """
+    numbers = set()
+    for part in sequenceSet.split(","):
+        if ":" in part:
+            low, high = part.split(":")
+            low = highest if low == "*" else int(low)
+            high = highest if high == "*" else int(high)
+            numbers.update(range(min(low, high), max(low, high) + 1))
+        else:
+            numbers.add(highest if part == "*" else int(part))
+    return numbers
+
+
+def tokenize(arguments):
+    return [token.strip('"') for token in re.findall(r'"[^"]*"|\(|\)|[^\s()]+', arguments)]
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode("utf-8"))
+
+    def handle(self):
+        server = self.server
+        self.selected = False
+        # number of messages the client was last told about, so IDLE reports the ones that arrived since
+        self.reportedCount = 0
+        self.authenticated = False
+        self.send("* OK [CAPABILITY " + server.greetingCapabilities + "] Fake IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode("utf-8", "replace").rstrip("\r\n").split(" ", 2)
+            tag, command = parts[0], (parts[1].upper() if len(parts) > 1 else "")
+            arguments = parts[2] if len(parts) > 2 else ""
+            useUID = command == "UID"
+            if useUID:
+                command, arguments = (arguments.split(" ", 1) + [""])[:2]
+                command = command.upper()
+            with server.lock:
+                server.counts[("UID " if useUID else "") + command] += 1
+            if server.latency:
+                time.sleep(server.latency)
+            handler = getattr(self, "do_" + command, None)
+            if handler is None:
+                self.send(tag + " BAD unknown command " + command + "\r\n")
+                continue
+            self.tag = tag
+            self.responseCode = ""
+            if command == "IDLE":
+                # waits for DONE, so it takes the lock itself while checking the INBOX
+                result = handler(arguments, useUID)
+            else:
+                with server.lock:
+                    result = handler(arguments, useUID)
+            if result is False:
+                return
+            self.send(tag + " OK " + self.responseCode + command + " completed\r\n")
+
+    def do_CAPABILITY(self, arguments, useUID):
+        server = self.server
+        self.send("* CAPABILITY " + (server.capabilities if self.authenticated else server.greetingCapabilities) + "\r\n")
+
+    def do_LOGIN(self, arguments, useUID):
+        self.authenticated = True
+        if self.server.loginCapabilityCode:
+            self.responseCode = "[CAPABILITY " + self.server.capabilities + "] "
+
+    def do_NOOP(self, arguments, useUID):
+        pass
+
+    def do_SELECT(self, arguments, useUID):
+        server = self.server
+        self.selected = True
+        self.reportedCount = len(server.inbox)
+        self.send("* " + str(len(server.inbox)) + " EXISTS\r\n* 0 RECENT\r\n"
+                  "* OK [UIDVALIDITY " + str(server.uidValidity) + "] UIDs valid\r\n"
+                  "* OK [UIDNEXT " + str(server.nextUID) + "] Predicted next UID\r\n")
+
+    def do_STATUS(self, arguments, useUID):
+        server = self.server
+        self.send("* STATUS INBOX (UIDVALIDITY " + str(server.uidValidity) + " MESSAGES " + str(len(server.inbox)) + ")\r\n")
+
+    def do_SEARCH(self, arguments, useUID):
+        tokens = [token for token in tokenize(arguments) if token not in ("(", ")")]
+        matches = list(self.server.inbox)
+        index = 0
+        while index < len(tokens):
+            key = tokens[index].upper()
+            if key == "UID":
+                highest = matches[-1].uid if matches else 0
+                wanted = parseSequenceSet(tokens[index + 1], highest)
+                matches = [message for message in matches if message.uid in wanted]
+                index += 2
+            elif key == "FROM":
+                matches = [message for message in matches if tokens[index + 1].lower() in message.sender.lower()]
+                index += 2
+            elif key == "HEADER":
+                name, value = tokens[index + 1].lower(), tokens[index + 2].strip("<>").lower()
+                if name == "from":
+                    matches = [message for message in matches if value in message.sender.lower()]
+                elif name == "date":
+                    day = datetime.strptime(value, "%d %b %Y")
+                    # the Date header carries "17 Oct 2026", without a leading zero for single digit days
+                    matches = [message for message in matches if (str(day.day) + day.strftime(" %b %Y")).lower() in message.date.lower()]
+                index += 3
+            elif key in ("SINCE", "CHARSET"):
+                # every seeded message was received today
+                index += 2
+            else:
+                index += 1
+        numbers = [message.uid if useUID else self.sequenceNumber(message) for message in matches]
+        self.send("* SEARCH" + "".join(" " + str(number) for number in numbers) + "\r\n")
+
+    def sequenceNumber(self, message):
+        return self.server.inbox.index(message) + 1
+
+    def do_FETCH(self, arguments, useUID):
+        sequenceSet, items = arguments.split(" ", 1)
+        inbox = self.server.inbox
+        if useUID:
+            wanted = parseSequenceSet(sequenceSet, inbox[-1].uid if inbox else 0)
+            messages = [message for message in inbox if message.uid in wanted]
+        else:
+            wanted = parseSequenceSet(sequenceSet, len(inbox))
+            messages = [message for number, message in enumerate(inbox, 1) if number in wanted]
+        for message in messages:
+            if "HEADER.FIELDS" in items.upper():
+                label, literal = "BODY[HEADER.FIELDS (SUBJECT)]", ("Subject: " + message.subject + "\r\n\r\n").encode("utf-8")
+            elif "RFC822" in items.upper():
+                label, literal = "RFC822", message.raw
+            elif "BODYSTRUCTURE" in items.upper():
+                self.send("* " + str(self.sequenceNumber(message)) + " FETCH (UID " + str(message.uid) +
+                          " BODYSTRUCTURE " + bodyStructure(message.mime) + ")\r\n")
+                continue
+            elif re.search(r'BODY\.PEEK\[[\d.]+\]', items.upper()):
+                section, offset, count = re.search(r'BODY\.PEEK\[([\d.]+)\](?:<(\d+)\.(\d+)>)?', items.upper()).groups()
+                literal = bodySection(message.mime, section)
+                label = "BODY[" + section + "]"
+                if offset is not None:
+                    literal = literal[int(offset):int(offset) + int(count)]
+                    label += "<" + offset + ">"
+            else:
+                label, literal = "BODY[]", message.raw
+            self.send("* " + str(self.sequenceNumber(message)) + " FETCH (UID " + str(message.uid) + " " + label +
+                      " {" + str(len(literal)) + "}\r\n")
+            self.send(literal)
+            self.send(")\r\n")
+
+    def do_MOVE(self, arguments, useUID):
+        sequenceSet, mailbox = arguments.split(" ", 1)
+        server = self.server
+        wanted = parseSequenceSet(sequenceSet, server.inbox[-1].uid if server.inbox else 0)
+        for message in reversed([message for message in server.inbox if message.uid in wanted]):
+            self.send("* " + str(self.sequenceNumber(message)) + " EXPUNGE\r\n")
+            server.inbox.remove(message)
+            self.reportedCount -= 1
+            server.archived.setdefault(mailbox.strip('"'), []).append(message)
+
+    def do_IDLE(self, arguments, useUID):
+        """
+        Reports the messages delivered while idling until the client sends DONE; mail that arrived before the command
+        is reported in the same write as the continuation, as real servers often do
+        """
+        server = self.server
+        waiting = "+ idling\r\n"
+        while True:
+            with server.lock:
+                if server.closingIdle:
+                    self.send(waiting + "* BYE Fake IMAP shutting down\r\n")
+                    return False
+                if len(server.inbox) > self.reportedCount:
+                    self.reportedCount = len(server.inbox)
+                    waiting += "* " + str(self.reportedCount) + " EXISTS\r\n"
+            if waiting:
+                self.send(waiting)
+                waiting = ""
+            if select.select([self.connection], [], [], 0.02)[0]:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == b"DONE":
+                    return None
+
+    def do_CLOSE(self, arguments, useUID):
+        self.selected = False
+
+    def do_LOGOUT(self, arguments, useUID):
+        self.send("* BYE Fake IMAP closing\r\n" + self.tag + " OK LOGOUT completed\r\n")
+        return False
+
+
+class FakeVstsServer(ThreadingHTTPServer):
+    """
+    HTTP/1.1 keep-alive stand-in for the VSTS Work Item Tracking REST API:
+    work item creation (single and $batch), get_workitem, add_link (relation PATCH) and WIQL queries on 'GTSKanban.TASK'.
+
+    Parameters:
+    ----------
+    latency : float
+        Seconds added to every request
+    idGap : int
+        Number of work item IDs consumed by other projects between two items created here
+    capacity : int
+        Number of requests served at the same time; further requests are throttled (429 with Retry-After),
+        0 for no limit
+    ----------
+    """
+    daemon_threads = True
+    # Retry-After of a throttled request, in seconds
+    retryAfter = 0.05
+
+    def __init__(self, latency=0.0, idGap=0, capacity=0):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeVstsHandler)
+        self.latency = latency
+        self.idGap = idGap
+        self.capacity = capacity
+        self.inFlight = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def baseUrl(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def reset(self, latency=None, idGap=None, capacity=None):
+        with self.lock:
+            if latency is not None:
+                self.latency = latency
+            if idGap is not None:
+                self.idGap = idGap
+            if capacity is not None:
+                self.capacity = capacity
+            self.workItems = {}
+            self.nextID = 1000
+            self.counts = Counter()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def createWorkItem(self, workItemType, operations, temporaryIDs):
+        """
+        Applies the JSON Patch operations of a creation request, resolving temporary negative IDs of the same $batch
+        """
+        workItemID = self.nextID
+        self.nextID += 1 + self.idGap
+        workItem = {"id": workItemID, "fields": {"System.WorkItemType": workItemType}, "relations": []}
+        for operation in operations:
+            if operation["path"] == "/id":
+                temporaryIDs[int(operation["value"])] = workItemID
+            elif operation["path"].startswith("/fields/"):
+                workItem["fields"][operation["path"][len("/fields/"):]] = operation["value"]
+            elif operation["path"] == "/relations/-":
+                self.addRelation(workItem, operation["value"], temporaryIDs)
+        self.workItems[workItemID] = workItem
+        return workItem
+
+    def updateWorkItem(self, workItemID, operations):
+        """
+        Applies the JSON Patch operations of an update request (fields and relations) to an existing work item
+        """
+        workItem = self.workItems[workItemID]
+        for operation in operations:
+            if operation["path"].startswith("/fields/"):
+                if operation["op"] == "remove":
+                    workItem["fields"].pop(operation["path"][len("/fields/"):], None)
+                else:
+                    workItem["fields"][operation["path"][len("/fields/"):]] = operation["value"]
+            elif operation["path"] == "/relations/-":
+                self.addRelation(workItem, operation["value"], {})
+        workItem["rev"] = workItem.get("rev", 1) + 1
+        return workItem
+
+    def addRelation(self, workItem, relation, temporaryIDs):
+        targetID = int(relation["url"].rstrip("/").rsplit("/", 1)[1])
+        targetID = temporaryIDs.get(targetID, targetID)
+        if targetID not in self.workItems:
+            raise KeyError("work item " + str(targetID) + " does not exist")
+        workItem["relations"].append({"rel": relation["rel"], "url": "/_apis/wit/workitems/" + str(targetID),
+                                      "attributes": relation.get("attributes", {})})
+
+    def linkCount(self):
+        with self.lock:
+            return sum(len(workItem["relations"]) for workItem in self.workItems.values())
+
+
+class FakeVstsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *arguments):
+        pass
+
+    def reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+        path = unquote(urlsplit(self.path).path)
+        with server.lock:
+            throttled = server.capacity and server.inFlight >= server.capacity
+            if throttled:
+                server.counts["throttled"] += 1
+            else:
+                server.inFlight += 1
+        if throttled:
+            self.reply(429, {"message": "Request was blocked due to exceeding usage of resource"},
+                       {"Retry-After": str(server.retryAfter), "X-RateLimit-Resource": "WorkItemTracking"})
+            return
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            with server.lock:
+                try:
+                    stage, status, result = self.dispatch(server, method, path, payload)
+                except KeyError as error:
+                    stage, status, result = "error", 404, {"message": str(error)}
+                server.counts[stage] += 1
+        finally:
+            with server.lock:
+                server.inFlight -= 1
+        self.reply(status, result)
+
+    def dispatch(self, server, method, path, payload):
+        if method == "POST" and path.endswith("/_apis/wit/$batch"):
+            temporaryIDs = {}
+            responses = []
+            for subRequest in payload:
+                uriPath = unquote(urlsplit(subRequest["uri"]).path)
+                try:
+                    if "$" in uriPath:
+                        workItem = server.createWorkItem(uriPath.rsplit("$", 1)[1], subRequest["body"], temporaryIDs)
+                    else:
+                        workItem = server.updateWorkItem(int(uriPath.rstrip("/").rsplit("/", 1)[1]), subRequest["body"])
+                    responses.append({"code": 200, "body": json.dumps(workItem)})
+                except KeyError as error:
+                    responses.append({"code": 404, "body": json.dumps({"message": str(error)})})
+            return "batch", 200, {"count": len(responses), "value": responses}
+        if method == "POST" and path.endswith("/_apis/wit/wiql"):
+            query = payload["query"]
+            task = re.search(r"\[GTSKanban\.TASK\] = '((?:[^']|'')*)'", query)
+            workItemType = re.search(r"\[System\.WorkItemType\] = '((?:[^']|'')*)'", query)
+            taskList = re.search(r"\[GTSKanban\.TASK\] IN \(([^)]*)\)", query)
+            tasks = None if taskList is None else set(value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", taskList.group(1)))
+            matches = [workItem["id"] for workItem in server.workItems.values()
+                       if (task is None or workItem["fields"].get("GTSKanban.TASK") == task.group(1).replace("''", "'")) and
+                       (tasks is None or workItem["fields"].get("GTSKanban.TASK") in tasks) and
+                       (workItemType is None or workItem["fields"]["System.WorkItemType"] == workItemType.group(1).replace("''", "'"))]
+            afterID = re.search(r"\[System\.Id\] > (\d+)", query)
+            if afterID is not None:
+                matches = [workItemID for workItemID in matches if workItemID > int(afterID.group(1))]
+            ascending = "ORDER BY [System.Id]" in query and "ORDER BY [System.Id] DESC" not in query
+            return "wiql", 200, {"workItems": [{"id": workItemID} for workItemID in sorted(matches, reverse=not ascending)]}
+        if method == "POST" and path.endswith("/_apis/wit/workitemsbatch"):
+            workItems = []
+            for workItemID in payload["ids"]:
+                if workItemID in server.workItems:
+                    workItem = server.workItems[workItemID]
+                    fields = dict((name, value) for name, value in workItem["fields"].items()
+                                  if not payload.get("fields") or name in payload["fields"])
+                    workItems.append({"id": workItemID, "fields": fields})
+                    if payload.get("$expand", "").lower() in ("relations", "all"):
+                        workItems[-1]["relations"] = workItem["relations"]
+            return "read", 200, {"count": len(workItems), "value": workItems}
+        match = re.search(r'/_apis/wit/workitems/(\$?[^/]+)$', path)
+        if match is None:
+            raise KeyError("no route for " + method + " " + path)
+        if match.group(1).startswith("$"):
+            return "create", 200, server.createWorkItem(match.group(1)[1:], payload, {})
+        workItem = server.workItems[int(match.group(1))]
+        if method == "GET":
+            return "get", 200, workItem
+        if all(operation["path"] == "/relations/-" for operation in payload):
+            return "link", 200, server.updateWorkItem(workItem["id"], payload)
+        return "update", 200, server.updateWorkItem(workItem["id"], payload)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+
+class FakeS3Client(object):
+    """
+    In-memory S3 client with the conditional GET (IfNoneMatch), the ranged GET ("bytes=first-last") and the
+    conditional PUT (IfMatch, IfNoneMatch='*') of the run state store
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.version = 0
+
+    def _error(self, code, operation):
+        return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.counts["get"] += 1
+            if (Bucket, Key) not in self.objects:
+                raise self._error("NoSuchKey", "GetObject")
+            etag, body = self.objects[(Bucket, Key)]
+            if IfNoneMatch is not None and IfNoneMatch == etag:
+                raise self._error("304", "GetObject")
+        if Range is not None:
+            first, last = Range.split("=", 1)[1].split("-")
+            body = body[int(first):int(last) + 1 if last else None]
+        return {"ETag": etag, "Body": FakeBody(body)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **options):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.counts["put"] += 1
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == "*" and current is not None) or (IfMatch is not None and (current is None or current[0] != IfMatch)):
+                raise self._error("PreconditionFailed", "PutObject")
+            self.version += 1
+            etag = '"' + str(self.version) + '"'
+            self.objects[(Bucket, Key)] = (etag, Body if isinstance(Body, bytes) else Body.encode("utf-8"))
+        return {"ETag": etag}
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.counts["delete"] += 1
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+
+class FakeBody(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, amount=None):
+        end = len(self.data) if amount is None else self.position + amount
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+
+class FakeS3Resource(object):
+    """
+    The part of the boto3 S3 resource used by the .txt file helpers, on top of a FakeS3Client
+    """
+    def __init__(self, client):
+        self.client = client
+        self.meta = type("Meta", (object,), {"client": client})()
+
+    def Object(self, bucketName, key):
+        client = self.client
+        return type("Object", (object,), {"get": lambda _: client.get_object(Bucket=bucketName, Key=key)})()
+
+    def Bucket(self, bucketName):
+        client = self.client
+        return type("Bucket", (object,), {"put_object": lambda _, Key, Body: client.put_object(Bucket=bucketName, Key=Key, Body=Body)})()
+
+
+class FakeKMSClient(object):
+    """
+    KMS stand-in: the 'ciphertext' is the plaintext itself
+    """
+    def __init__(self):
+        self.counts = Counter()
+
+    def decrypt(self, CiphertextBlob):
+        self.counts["decrypt"] += 1
+        return {"Plaintext": CiphertextBlob}
+
+
+class FakeSMTPModule(object):
+    """
+    Stand-in for the smtplib module of the Lambda function: SMTP sessions that keep the sent emails in 'sent'
+    and count the sessions opened and the emails sent
+    """
+    SMTPServerDisconnected = smtplib.SMTPServerDisconnected
+
+    def __init__(self):
+        self.sent = []
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def SMTP(self, host, port):
+        module = self
+        module.counts["sessions"] += 1
+
+        class FakeSMTPSession(object):
+            def ehlo(self):
+                return 250, b"ok"
+
+            def starttls(self):
+                return 220, b"ok"
+
+            def login(self, user, password):
+                return 235, b"ok"
+
+            def noop(self):
+                return 250, b"ok"
+
+            def sendmail(self, sender, recipient, message):
+                with module.lock:
+                    module.counts["emails"] += 1
+                    module.sent.append((sender, recipient, message))
+                return {}
+
+            def close(self):
+                pass
+
+        return FakeSMTPSession()
+
+
+class FakeLambdaContext(object):
+    """
+    The part of the Lambda context object read by the handler
+    """
+    def __init__(self, timeoutSeconds=900):
+        self.deadline = time.time() + timeoutSeconds
+        self.function_name = "VSTSWorkItemGenerator-benchmark"
+        self.aws_request_id = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
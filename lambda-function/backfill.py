@@ -0,0 +1,187 @@
+"""Backfill: replays an mbox file or Maildir export of missed Intake Requests into VSTS, resumable through a checkpoint file."""
+# Import the OS, JSON and time modules
+import os
+import json
+import time
+
+# Import the thread pool module
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Import the email header decoding module
+from email.header import decode_header, make_header
+
+# Import the Intake Request email parser
+from intake_parser import parseIntakeMessage, splitHeaders
+
+# Import the mbox/Maildir export reader
+from mail_export import iterExport
+
+# Import the VSTS REST API helper (paged WIQL queries, workitemsbatch reads)
+from vsts_rest import MAX_BATCH_REQUESTS, wiqlQuote, queryWorkItemIDsPaged, readWorkItemsChunked
+
+
+def loadTaskIndex(restClient, route, workers=4):
+    """
+    Reads the TASK Number of every existing Request work item of a route, so a backfill can skip them without one query per email:
+    WIQL queries paged by ID return the work item IDs, then the 'GTSKanban.TASK' fields are read MAX_WORKITEMS_BATCH items per call
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+    workers : int
+        Concurrent workitemsbatch calls
+    ----------
+
+    Returns:
+    ----------
+    tasks : set of str
+    """
+    workItemIDs = queryWorkItemIDsPaged(restClient, route.project,
+                                        " AND [System.WorkItemType] = " + wiqlQuote(route.requestType) +
+                                        " AND [GTSKanban.TASK] <> ''")
+    tasks = set()
+    for workItems in readWorkItemsChunked(restClient, workItemIDs, workers, ["GTSKanban.TASK"]):
+        tasks.update(str(workItem["fields"]["GTSKanban.TASK"]) for workItem in workItems
+                     if workItem.get("fields", {}).get("GTSKanban.TASK"))
+    print("TASK index of " + route.project + ": " + str(len(tasks)) + " TASKs already have work items")
+    return tasks
+
+
+def iterBackfillRecords(exportPath, route, start=0):
+    """
+    Streams an mbox/Maildir export and parses the Intake Requests of a route (sender and Subject pattern)
+
+    Yields:
+    ----------
+    (index, record) : tuple
+        record is None for a message that is not an Intake Request of the route
+    """
+    for index, key, rawEmail in iterExport(exportPath, start):
+        headers = splitHeaders(rawEmail)[0]
+        subject = str(make_header(decode_header(headers.get("Subject", ""))))
+        if route.sender.lower() not in str(headers.get("From", "")).lower() or not route.isIntakeSubject(subject):
+            yield index, None
+            continue
+        yield index, parseIntakeMessage(rawEmail, key, subject)
+
+
+def writeCheckpoint(checkpointPath, checkpoint):
+    """
+    Replaces the backfill checkpoint file in one step, so an interrupted write never leaves a truncated checkpoint
+    """
+    temporaryPath = checkpointPath + ".tmp"
+    with open(temporaryPath, "w") as checkpointFile:
+        json.dump(checkpoint, checkpointFile, indent=1, sort_keys=True)
+    os.replace(temporaryPath, checkpointPath)
+
+
+def replayExport(exportPath, route, restClient, processChunk, checkpointPath=None, batchEmails=MAX_BATCH_REQUESTS // 2, workers=4,
+                 recordTasks=None):
+    """
+    Replays an mbox file or Maildir export of missed Intake Requests into VSTS.
+
+    Messages are streamed (a memory-mapped mbox is never read whole) and the TASKs that already have work items are
+    skipped using an index loaded once. The Request/PBI pairs are created 'batchEmails' emails per $batch call by
+    'workers' concurrent calls, with the number of pending batches bounded, so memory stays constant whatever the export size.
+    After every batch the checkpoint records the position up to which every message is done; a new run over the same
+    export resumes from there, and TASKs created after the checkpoint are skipped through the TASK index.
+
+    Parameters:
+    ----------
+    exportPath : str
+        mbox file or Maildir directory
+    route : Route
+        Route the emails belong to
+    restClient : object
+        VSTS REST API connection
+    processChunk : function
+        Creates and links the cards of a list of IntakeRecords, returns (processedRecords, createdIDNumbers)
+    checkpointPath : str
+        Default: exportPath + ".checkpoint.json"
+    batchEmails : int
+        Emails per $batch call, at most MAX_BATCH_REQUESTS / 2
+    workers : int
+        Concurrent $batch calls
+    recordTasks : function
+        Takes the TASK Numbers whose cards this run created, called at its end even when it stops on an error;
+        None when they are not recorded
+    ----------
+
+    Returns:
+    ----------
+    checkpoint : dict
+        Position reached and the number of emails created, skipped and failed
+    """
+    batchEmails = max(1, min(batchEmails, MAX_BATCH_REQUESTS // 2))
+    checkpointPath = checkpointPath or exportPath.rstrip("/") + ".checkpoint.json"
+
+    checkpoint = {"source": os.path.abspath(exportPath), "route": route.name, "position": 0, "created": 0, "skipped": 0, "failed": 0}
+    if os.path.exists(checkpointPath):
+        with open(checkpointPath) as checkpointFile:
+            saved = json.load(checkpointFile)
+        if saved.get("source") == checkpoint["source"] and saved.get("route") == route.name:
+            checkpoint.update(saved)
+            print("Resuming backfill at message " + str(checkpoint["position"]))
+
+    existingTasks = loadTaskIndex(restClient, route, workers)
+    createdTasks = []
+    # first index -> (last index, completed) of every batch not yet covered by the checkpoint
+    batchRanges = {}
+    started = time.time()
+
+    def collect(futures):
+        for future in futures:
+            firstIndex, lastIndex, records = pending.pop(future)
+            try:
+                processedRecords, createdIDNumbers = future.result()
+            except Exception as error:
+                print("Backfill batch of messages " + str(firstIndex) + "-" + str(lastIndex) + " failed: " + repr(error))
+                processedRecords = []
+            createdTasks.extend(record.task for record in processedRecords)
+            checkpoint["created"] += len(processedRecords)
+            checkpoint["failed"] += len(records) - len(processedRecords)
+            batchRanges[firstIndex] = (lastIndex, len(processedRecords) == len(records))
+        # the checkpoint only moves over consecutive completed batches
+        while checkpoint["position"] in batchRanges and batchRanges[checkpoint["position"]][1]:
+            checkpoint["position"] = batchRanges.pop(checkpoint["position"])[0] + 1
+        writeCheckpoint(checkpointPath, checkpoint)
+        print("Backfill: " + str(checkpoint["position"]) + " messages done, " + str(checkpoint["created"]) + " created, " +
+              str(checkpoint["skipped"]) + " skipped, " + str(checkpoint["failed"]) + " failed, " +
+              str(round(checkpoint["created"] / max(time.time() - started, 0.001), 1)) + " emails/s")
+
+    pending = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def submit(firstIndex, lastIndex, records):
+                while len(pending) >= 2 * workers:
+                    done = wait(list(pending), return_when=FIRST_COMPLETED)[0]
+                    collect(done)
+                future = executor.submit(processChunk, records) if records else executor.submit(lambda: ([], []))
+                pending[future] = (firstIndex, lastIndex, records)
+
+            batch = []
+            firstIndex = checkpoint["position"]
+            lastIndex = firstIndex - 1
+            for index, record in iterBackfillRecords(exportPath, route, checkpoint["position"]):
+                lastIndex = index
+                if record is None:
+                    pass
+                elif record.task in existingTasks:
+                    checkpoint["skipped"] += 1
+                else:
+                    existingTasks.add(record.task)
+                    batch.append(record)
+                if len(batch) == batchEmails:
+                    submit(firstIndex, index, batch)
+                    batch = []
+                    firstIndex = index + 1
+            if lastIndex >= firstIndex:
+                submit(firstIndex, lastIndex, batch)
+            collect(wait(list(pending))[0])
+    finally:
+        if recordTasks is not None and createdTasks:
+            recordTasks(createdTasks)
+
+    return checkpoint
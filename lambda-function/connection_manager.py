@@ -0,0 +1,100 @@
+"""Keeps the IMAP session, the VSTS HTTP connection pool and the SMTP session alive across warm Lambda invocations."""
+# Import the threading module
+import threading
+
+
+class ConnectionManager(object):
+    """
+    Module-scope registry of long-lived connections.
+
+    A connection is created by its 'connect' function the first time it is asked for, and handed out again on later
+    (warm) invocations after a cheap liveness check - NOOP for IMAP and SMTP. A connection that fails the check is
+    closed, discarded and transparently replaced. The number of times each kind of connection was created and reused is kept
+    for reporting.
+    """
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.created = {}
+        self.reused = {}
+
+    def get(self, kind, key, connect, isAlive=None, close=None, exclusive=False):
+        """
+        Returns a live connection, reusing the stored one when it passes its liveness check
+
+        Parameters:
+        ----------
+        kind : str
+            Example: "imap", "smtp", "vsts"
+        key : tuple
+            Identifies the connection within its kind, Example: (host, user name, mailbox)
+        connect : function
+            Creates a new connection
+        isAlive : function
+            Returns True when the stored connection can still be used, no check when None
+        close : function
+            Closes a connection that is discarded, Example: lambda mail: mail.shutdown()
+        exclusive : bool
+            Only one connection of the kind is kept: creating one closes the others,
+            Example: the client of a rotated VSTS token replaces the client of the old token
+        ----------
+
+        Returns:
+        ----------
+        connection : object
+        """
+        with self.lock:
+            connection = self.connections.get((kind, key))
+        if connection is not None:
+            try:
+                alive = isAlive is None or isAlive(connection)
+            except Exception as error:
+                print("Stored " + kind + " connection failed its liveness check: " + repr(error))
+                alive = False
+            if alive:
+                with self.lock:
+                    self.reused[kind] = self.reused.get(kind, 0) + 1
+                return connection
+            self.discard(kind, key, close)
+        connection = connect()
+        with self.lock:
+            self.connections[(kind, key)] = connection
+            self.created[kind] = self.created.get(kind, 0) + 1
+            staleKeys = [storedKey for storedKind, storedKey in self.connections if storedKind == kind and storedKey != key] if exclusive else []
+        for staleKey in staleKeys:
+            self.discard(kind, staleKey, close)
+        return connection
+
+    def discard(self, kind, key, close=None):
+        """
+        Forgets a stored connection (after an error left it in an unknown state), closing it with 'close' when given
+        """
+        with self.lock:
+            connection = self.connections.pop((kind, key), None)
+        if connection is not None and close is not None:
+            try:
+                close(connection)
+            except Exception:
+                pass
+
+    def report(self):
+        """
+        Returns the number of connections created and reused per kind, Example: {"imap": {"created": 1, "reused": 14}}
+        """
+        with self.lock:
+            kinds = set(self.created) | set(self.reused)
+            return dict((kind, {"created": self.created.get(kind, 0), "reused": self.reused.get(kind, 0)}) for kind in sorted(kinds))
+
+
+def imapIsAlive(mail):
+    """
+    Liveness check of a stored IMAP session
+    """
+    return mail.noop()[0] == 'OK'
+
+
+def smtpIsAlive(mailserver):
+    """
+    Liveness check of a stored SMTP session
+    """
+    return mailserver.noop()[0] == 250
@@ -0,0 +1,166 @@
+"""Long-running alternative to the scheduled polls: waits for new mail with IMAP IDLE on one session and reconnects with backoff."""
+# Import the Regular Expression, time, socket wait, random and counter modules
+import re
+import time
+import select
+import random
+import itertools
+
+# Import the IMAP email client and TLS modules
+import imaplib
+import ssl
+
+
+# Tags of the IDLE commands; imaplib only tracks the tags it issues itself, so these never collide with its own
+idleTags = itertools.count(1)
+
+
+class DaemonConfigurationError(RuntimeError):
+    """
+    Error of the daemon's setup that reconnecting cannot fix, Example: an IMAP server without IDLE
+    """
+
+
+def imapBufferedLine(mail):
+    """
+    Tells whether imaplib already holds received bytes that select() on the socket would not report:
+    the rest of an earlier read of its buffered file, or decrypted TLS data
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection
+    ----------
+
+    Returns:
+    ----------
+    buffered : bool
+    """
+    timeout = mail.sock.gettimeout()
+    # a non-blocking peek returns the buffered bytes without waiting for the socket
+    mail.sock.settimeout(0)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+
+def imapIdle(mail, timeoutSeconds):
+    """
+    Issues an IMAP IDLE command and waits until the server reports new mail or 'timeoutSeconds' pass, then ends it with DONE.
+
+    Uses the IDLE support of imaplib where it exists (Python 3.14). Older versions have none, so the untagged responses
+    are read with imaplib's readline(), from its buffered file, and select() only waits on the socket when nothing is
+    buffered; the connection is back in its normal state for imaplib when this function returns.
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection, with a mailbox selected
+    timeoutSeconds : float
+    ----------
+
+    Returns:
+    ----------
+    newMail : bool
+        True when the server reported an EXISTS or RECENT response
+    """
+    if hasattr(mail, 'idle'):
+        with mail.idle(duration=timeoutSeconds) as idler:
+            for responseType, data in idler:
+                if responseType in ('EXISTS', 'RECENT'):
+                    return True
+        return False
+
+    tag = b'IDLE' + str(next(idleTags)).encode()
+    mail.send(tag + b' IDLE\r\n')
+
+    def readLine(deadline):
+        if not imapBufferedLine(mail):
+            remaining = max(deadline - time.time(), 0)
+            if not select.select([mail.sock], [], [], remaining)[0]:
+                return None
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while idling")
+        return line.rstrip(b"\r\n")
+
+    continuation = readLine(time.time() + 60)
+    if continuation is None or not continuation.startswith(b"+"):
+        raise imaplib.IMAP4.abort("IDLE not accepted: " + repr(continuation))
+
+    newMail = False
+    deadline = time.time() + timeoutSeconds
+    while not newMail:
+        line = readLine(deadline)
+        if line is None:
+            break
+        if line.startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort("server closed the IDLE session: " + repr(line))
+        if re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+            newMail = True
+
+    mail.send(b'DONE\r\n')
+    while True:
+        line = readLine(time.time() + 60)
+        if line is None:
+            raise imaplib.IMAP4.abort("no response to DONE")
+        if line.startswith(tag + b' '):
+            if not line.startswith(tag + b' OK'):
+                raise imaplib.IMAP4.abort("IDLE failed: " + repr(line))
+            break
+    return newMail
+
+
+def runIdleLoop(connect, processNewMail, idleSeconds=1500, maxBackoffSeconds=300):
+    """
+    Keeps one authenticated IMAP session open, waits for new mail with IDLE (re-issued every 'idleSeconds'),
+    and hands the session to 'processNewMail' once on start and then every time mail arrives.
+    Any failure of a run drops the IMAP session, which is re-established with jittered exponential backoff;
+    only a DaemonConfigurationError stops the loop.
+
+    Parameters:
+    ----------
+    connect : function
+        Opens the IMAP session, logged in and with the watched mailbox selected
+    processNewMail : function
+        Takes the IMAP session and processes the mail that arrived
+    idleSeconds : float
+        Seconds an IDLE command is left open before it is re-issued (servers drop it after 29 minutes)
+    maxBackoffSeconds : float
+        Longest wait between two reconnect attempts
+    ----------
+
+    Returns:
+    ----------
+    Never returns
+    """
+    failures = 0
+    while True:
+        mail = None
+        try:
+            mail = connect()
+            if 'IDLE' not in mail.capabilities:
+                raise DaemonConfigurationError("The IMAP server does not support IDLE")
+            newMail = True
+            while True:
+                if newMail:
+                    processNewMail(mail)
+                    failures = 0
+                newMail = imapIdle(mail, idleSeconds)
+        except DaemonConfigurationError:
+            raise
+        except Exception as error:
+            # a lost connection, a VSTS error left after the retries, a failed UID MOVE...: the session is in an unknown
+            # state, so it is dropped and a new one is opened after the backoff
+            if mail is not None:
+                try:
+                    mail.shutdown()
+                except Exception:
+                    pass
+            failures += 1
+            delay = min(maxBackoffSeconds, 2 ** min(failures, 16)) * random.uniform(0.5, 1.0)
+            print("Daemon run failed (" + repr(error) + "), reconnecting in " + str(round(delay, 1)) + " seconds")
+            time.sleep(delay)
@@ -0,0 +1,331 @@
+"""Single-pass, MIME-aware parser for the ServiceNow Intake Request emails."""
+# Import the Regular Expression Module
+import re
+
+# Import the HTML escaping module
+from html import escape
+
+# Import the transfer decoding module
+import binascii
+
+# Import the email header parsing modules
+from email.parser import BytesHeaderParser
+from email.header import decode_header, make_header
+
+
+# Every Work Item Card field found in the body, in one pattern: "<label>: <value><br>"
+FIELD_PATTERN = re.compile(r'(Request Name|GBL#|PyxIS#): (.*?)<br>', re.DOTALL)
+# TASK Number in the Subject, Example: "TASK0123456 ..." -> "0123456"
+TASK_PATTERN = re.compile(r'TASK(\S*)')
+# Line breaks and tabs removed from the description (the HTML tags are kept for formatting purposes)
+WHITESPACE_TABLE = str.maketrans("", "", "\r\n\t")
+
+# End of a MIME header block
+HEADER_END_PATTERN = re.compile(rb'\r?\n\r?\n')
+# Quoted-printable escape cut short by a size-capped fetch, Example: b"...=3" or b"...="
+PARTIAL_QP_ESCAPE = re.compile(rb'=[0-9A-Fa-f]?$')
+
+# Title used when the body has no "Request Name:" field
+DEFAULT_TITLE = "NEW VSTS WORK ITEM"
+
+# Label in the body -> IntakeRecord attribute
+FIELD_ATTRIBUTES = {"Request Name": "title", "GBL#": "gbl", "PyxIS#": "pyxis"}
+
+
+class IntakeRecord(object):
+    """
+    Data needed for the Work ID Card JSON Document of one Intake Request
+
+    Attributes:
+    ----------
+    uid : str
+        IMAP UID of the email, None when the email did not come from IMAP
+    subject : str
+    title : str
+    description : str
+        HTML body of the email
+    task : str
+        TASK Number, without the "TASK" prefix
+    gbl : str
+        GBL Number, None when the email has none
+    pyxis : str
+        Pyxis Number, None when the email has none
+    ----------
+    """
+    __slots__ = ("uid", "subject", "title", "description", "task", "gbl", "pyxis")
+
+    def __init__(self, uid, subject, title, description, task, gbl=None, pyxis=None):
+        self.uid = uid
+        self.subject = subject
+        self.title = title
+        self.description = description
+        self.task = task
+        self.gbl = gbl
+        self.pyxis = pyxis
+
+    def __repr__(self):
+        return "IntakeRecord(TASK" + str(self.task) + ", " + repr(self.title) + ")"
+
+
+def bodyToDescription(text, subtype):
+    """
+    Turns the decoded body into the HTML description of the Work Item Card:
+    HTML is used as is (decodeBody already removed its line breaks and tabs), plain text is escaped and its line breaks become <br> tags
+    """
+    if subtype == "html":
+        return text
+    return escape(text).replace("\r\n", "<br>").replace("\n", "<br>").translate(WHITESPACE_TABLE)
+
+
+def buildIntakeRecord(subject, description, uid=None):
+    """
+    Extracts every Work Item Card field from the description in a single pass
+
+    Parameters:
+    ----------
+    subject : str
+    description : str
+        HTML body of the email
+    uid : str
+    ----------
+
+    Returns:
+    ----------
+    record : IntakeRecord
+    """
+    fields = {}
+    for match in FIELD_PATTERN.finditer(description):
+        # the first occurrence of each label wins, and the scan stops as soon as every label was seen
+        fields.setdefault(FIELD_ATTRIBUTES[match.group(1)], match.group(2))
+        if len(fields) == len(FIELD_ATTRIBUTES):
+            break
+    taskMatch = TASK_PATTERN.search(subject)
+    return IntakeRecord(uid, subject,
+                        fields.get("title", DEFAULT_TITLE),
+                        description,
+                        taskMatch.group(1) if taskMatch is not None else "",
+                        fields.get("gbl"),
+                        fields.get("pyxis"))
+
+
+def splitHeaders(rawEmail, start=0, end=None):
+    """
+    Parses the headers of a message (or of the MIME part between 'start' and 'end')
+
+    Returns:
+    ----------
+    headers, bodyStart : tuple
+        Parsed headers and the offset at which the body begins
+    """
+    end = len(rawEmail) if end is None else end
+    headerEnd = HEADER_END_PATTERN.search(rawEmail, start, end)
+    bodyStart = end if headerEnd is None else headerEnd.end()
+    return BytesHeaderParser().parsebytes(rawEmail[start:bodyStart]), bodyStart
+
+
+def findBodyPart(rawEmail, preferredSubtype="html", start=0, end=None):
+    """
+    Walks the MIME tree of a message by offsets, without copying or decoding the parts it skips
+
+    Parameters:
+    ----------
+    rawEmail : bytes
+    preferredSubtype : str
+        The first text part of this subtype is returned, otherwise the first text/plain part
+    start, end : int
+        Offsets of the (sub)part to search
+    ----------
+
+    Returns:
+    ----------
+    (headers, bodyStart, bodyEnd) : tuple
+        None when the message has no text part
+    """
+    end = len(rawEmail) if end is None else end
+    headers, bodyStart = splitHeaders(rawEmail, start, end)
+    if headers.get_content_maintype() == "multipart":
+        boundary = headers.get_param("boundary")
+        if not boundary:
+            return None
+        delimiter = b"--" + boundary.encode("ascii", "replace")
+        fallback = None
+        position = rawEmail.find(delimiter, bodyStart, end)
+        while position != -1:
+            partStart = position + len(delimiter)
+            if rawEmail.startswith(b"--", partStart):
+                # closing delimiter
+                break
+            # the line break after a delimiter belongs to the delimiter, as does the one before the next delimiter
+            partStart = rawEmail.find(b"\n", partStart, end) + 1
+            position = rawEmail.find(delimiter, partStart, end)
+            partEnd = end if position == -1 else position
+            if rawEmail.startswith(b"\r\n", partEnd - 2):
+                partEnd -= 2
+            elif rawEmail.startswith(b"\n", partEnd - 1):
+                partEnd -= 1
+            if partStart == 0:
+                break
+            found = findBodyPart(rawEmail, preferredSubtype, partStart, partEnd)
+            if found is None:
+                continue
+            if found[0].get_content_subtype() == preferredSubtype:
+                return found
+            fallback = fallback or found
+        return fallback
+    if headers.get_content_maintype() == "text" and headers.get_content_subtype() in (preferredSubtype, "plain"):
+        return headers, bodyStart, end
+    return None
+
+
+def findStructurePart(structure, preferredSubtype="html", section=""):
+    """
+    Walks an IMAP BODYSTRUCTURE the way findBodyPart walks a raw message, so the text part can be fetched on its own
+
+    Parameters:
+    ----------
+    structure : list
+        BODYSTRUCTURE parsed into nested lists of str (None for NIL)
+    preferredSubtype : str
+        The first text part of this subtype is returned, otherwise the first text/plain part; attachments are skipped
+    section : str
+        IMAP section number of 'structure', "" for the whole message
+    ----------
+
+    Returns:
+    ----------
+    (section, subtype, transferEncoding, charset, size) : tuple
+        section : str
+            Example: "1.2", for BODY.PEEK[1.2]
+        size : int
+            Size of the encoded part, in bytes
+        None when the message has no text part
+    """
+    if not structure:
+        return None
+    if isinstance(structure[0], list):
+        # multipart: the parts come first, followed by the multipart subtype and its extension data
+        fallback = None
+        for index, part in enumerate(structure):
+            if not isinstance(part, list):
+                break
+            found = findStructurePart(part, preferredSubtype, (section + "." if section else "") + str(index + 1))
+            if found is None:
+                continue
+            if found[1] == preferredSubtype:
+                return found
+            fallback = fallback or found
+        return fallback
+    mainType, subtype = str(structure[0]).lower(), str(structure[1]).lower()
+    if mainType != "text" or subtype not in (preferredSubtype, "plain"):
+        return None
+    # text part: type, subtype, parameters, id, description, encoding, size, lines, md5, disposition, ...
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).lower() == "attachment":
+        return None
+    parameters = structure[2] or []
+    charset = dict((str(name).lower(), value) for name, value in zip(parameters[::2], parameters[1::2])).get("charset")
+    transferEncoding = str(structure[5] or "").lower()
+    return section or "1", subtype, transferEncoding, charset, int(structure[6] or 0)
+
+
+def decodeBody(headers, body):
+    """
+    Decodes the quoted-printable or base64 transfer encoding and then the charset of a text part.
+    Line breaks and tabs are dropped from HTML while it is still bytes, which is much cheaper than on the decoded text.
+    """
+    return decodeText(body, str(headers.get("Content-Transfer-Encoding", "")), headers.get_content_subtype(), headers.get_content_charset())
+
+
+def decodeText(body, transferEncoding, subtype, charset=None, truncated=False):
+    """
+    Decodes a text part given its transfer encoding, subtype and charset, see decodeBody
+
+    Parameters:
+    ----------
+    body : bytes
+    transferEncoding : str
+        Example: "quoted-printable"
+    subtype : str
+        Example: "html"
+    charset : str
+        "utf-8" when None
+    truncated : bool
+        The part was cut by a size-capped fetch: the incomplete encoded unit at the end is dropped
+    ----------
+
+    Returns:
+    ----------
+    text : str
+    """
+    transferEncoding = transferEncoding.strip().lower()
+    if transferEncoding == "quoted-printable":
+        if truncated:
+            body = PARTIAL_QP_ESCAPE.sub(b"", body)
+        body = binascii.a2b_qp(body)
+    elif transferEncoding == "base64":
+        if truncated:
+            body = body.translate(None, b"\r\n\t ")
+            body = body[:len(body) - len(body) % 4]
+        body = binascii.a2b_base64(body)
+    if subtype == "html":
+        body = body.translate(None, b"\r\n\t")
+    charset = charset or "utf-8"
+    try:
+        return body.decode(charset, "replace")
+    except LookupError:
+        # unknown charset - fall back to UTF-8
+        return body.decode("utf-8", "replace")
+
+
+def parseIntakeMessage(rawEmail, uid=None, subject=None):
+    """
+    Parses a raw Intake Request email: finds the HTML body (text/plain as a fallback), decodes its
+    quoted-printable or base64 transfer encoding and charset, then extracts the Work Item Card fields
+
+    Parameters:
+    ----------
+    rawEmail : bytes
+        Full RFC822 message
+    uid : str
+        IMAP UID of the email
+    subject : str
+        Already decoded Subject, read from the message headers when None
+    ----------
+
+    Returns:
+    ----------
+    record : IntakeRecord
+    """
+    if subject is None:
+        headers = splitHeaders(rawEmail)[0]
+        subject = str(make_header(decode_header(headers.get("Subject", ""))))
+    bodyPart = findBodyPart(rawEmail)
+    if bodyPart is None:
+        description = ""
+    else:
+        headers, bodyStart, bodyEnd = bodyPart
+        description = bodyToDescription(decodeBody(headers, rawEmail[bodyStart:bodyEnd]), headers.get_content_subtype())
+    return buildIntakeRecord(subject, description, uid)
+
+
+def parseIntakePart(body, uid, subject, subtype, transferEncoding, charset=None, truncated=False):
+    """
+    Parses the text part of an Intake Request fetched on its own (see findStructurePart), instead of the full message
+
+    Parameters:
+    ----------
+    body : bytes
+        Encoded text part, possibly cut to a size cap
+    uid : str
+    subject : str
+        Decoded Subject
+    subtype, transferEncoding, charset, truncated :
+        See decodeText
+    ----------
+
+    Returns:
+    ----------
+    record : IntakeRecord
+    """
+    description = bodyToDescription(decodeText(body, transferEncoding, subtype, charset, truncated), subtype)
+    return buildIntakeRecord(subject or "", description, uid)
@@ -0,0 +1,100 @@
+"""Reconciliation sweep of the Request/PBI pairs whose parent/child link was never created."""
+# Import the thread pool module
+from concurrent.futures import ThreadPoolExecutor
+
+# Import the vstsclient constants (link type names)
+from vstsclient.constants import LinkTypes
+
+# Import the VSTS REST API helper (paged WIQL queries, workitemsbatch reads, $batch requests)
+from vsts_rest import MAX_BATCH_REQUESTS, CHILD_LINK_TYPE, wiqlQuote, queryWorkItemIDsPaged, readWorkItemsChunked
+
+
+def relatedIDs(workItem, linkType):
+    """
+    Returns the IDs of the work items a work item is related to by relations of type 'linkType'
+    """
+    return set(int(relation["url"].rstrip("/").rsplit("/", 1)[1]) for relation in workItem.get("relations") or []
+               if relation.get("rel") == linkType)
+
+
+def repairParentLinks(restClient, route, days=30, dryRun=False, workers=4):
+    """
+    Reconciliation of the Request/PBI pairs left without their parent/child link (for instance when a run stopped between
+    the creation of the cards and the link):
+    one paged WIQL query finds the Request and PBI items created in the last 'days' days with a TASK Number, their
+    relations are read MAX_WORKITEMS_BATCH items per workitemsbatch call, the items are grouped by TASK in memory, and
+    every missing link is created through $batch calls of up to MAX_BATCH_REQUESTS links.
+    Within a TASK the unlinked PBIs are paired, in creation order, with the Requests that have no child.
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+    days : int
+        Age, in days, of the oldest work items checked
+    dryRun : bool
+        Only reports the missing links
+    workers : int
+        Concurrent VSTS calls
+    ----------
+
+    Returns:
+    ----------
+    summary : dict
+        Number of work items checked, links missing, links created and failed, the TASKs whose PBI has no Request to link to,
+        and the [Request ID, PBI ID, status code] of every link that failed
+    """
+    workItemIDs = queryWorkItemIDsPaged(restClient, route.project,
+                                        " AND [System.WorkItemType] IN (" + wiqlQuote(route.requestType) + ", " + wiqlQuote(route.pbiType) + ")" +
+                                        " AND [GTSKanban.TASK] <> ''" +
+                                        " AND [System.CreatedDate] >= @Today - " + str(int(days)))
+
+    # TASK -> ([(Request ID, has a child)], [(PBI ID, parent IDs)]); only IDs and relation targets are kept, not the descriptions
+    tasks = {}
+    for workItems in readWorkItemsChunked(restClient, workItemIDs, workers, expand="Relations"):
+        for workItem in workItems:
+            fields = workItem.get("fields", {})
+            requests, pbis = tasks.setdefault(str(fields.get("GTSKanban.TASK")), ([], []))
+            if fields.get("System.WorkItemType") == route.requestType:
+                requests.append((workItem["id"], bool(relatedIDs(workItem, CHILD_LINK_TYPE))))
+            else:
+                pbis.append((workItem["id"], relatedIDs(workItem, LinkTypes.PARENT)))
+
+    missingLinks = []
+    unpairedTasks = []
+    for TASK, (requests, pbis) in tasks.items():
+        parents = set()
+        for PBI_WIID, parentIDs in pbis:
+            parents |= parentIDs
+        freeRequests = sorted(REQUEST_WIID for REQUEST_WIID, hasChild in requests if not hasChild and REQUEST_WIID not in parents)
+        unlinkedPBIs = sorted(PBI_WIID for PBI_WIID, parentIDs in pbis if not parentIDs)
+        missingLinks += zip(freeRequests, unlinkedPBIs)
+        if len(unlinkedPBIs) > len(freeRequests):
+            unpairedTasks.append(TASK)
+
+    summary = {"workItems": len(workItemIDs), "tasks": len(tasks), "missing": len(missingLinks), "linked": 0, "failed": 0,
+               "unpairedTasks": sorted(unpairedTasks), "failedLinks": []}
+    print("Link repair of " + route.project + ": " + str(len(workItemIDs)) + " work items, " + str(len(missingLinks)) +
+          " missing links" + (", PBIs without a Request for TASK " + ", ".join(sorted(unpairedTasks)) if unpairedTasks else ""))
+    if dryRun or not missingLinks:
+        return summary
+
+    def linkChunk(pairs):
+        return restClient.batch([restClient.update_workitem_request(PBI_WIID, [{"op": "add", "path": "/relations/-", "value": {
+            "rel": LinkTypes.PARENT,
+            "url": restClient.workitem_url(REQUEST_WIID),
+            "attributes": {"comment": "Parent/Child connection restored by the link repair"}}}]) for REQUEST_WIID, PBI_WIID in pairs])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pairChunks = [missingLinks[i:i + MAX_BATCH_REQUESTS] for i in range(0, len(missingLinks), MAX_BATCH_REQUESTS)]
+        for pairs, responses in zip(pairChunks, executor.map(linkChunk, pairChunks)):
+            for (REQUEST_WIID, PBI_WIID), (code, body) in zip(pairs, responses):
+                if code == 200:
+                    summary["linked"] += 1
+                else:
+                    summary["failed"] += 1
+                    summary["failedLinks"].append([REQUEST_WIID, PBI_WIID, code])
+                    print("Link repair failed for Request " + str(REQUEST_WIID) + " and PBI " + str(PBI_WIID) + ": " + str(code) + " " + str(body)[:500])
+    print("Link repair of " + route.project + ": " + str(summary["linked"]) + " links created, " + str(summary["failed"]) + " failed")
+    return summary
@@ -0,0 +1,92 @@
+"""Streams the messages of an mbox file or a Maildir directory, one message in memory at a time."""
+# Import the OS, memory map and Regular Expression modules
+import os
+import mmap
+import re
+
+
+# Start of a message in an mbox file: a "From " line at the very beginning of the file or after a line break
+MBOX_SEPARATOR = b"\nFrom "
+# ">From " quoting of body lines (mboxo/mboxrd), removed from each message
+MBOX_QUOTED_FROM = re.compile(rb'^>(>*From )', re.M)
+
+
+def iterMbox(path, start=0):
+    """
+    Yields the messages of an mbox file. The file is memory-mapped, so only the message being yielded is copied into memory.
+
+    Parameters:
+    ----------
+    path : str
+    start : int
+        Number of messages to skip, Example: the position of a backfill checkpoint
+    ----------
+
+    Yields:
+    ----------
+    (index, key, rawEmail) : tuple
+        index : int
+            Position of the message in the file
+        key : str
+            Example: "mbox:1048576" (byte offset of the message)
+        rawEmail : bytes
+    """
+    with open(path, "rb") as mboxFile:
+        if os.fstat(mboxFile.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(mboxFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = 0 if mapped[:5] == b"From " else mapped.find(MBOX_SEPARATOR)
+            if position > 0:
+                position += 1
+            index = 0
+            while position != -1:
+                # the "From " line itself is not part of the message
+                bodyStart = mapped.find(b"\n", position) + 1
+                separator = mapped.find(MBOX_SEPARATOR, bodyStart) if bodyStart else -1
+                end = len(mapped) if separator == -1 else separator + 1
+                if index >= start and bodyStart:
+                    yield index, "mbox:" + str(position), MBOX_QUOTED_FROM.sub(rb'\1', mapped[bodyStart:end])
+                index += 1
+                position = -1 if separator == -1 else separator + 1
+        finally:
+            mapped.close()
+
+
+def iterMaildir(path, start=0):
+    """
+    Yields the messages of a Maildir directory ('cur' and 'new'), in file name order - the delivery order of most servers
+
+    Parameters:
+    ----------
+    path : str
+    start : int
+        Number of messages to skip
+    ----------
+
+    Yields:
+    ----------
+    (index, key, rawEmail) : tuple
+        key : str
+            Example: "new/1536272042.M1P2.host"
+    """
+    names = []
+    for folder in ("cur", "new"):
+        folderPath = os.path.join(path, folder)
+        if os.path.isdir(folderPath):
+            names += [folder + "/" + name for name in os.listdir(folderPath) if not name.startswith(".")]
+    names.sort(key=lambda name: name.split("/", 1)[1])
+    for index, name in enumerate(names):
+        if index < start:
+            continue
+        with open(os.path.join(path, name), "rb") as messageFile:
+            yield index, name, messageFile.read()
+
+
+def iterExport(path, start=0):
+    """
+    Yields the messages of an mbox file or a Maildir directory, see iterMbox and iterMaildir
+    """
+    if os.path.isdir(path):
+        return iterMaildir(path, start)
+    return iterMbox(path, start)
@@ -0,0 +1,127 @@
+"""Per-invocation timing spans, call counters and debug logging, emitted as one CloudWatch Embedded Metric Format record."""
+# Import the JSON, time and threading modules
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# Log levels understood by 'logLevel'
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# CloudWatch accepts at most 100 values per metric in one EMF record
+MAX_EMF_VALUES = 100
+
+
+class InvocationMetrics(object):
+    """
+    Collects the metrics of one invocation: the duration of every stage span (several spans per stage are kept,
+    so CloudWatch can compute percentiles) and the number of IMAP commands, VSTS calls and S3 operations.
+    Spans and counters may be recorded from the worker threads.
+
+    Parameters:
+    ----------
+    namespace : str
+        CloudWatch metric namespace
+    logLevel : str
+        Example: "INFO", payloads are only logged at "DEBUG"
+    ----------
+    """
+    def __init__(self, namespace, logLevel="INFO"):
+        self.namespace = namespace
+        self.logLevel = LOG_LEVELS.get(str(logLevel).upper(), LOG_LEVELS["INFO"])
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the metrics of the previous invocation of the warm container
+        """
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.started = time.time()
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Times the enclosed block as one span of 'stage', Example: with metrics.span("fetch"): ...
+        The span is recorded even when the block raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000.0
+            with self.lock:
+                self.spans.setdefault(stage, []).append(elapsed)
+
+    def count(self, name, amount=1):
+        """
+        Adds 'amount' to a counter, Example: metrics.count("IMAPCommands")
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def debug(self, message):
+        """
+        Prints a message only when the log level is DEBUG - used for payloads and per-item details
+        """
+        if self.logLevel <= LOG_LEVELS["DEBUG"]:
+            print(message)
+
+    def embeddedMetricRecord(self, dimensions):
+        """
+        Builds the CloudWatch Embedded Metric Format record of the invocation
+
+        Parameters:
+        ----------
+        dimensions : dict
+            Example: {"FunctionName": "VSTSWorkItemGenerator"}
+        ----------
+
+        Returns:
+        ----------
+        record : dict
+        """
+        with self.lock:
+            spans = dict((stage, list(durations)) for stage, durations in self.spans.items())
+            counters = dict(self.counters)
+        record = dict(dimensions)
+        definitions = []
+        for stage, durations in sorted(spans.items()):
+            name = stage + "Time"
+            if len(durations) > MAX_EMF_VALUES:
+                # keeps the total: the overflow is folded into the last value
+                durations = durations[:MAX_EMF_VALUES - 1] + [sum(durations[MAX_EMF_VALUES - 1:])]
+            record[name] = [round(duration, 3) for duration in durations] if len(durations) > 1 else round(durations[0], 3)
+            definitions.append({"Name": name, "Unit": "Milliseconds"})
+        record["invocationTime"] = round((time.time() - self.started) * 1000.0, 3)
+        definitions.append({"Name": "invocationTime", "Unit": "Milliseconds"})
+        for name, value in sorted(counters.items()):
+            record[name] = value
+            definitions.append({"Name": name, "Unit": "Count"})
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{"Namespace": self.namespace, "Dimensions": [sorted(dimensions)], "Metrics": definitions}],
+        }
+        return record
+
+    def emit(self, dimensions):
+        """
+        Writes the Embedded Metric Format record as a single log line; CloudWatch turns it into metrics
+        """
+        print(json.dumps(self.embeddedMetricRecord(dimensions), sort_keys=True))
+
+
+class IMAPCommandCounter(object):
+    """
+    Mixin for the imaplib IMAP4 classes that counts every command sent to the server (UID commands included)
+    in 'metrics', the InvocationMetrics of the warm container
+    """
+    metrics = None
+
+    def _command(self, name, *args):
+        if self.metrics is not None:
+            self.metrics.count("IMAPCommands")
+        return super(IMAPCommandCounter, self)._command(name, *args)
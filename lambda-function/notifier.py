@@ -0,0 +1,226 @@
+"""Collects the events of an invocation (created cards, failures, alerts) and mails them as one digest per recipient."""
+# Import the JSON, time and threading modules
+import json
+import time
+import threading
+
+
+# Event kinds, in the order of the digest sections
+TOKEN_EXPIRY = "tokenExpiry"
+RUN_FAILED = "runFailed"
+CREATION_FAILED = "creationFailed"
+LINK_FAILED = "linkFailed"
+PARSE_FAILED = "parseFailed"
+CREATED = "created"
+EVENT_KINDS = (TOKEN_EXPIRY, RUN_FAILED, CREATION_FAILED, LINK_FAILED, PARSE_FAILED, CREATED)
+
+# A digest holding one of these is sent right away; a digest of created cards only waits for 'minDigestSeconds'
+ALERT_KINDS = (TOKEN_EXPIRY, RUN_FAILED, CREATION_FAILED, LINK_FAILED, PARSE_FAILED)
+
+SECTION_TITLES = {
+    TOKEN_EXPIRY: "VSTS account token",
+    RUN_FAILED: "Failed runs",
+    CREATION_FAILED: "Work items not created",
+    LINK_FAILED: "Parent/child links not created",
+    PARSE_FAILED: "Emails without a TASK Number or Request Name",
+    CREATED: "Work items created",
+}
+
+# Subject line summary of each section, Example: "2 link failures, 14 cards created"
+SUBJECT_LABELS = {
+    TOKEN_EXPIRY: "token expiry alert",
+    RUN_FAILED: "failed route runs",
+    CREATION_FAILED: "creation failures",
+    LINK_FAILED: "link failures",
+    PARSE_FAILED: "unparsed emails",
+    CREATED: "cards created",
+}
+
+
+def loadRecipients(configText, defaultRecipient):
+    """
+    Builds the recipient list from its JSON configuration, an object mapping each address to the event kinds it receives
+    ("*" for all of them), such as
+        {"vsts-admins@example.com": ["tokenExpiry", "runFailed"], "architecture@example.com": "*"}
+    The digests of created cards are opt-in: only a recipient configured with "*" or "created" receives them.
+
+    Parameters:
+    ----------
+    configText : str
+        JSON recipients, None or empty for 'defaultRecipient' receiving the alerts only (ALERT_KINDS)
+    defaultRecipient : str
+    ----------
+
+    Returns:
+    ----------
+    recipients : list of (address, kinds) tuples
+    """
+    if not configText or not configText.strip():
+        return [(defaultRecipient, ALERT_KINDS)]
+    recipients = []
+    for address, kinds in sorted(json.loads(configText).items()):
+        kinds = EVENT_KINDS if kinds == "*" else tuple(kinds)
+        unknownKinds = set(kinds) - set(EVENT_KINDS)
+        if unknownKinds:
+            raise ValueError("Unknown event kinds " + str(sorted(unknownKinds)) + " for recipient " + address)
+        recipients.append((address, kinds))
+    return recipients
+
+
+class DigestNotifier(object):
+    """
+    Notification events of one invocation, delivered at its end as one digest per recipient.
+
+    Events may be recorded from the worker threads. An alert recorded with an 'alertKey' is throttled: it is dropped when
+    an alert with the same key was delivered less than its repeat period ago (kept in the run state), so a failure that
+    recurs on every run is reported once a day rather than every few minutes.
+    A recipient's digest is sent right away when it holds an alert; a digest of created cards only is sent at most every
+    'minDigestSeconds'. The events of a digest that is not sent (too early, over 'maxDigestsPerRun' or failed) are kept
+    in the run state, at most 'maxBacklog' per recipient, and sent with the next digest of that recipient.
+
+    Parameters:
+    ----------
+    recipients : list of (address, kinds) tuples
+        See loadRecipients
+    repeatSeconds : float
+        Default repeat period of the throttled alerts
+    minDigestSeconds : float
+    maxDigestsPerRun : int
+    maxBacklog : int
+    maxLines : int
+        Events listed per digest section, the others are only counted
+    ----------
+    """
+    def __init__(self, recipients, repeatSeconds=86400, minDigestSeconds=3600, maxDigestsPerRun=20, maxBacklog=500, maxLines=100):
+        self.recipients = recipients
+        self.repeatSeconds = repeatSeconds
+        self.minDigestSeconds = minDigestSeconds
+        self.maxDigestsPerRun = maxDigestsPerRun
+        self.maxBacklog = maxBacklog
+        self.maxLines = maxLines
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the events of the previous invocation of the warm container
+        """
+        with self.lock:
+            self.events = []
+
+    def record(self, kind, text, alertKey=None, repeatSeconds=None):
+        """
+        Records an event, Example: notifier.record(LINK_FAILED, "TASK0001234: Request 101, PBI 102", "link:102")
+
+        Parameters:
+        ----------
+        kind : str
+            One of EVENT_KINDS
+        text : str
+            One line of the digest
+        alertKey : str
+            Throttles the repeats of the alert, None for an event that is always reported
+        repeatSeconds : float
+            Repeat period of this alert, 'repeatSeconds' of the notifier when None
+        ----------
+        """
+        with self.lock:
+            self.events.append((kind, text, alertKey, self.repeatSeconds if repeatSeconds is None else repeatSeconds, time.time()))
+
+    def pendingEvents(self):
+        with self.lock:
+            return len(self.events)
+
+    def render(self, entries):
+        """
+        Renders the digest of a recipient
+
+        Parameters:
+        ----------
+        entries : list of [kind, text, at] lists
+        ----------
+
+        Returns:
+        ----------
+        subject, body : tuple
+        """
+        sections = []
+        summary = []
+        for kind in EVENT_KINDS:
+            lines = [time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(at)) + "  " + text for entryKind, text, at in entries if entryKind == kind]
+            if not lines:
+                continue
+            count = len(lines)
+            summary.append(str(count) + " " + SUBJECT_LABELS[kind])
+            if count > self.maxLines:
+                lines = lines[:self.maxLines] + ["... and " + str(count - self.maxLines) + " more"]
+            sections.append(SECTION_TITLES[kind] + " (" + str(count) + ")\n" + "\n".join(" - " + line for line in lines))
+        subject = "VSTS Work Item Generator: " + ", ".join(summary)
+        return subject, "\n\n".join(sections) + "\n"
+
+    def deliver(self, state, send):
+        """
+        Sends the due digests and keeps the throttling and the held-back events in the run state
+
+        Parameters:
+        ----------
+        state : RunStateStore
+        send : function
+            Takes a list of (recipient, subject, body) tuples and sends them over one SMTP session,
+            returns the recipients that were sent to
+        ----------
+
+        Returns:
+        ----------
+        sent, throttled : tuple
+            Number of digests sent and of alerts dropped as repeats
+        """
+        with self.lock:
+            events, self.events = self.events, []
+        now = time.time()
+        alertsSent = state.get("notifierAlertsSent") or {}
+        fresh = []
+        deliveredKeys = {}
+        throttled = 0
+        for kind, text, alertKey, repeatSeconds, at in events:
+            if alertKey is not None:
+                if alertKey in deliveredKeys or now - alertsSent.get(alertKey, 0) < repeatSeconds:
+                    throttled += 1
+                    continue
+                deliveredKeys[alertKey] = now
+            fresh.append([kind, text, at])
+        backlog = state.get("notifierBacklog") or {}
+        digestsSent = state.get("notifierDigestsSent") or {}
+
+        messages = []
+        newEntries = {}
+        for address, kinds in self.recipients:
+            newEntries[address] = [entry for entry in fresh if entry[0] in kinds]
+            entries = backlog.get(address, []) + newEntries[address]
+            if not entries:
+                continue
+            urgent = any(entry[0] in ALERT_KINDS for entry in entries)
+            if not urgent and now - digestsSent.get(address, 0) < self.minDigestSeconds:
+                continue
+            if len(messages) >= self.maxDigestsPerRun:
+                continue
+            subject, body = self.render(entries)
+            messages.append((address, subject, body))
+
+        sentTo = set()
+        if messages:
+            try:
+                sentTo = set(send(messages))
+            except Exception as error:
+                print("Digest delivery failed, the events are kept for the next run: " + repr(error))
+
+        # the alerts are throttled whether or not their digest went out - an unsent digest stays in the backlog
+        if deliveredKeys:
+            state.setMaxEntries("notifierAlertsSent", deliveredKeys)
+        if sentTo:
+            state.setMaxEntries("notifierDigestsSent", dict((address, now) for address in sentTo))
+            state.removeEntries("notifierBacklog", dict((address, backlog[address]) for address in sentTo if backlog.get(address)))
+        heldBack = dict((address, entries) for address, entries in newEntries.items() if entries and address not in sentTo)
+        if heldBack:
+            state.appendEntries("notifierBacklog", heldBack, self.maxBacklog)
+        return len(sentTo), throttled
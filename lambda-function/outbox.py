@@ -0,0 +1,300 @@
+"""Durable outbox of parsed Intake Requests: a SQLite database kept in S3, between the IMAP ingestion and the VSTS creation stages."""
+# Import the SQLite, OS, time and threading modules
+import sqlite3
+import os
+import time
+import threading
+
+# Import the hashing and compression modules
+import hashlib
+import zlib
+
+# Import the AWS error module
+from botocore.exceptions import ClientError
+
+# Import the Intake Request record
+from intake_parser import IntakeRecord
+
+
+# Outbox record states
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY,
+    route TEXT NOT NULL,
+    uid TEXT,
+    task TEXT,
+    subject TEXT,
+    title TEXT,
+    description BLOB,
+    gbl TEXT,
+    pyxis TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    ingestedAt REAL NOT NULL,
+    doneAt REAL
+);
+CREATE INDEX IF NOT EXISTS recordsByStatus ON records (route, status, ingestedAt);
+"""
+
+COLUMNS = "key, route, uid, task, subject, title, description, gbl, pyxis, status, attempts, ingestedAt, doneAt"
+
+
+def outboxKey(routeName, record):
+    """
+    Returns the outbox key of an Intake Request: the same email ingested twice (Example: archived by a later run
+    after a crash) maps to the same record, while a follow-up email with new content gets a record of its own
+    """
+    digest = hashlib.sha1((record.subject + "\n" + record.description).encode("utf-8", "replace")).hexdigest()
+    return routeName + ":" + digest
+
+
+class OutboxStore(object):
+    """
+    Parsed Intake Requests waiting for their work items, in a SQLite database.
+
+    The ingestion stage adds the records of the emails it read and writes the database to S3 before the emails are
+    archived, so an email leaves the INBOX only once its record is durable. The drain stage reads the pending records,
+    creates their work items in large batches and marks them done, without any IMAP access; a record that keeps failing
+    is set aside as failed after 'maxAttempts' drains. Either stage can run on its own schedule.
+
+    The database is read with an ETag-conditional GET against the copy kept in /tmp and written with an If-Match-conditional
+    PUT. When the other stage wrote in between, its database is merged into this one - records are only ever added, and
+    'done' and the attempt count only ever increase - before the PUT is retried.
+    Without an S3 client the store is a plain local database, Example: a local replay of the drain stage.
+
+    Parameters:
+    ----------
+    s3Client : object
+        boto3 S3 client, None for a local database
+    bucketName : str
+    key : str
+        Path of the database object, Example: "Outbox.sqlite"
+    path : str
+        Local database file, Example: "/tmp/Outbox.sqlite"
+    maxAttempts : int
+    ----------
+    """
+    def __init__(self, s3Client, bucketName, key, path, maxAttempts=10):
+        self.s3Client = s3Client
+        self.bucketName = bucketName
+        self.key = key
+        self.path = path
+        self.maxAttempts = maxAttempts
+        self.etag = None
+        self.connection = None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def _open(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _readEtag(self):
+        try:
+            with open(self.path + ".etag") as etagFile:
+                return etagFile.read().strip() or None
+        except IOError:
+            return None
+
+    def _writeEtag(self):
+        with open(self.path + ".etag", "w") as etagFile:
+            etagFile.write(self.etag or "")
+
+    def _download(self, targetPath, cachedEtag=None):
+        """
+        Downloads the database object to 'targetPath' unless 'cachedEtag' is still current
+
+        Returns:
+        ----------
+        etag : str
+            None when the object does not exist yet, 'cachedEtag' when it did not change
+        """
+        request = {"Bucket": self.bucketName, "Key": self.key}
+        if cachedEtag:
+            request["IfNoneMatch"] = cachedEtag
+        try:
+            response = self.s3Client.get_object(**request)
+        except ClientError as error:
+            code = str(error.response.get('Error', {}).get('Code', ''))
+            if code in ('304', 'NotModified'):
+                return cachedEtag
+            if code in ('NoSuchKey', '404'):
+                return None
+            raise
+        temporaryPath = targetPath + ".download"
+        with open(temporaryPath, "wb") as databaseFile:
+            for chunk in iter(lambda: response['Body'].read(1048576), b""):
+                databaseFile.write(chunk)
+        os.replace(temporaryPath, targetPath)
+        return response['ETag']
+
+    def load(self):
+        """
+        Reads the current database once for this invocation; a warm container whose copy is current downloads nothing
+        """
+        with self.lock:
+            if self.s3Client is None:
+                self._open()
+                return
+            self._close()
+            cachedEtag = self._readEtag() if os.path.exists(self.path) else None
+            self.etag = self._download(self.path, cachedEtag)
+            if self.etag is None and os.path.exists(self.path):
+                # the object was deleted: start over from an empty outbox
+                os.remove(self.path)
+            self._writeEtag()
+            self._open()
+            self.dirty = False
+
+    def add(self, routeName, records):
+        """
+        Adds the records of a route; a record already in the outbox (same key) is left as it is
+
+        Returns:
+        ----------
+        added : int
+        """
+        now = time.time()
+        rows = [(outboxKey(routeName, record), routeName, record.uid, record.task, record.subject, record.title,
+                 zlib.compress(record.description.encode("utf-8")), record.gbl, record.pyxis, now) for record in records]
+        with self.lock:
+            connection = self._open()
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO records (key, route, uid, task, subject, title, description, gbl, pyxis, ingestedAt)"
+                                   " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.commit()
+            added = connection.total_changes - before
+            self.dirty = self.dirty or added > 0
+        return added
+
+    def pending(self, routeName, limit):
+        """
+        Returns the oldest pending records of a route, in ingestion order; the 'uid' of each record is its outbox key
+
+        Returns:
+        ----------
+        records : list of IntakeRecord
+        """
+        with self.lock:
+            rows = self._open().execute("SELECT key, subject, title, description, task, gbl, pyxis FROM records"
+                                        " WHERE route = ? AND status = ? ORDER BY ingestedAt, rowid LIMIT ?",
+                                        (routeName, PENDING, limit)).fetchall()
+        return [IntakeRecord(key, subject, title, zlib.decompress(description).decode("utf-8"), task, gbl, pyxis)
+                for key, subject, title, description, task, gbl, pyxis in rows]
+
+    def markDone(self, keys):
+        """
+        Marks records done once their work items exist
+        """
+        with self.lock:
+            connection = self._open()
+            connection.executemany("UPDATE records SET status = ?, doneAt = ? WHERE key = ?", [(DONE, time.time(), key) for key in keys])
+            connection.commit()
+            self.dirty = self.dirty or bool(keys)
+
+    def markAttempted(self, keys):
+        """
+        Counts a failed drain of records; a record that reached 'maxAttempts' is set aside as failed
+
+        Returns:
+        ----------
+        failedKeys : list of str
+            Records set aside by this call
+        """
+        with self.lock:
+            connection = self._open()
+            connection.executemany("UPDATE records SET attempts = attempts + 1 WHERE key = ? AND status = ?", [(key, PENDING) for key in keys])
+            failedKeys = [key for key, in connection.execute(
+                "SELECT key FROM records WHERE status = ? AND attempts >= ?", (PENDING, self.maxAttempts)).fetchall()]
+            connection.executemany("UPDATE records SET status = ? WHERE key = ?", [(FAILED, key) for key in failedKeys])
+            connection.commit()
+            self.dirty = self.dirty or bool(keys)
+        return failedKeys
+
+    def purge(self, retentionSeconds):
+        """
+        Deletes the records done more than 'retentionSeconds' ago, so the database stays small
+        """
+        with self.lock:
+            connection = self._open()
+            deleted = connection.execute("DELETE FROM records WHERE status = ? AND doneAt < ?", (DONE, time.time() - retentionSeconds)).rowcount
+            connection.commit()
+            self.dirty = self.dirty or deleted > 0
+        return deleted
+
+    def counts(self):
+        """
+        Returns the number of records per route and status, Example: {("default", "pending"): 3}
+        """
+        with self.lock:
+            rows = self._open().execute("SELECT route, status, COUNT(*) FROM records GROUP BY route, status").fetchall()
+        return dict(((route, status), count) for route, status, count in rows)
+
+    def _merge(self, otherPath):
+        """
+        Merges another copy of the database into this one: new records are added, and a record done or set aside
+        there is done or set aside here
+        """
+        connection = self._open()
+        connection.execute("ATTACH DATABASE ? AS other", (otherPath,))
+        try:
+            connection.execute("INSERT OR IGNORE INTO records (" + COLUMNS + ") SELECT " + COLUMNS + " FROM other.records")
+            connection.execute("UPDATE records SET"
+                               " status = (SELECT status FROM other.records WHERE other.records.key = records.key),"
+                               " doneAt = (SELECT doneAt FROM other.records WHERE other.records.key = records.key)"
+                               " WHERE status = ? AND key IN (SELECT key FROM other.records WHERE status <> ?)", (PENDING, PENDING))
+            connection.execute("UPDATE records SET attempts = MAX(attempts, (SELECT attempts FROM other.records WHERE other.records.key = records.key))"
+                               " WHERE key IN (SELECT key FROM other.records)")
+            connection.commit()
+        finally:
+            connection.execute("DETACH DATABASE other")
+
+    def flush(self, maxAttempts=5):
+        """
+        Writes the database to S3 with a conditional PUT, merging the other stage's changes on a conflicting write
+
+        Returns:
+        ----------
+        written : bool
+            False when there was nothing to write
+        """
+        with self.lock:
+            if not self.dirty or self.s3Client is None:
+                return False
+            for attempt in range(maxAttempts):
+                self._open().commit()
+                with open(self.path, "rb") as databaseFile:
+                    request = {"Bucket": self.bucketName, "Key": self.key, "Body": databaseFile.read(),
+                               "ContentType": "application/vnd.sqlite3"}
+                if self.etag is None:
+                    request["IfNoneMatch"] = "*"
+                else:
+                    request["IfMatch"] = self.etag
+                try:
+                    response = self.s3Client.put_object(**request)
+                except ClientError as error:
+                    if str(error.response.get('Error', {}).get('Code', '')) not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+                        raise
+                    print("Outbox changed by another invocation, merging (attempt " + str(attempt + 1) + ")")
+                    otherPath = self.path + ".other"
+                    self.etag = self._download(otherPath)
+                    if self.etag is not None:
+                        self._merge(otherPath)
+                        os.remove(otherPath)
+                    continue
+                self.etag = response['ETag']
+                self._writeEtag()
+                self.dirty = False
+                return True
+            raise RuntimeError("Outbox " + self.key + " could not be written after " + str(maxAttempts) + " attempts")
@@ -0,0 +1,171 @@
+"""On-demand cProfile and tracemalloc profiling of a single invocation, written where it can be analysed offline."""
+# Import the profiling modules
+import cProfile
+import pstats
+import tracemalloc
+
+# Import the serialization, string, time and threading modules
+import io
+import marshal
+import sys
+import time
+import threading
+import functools
+
+
+# Profiling modes: "cpu" runs cProfile, "memory" runs tracemalloc
+PROFILE_MODES = ("cpu", "memory")
+
+
+def profileModes(event, defaultModes=""):
+    """
+    Returns the profiling modes of an invocation: the "profile" field of the event, else 'defaultModes'.
+    Both take True or "all" for every mode, a comma-separated string such as "cpu,memory", or a list of modes.
+
+    Parameters:
+    ----------
+    event : dict
+        Example: {"profile": "cpu"}
+    defaultModes : str
+        Value of the 'profileInvocations' Environment Variable, "" to profile only on demand
+    ----------
+
+    Returns:
+    ----------
+    modes : tuple of str
+        Empty when the invocation is not profiled
+    """
+    value = event.get("profile", defaultModes) if isinstance(event, dict) else defaultModes
+    if value is True or value == "all":
+        return PROFILE_MODES
+    if not value:
+        return ()
+    if isinstance(value, str):
+        value = value.split(",")
+    return tuple(mode for mode in PROFILE_MODES if mode in [str(item).strip().lower() for item in value])
+
+
+class InvocationProfiler(object):
+    """
+    Runs a handler under cProfile ("cpu") and/or tracemalloc ("memory") and writes, under the invocation ID:
+        cpu.prof     pstats data, Example: snakeviz cpu.prof, or pstats.Stats("cpu.prof")
+        cpu.txt      the 'topFunctions' functions by cumulative time
+        memory.txt   the 'topAllocations' allocation sites by size, and the peak traced memory
+
+    cProfile only follows the thread that enables it before Python 3.12, so every thread started during the invocation
+    (the intake pipeline workers) gets a profiler of its own and their statistics are merged into cpu.prof.
+    A failure to write the results is logged and never fails the invocation.
+
+    Parameters:
+    ----------
+    write : function
+        Stores one result, write(invocationID, name, data) -> location, Example: an S3 put_object
+    topFunctions : int
+    topAllocations : int
+    frames : int
+        Stack frames kept per allocation by tracemalloc
+    ----------
+    """
+    def __init__(self, write, topFunctions=50, topAllocations=50, frames=10):
+        self.write = write
+        self.topFunctions = topFunctions
+        self.topAllocations = topAllocations
+        self.frames = frames
+
+    def profiled(self, defaultModes=lambda: ""):
+        """
+        Decorator of a Lambda handler (event, context): the handler runs as is unless profileModes() asks for profiling
+
+        Parameters:
+        ----------
+        defaultModes : function
+            Returns the modes of the invocations without a "profile" event field
+        ----------
+        """
+        def decorator(handler):
+            @functools.wraps(handler)
+            def wrapper(event, context):
+                modes = profileModes(event, defaultModes())
+                if not modes:
+                    return handler(event, context)
+                invocationID = getattr(context, "aws_request_id", None) or time.strftime("%Y%m%dT%H%M%S")
+                return self.run(modes, invocationID, handler, event, context)
+            return wrapper
+        return decorator
+
+    def run(self, modes, invocationID, function, *args):
+        """
+        Calls function(*args) with the given profiling modes and writes the results, also when the function raises
+        """
+        threadProfilers = []
+        profiler = None
+        startedTracing = False
+        if "memory" in modes and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            startedTracing = True
+        if "cpu" in modes:
+            profiler = cProfile.Profile()
+            if sys.version_info < (3, 12):
+                def startThreadProfiler(frame, event, arg):
+                    # first profiling event of a new thread: replaces this hook with a profiler of the thread
+                    threadProfiler = cProfile.Profile()
+                    threadProfilers.append(threadProfiler)
+                    threadProfiler.enable()
+                threading.setprofile(startThreadProfiler)
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            seconds = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                threading.setprofile(None)
+            results = {}
+            try:
+                # the memory snapshot is taken before the CPU statistics are built, so it does not list them
+                if "memory" in modes:
+                    results.update(self.memoryResults())
+                if profiler is not None:
+                    results.update(self.cpuResults(profiler, threadProfilers))
+            except Exception as error:
+                print("Profile of invocation " + invocationID + " could not be built: " + repr(error))
+            finally:
+                if startedTracing:
+                    tracemalloc.stop()
+            locations = []
+            for name in sorted(results):
+                try:
+                    locations.append(self.write(invocationID, name, results[name]))
+                except Exception as error:
+                    print("Profile " + name + " of invocation " + invocationID + " could not be written: " + repr(error))
+            print("Profiled invocation " + invocationID + " (" + ",".join(modes) + ", " + str(round(seconds, 3)) + " s): " + ", ".join(str(location) for location in locations))
+
+    def cpuResults(self, profiler, threadProfilers):
+        stats = pstats.Stats(profiler)
+        for threadProfiler in threadProfilers:
+            threadProfiler.create_stats()
+            if threadProfiler.stats:
+                stats.add(threadProfiler)
+        report = io.StringIO()
+        stats.stream = report
+        report.write(str(len(threadProfilers)) + " worker thread(s) merged\n")
+        stats.sort_stats("cumulative").print_stats(self.topFunctions)
+        return {"cpu.prof": marshal.dumps(stats.stats), "cpu.txt": report.getvalue().encode("utf-8")}
+
+    def memoryResults(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Traced memory: current " + str(round(current / 1048576.0, 2)) + " MiB, peak " + str(round(peak / 1048576.0, 2)) + " MiB", "",
+                 "Top " + str(self.topAllocations) + " allocation sites (still allocated at the end of the invocation):"]
+        for statistic in snapshot.statistics("lineno")[:self.topAllocations]:
+            lines.append(str(statistic))
+        lines += ["", "Tracebacks of the 10 largest sites:"]
+        for statistic in snapshot.statistics("traceback")[:10]:
+            lines.append(str(statistic.count) + " blocks, " + str(round(statistic.size / 1024.0, 1)) + " KiB")
+            lines += ["    " + line for line in statistic.traceback.format()]
+        return {"memory.txt": ("\n".join(lines) + "\n").encode("utf-8")}
@@ -0,0 +1,193 @@
+"""Routing table of the VSTS Work Item Generator: which mailbox, sender and Subject feed which VSTS project."""
+# Import the JSON and Regular Expression modules
+import json
+import re
+
+# Import the email header decoding module
+from email.header import decode_header, make_header
+
+
+class Route(object):
+    """
+    One mailbox -> VSTS project route
+
+    Attributes:
+    ----------
+    name : str
+        Unique name, used in the IMAP connection key and the default run state object name
+    mailbox : str
+        Example: "INBOX"
+    sender : str
+        Address the Intake Requests are sent from
+    subjectPattern : object
+        Compiled pattern an Intake Request Subject must match, Example: "^TASK"
+    project : str
+        VSTS project name
+    areaPath : str
+        Example: "GTS Architecture\\Architecture"
+    requestType : str
+        Work item type of the parent card
+    pbiType : str
+        Work item type of the child card
+    archiveMailbox : str
+        Mailbox the processed emails are moved to
+    stateKey : str
+        S3 key of the route's run state object
+    errorMailbox : str
+        Mailbox the emails that keep failing are moved to, None to leave them in the mailbox past the UID watermark
+    ----------
+    """
+    __slots__ = ("name", "mailbox", "sender", "subjectPattern", "project", "areaPath", "requestType", "pbiType",
+                 "archiveMailbox", "stateKey", "errorMailbox")
+
+    def __init__(self, name, mailbox, sender, subjectPattern, project, areaPath, requestType, pbiType, archiveMailbox, stateKey,
+                 errorMailbox=None):
+        self.name = name
+        self.mailbox = mailbox
+        self.sender = sender
+        self.subjectPattern = re.compile(subjectPattern)
+        self.project = project
+        self.areaPath = areaPath
+        self.requestType = requestType
+        self.pbiType = pbiType
+        self.archiveMailbox = archiveMailbox
+        self.stateKey = stateKey
+        self.errorMailbox = errorMailbox or None
+
+    def isIntakeSubject(self, subject):
+        """
+        Returns True when an email with this Subject is an Intake Request of the route
+        """
+        return self.subjectPattern.search(subject or "") is not None
+
+    def __repr__(self):
+        return "Route(" + self.name + ": " + self.mailbox + " -> " + self.project + ")"
+
+
+def loadRoutes(configText, defaults):
+    """
+    Builds the routing table from its JSON configuration, a list of objects such as
+        [{"name": "architecture", "mailbox": "INBOX", "sender": "servicenow@example.com", "subjectPattern": "^TASK",
+          "project": "Architecture", "areaPath": "GTS Architecture\\\\Architecture",
+          "requestType": "Request", "pbiType": "Product Backlog Item", "archiveMailbox": "Archive/ServiceCafe"}]
+    Every key but "name" may be left out and is then taken from 'defaults', except "stateKey",
+    which defaults to "RunState-<name>.json" so that every route keeps its own watermark and state.
+
+    Parameters:
+    ----------
+    configText : str
+        JSON routing table, None or empty for the single default route
+    defaults : dict
+        Route attributes of the single-route deployment, including "name" and "stateKey"
+    ----------
+
+    Returns:
+    ----------
+    routes : list of Route
+    """
+    if not configText or not configText.strip():
+        return [Route(**defaults)]
+    entries = json.loads(configText)
+    if isinstance(entries, dict):
+        entries = entries.get("routes", [])
+    if not entries:
+        raise ValueError("The routing table has no routes")
+    routes = []
+    for entry in entries:
+        if "name" not in entry:
+            raise ValueError("Every route needs a name: " + json.dumps(entry))
+        unknownKeys = set(entry) - set(Route.__slots__)
+        if unknownKeys:
+            raise ValueError("Unknown route keys " + str(sorted(unknownKeys)) + " in route " + str(entry["name"]))
+        attributes = dict(defaults)
+        attributes["stateKey"] = "RunState-" + re.sub(r'[^A-Za-z0-9_.-]', '_', str(entry["name"])) + ".json"
+        attributes.update(entry)
+        routes.append(Route(**attributes))
+    names = [route.name for route in routes]
+    if len(set(names)) != len(names):
+        raise ValueError("Route names must be unique: " + str(names))
+    stateKeys = [route.stateKey for route in routes]
+    if len(set(stateKeys)) != len(stateKeys):
+        raise ValueError("Routes must not share a run state object: " + str(stateKeys))
+    return routes
+
+
+class RouteTable(object):
+    """
+    Routing table of a warm container: read on first use and kept, with a run state store per route, also kept
+
+    Parameters:
+    ----------
+    loadConfig : function
+        Returns the JSON routing table, None or empty for the single default route (see loadRoutes)
+    defaults : dict
+        Route attributes of the single-route deployment, see loadRoutes
+    newStateStore : function
+        Takes the 'stateKey' of a route and returns its RunStateStore
+    ----------
+    """
+    def __init__(self, loadConfig, defaults, newStateStore):
+        self.loadConfig = loadConfig
+        self.defaults = defaults
+        self.newStateStore = newStateStore
+        # list of Route once read, None before
+        self.routes = None
+        # stateKey -> RunStateStore
+        self.stateStores = {}
+        # optional function called with the routes once they are read, used for logging
+        self.onLoad = None
+
+    def getRoutes(self):
+        """
+        Returns the routes, reading the routing table on the first call
+
+        Returns:
+        ----------
+        routes : list of Route
+        """
+        if self.routes is None:
+            self.routes = loadRoutes(self.loadConfig(), self.defaults)
+            if self.onLoad is not None:
+                self.onLoad(self.routes)
+        return self.routes
+
+    def find(self, routeName=None):
+        """
+        Returns the route named 'routeName', the first route of the routing table when None
+        """
+        routes = self.getRoutes()
+        matching = [route for route in routes if routeName is None or route.name == routeName]
+        if not matching:
+            raise ValueError("Unknown route " + str(routeName) + ", configured routes: " + ", ".join(route.name for route in routes))
+        return matching[0]
+
+    def match(self, headers):
+        """
+        Returns the route whose sender and Subject pattern an email matches, None when it is not an Intake Request of any route
+
+        Parameters:
+        ----------
+        headers : object
+            Parsed headers of the email, see intake_parser.splitHeaders
+        ----------
+
+        Returns:
+        ----------
+        route, subject : tuple
+            subject : str
+                Decoded Subject
+        """
+        subject = str(make_header(decode_header(headers.get("Subject", ""))))
+        sender = str(headers.get("From", "")).lower()
+        for route in self.getRoutes():
+            if route.sender.lower() in sender and route.isIntakeSubject(subject):
+                return route, subject
+        return None, subject
+
+    def stateStore(self, route):
+        """
+        Returns the run state store of a route, created on first use
+        """
+        if route.stateKey not in self.stateStores:
+            self.stateStores[route.stateKey] = self.newStateStore(route.stateKey)
+        return self.stateStores[route.stateKey]
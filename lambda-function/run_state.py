@@ -0,0 +1,405 @@
+"""Run state of the VSTS Work Item Generator, kept as one versioned JSON document in S3 and cached in /tmp between warm invocations."""
+# Import the JSON and OS modules
+import json
+import os
+import copy
+
+# Import the hashing, compression and encoding modules used by the Bloom filter
+import math
+import zlib
+import hashlib
+import uuid
+from base64 import b64encode, b64decode
+
+# Import the AWS error module
+from botocore.exceptions import ClientError
+
+
+# Version of the JSON state document layout
+STATE_VERSION = 1
+
+
+def s3ErrorCode(error):
+    """
+    Returns the error code of a botocore ClientError, Example: 'NoSuchKey'
+    """
+    return str(error.response.get('Error', {}).get('Code', ''))
+
+
+def mergeWatermark(current, value):
+    """
+    Merges two IMAP UID watermarks {"uidValidity": int, "lastUID": int}:
+    the highest UID wins when both refer to the same UIDVALIDITY, otherwise the new watermark replaces the old one
+    """
+    if current and value and current.get("uidValidity") == value.get("uidValidity"):
+        return {"uidValidity": value["uidValidity"], "lastUID": max(current.get("lastUID", 0), value.get("lastUID", 0))}
+    return value
+
+
+class RunStateStore(object):
+    """
+    All run state in one JSON object in S3.
+
+    The object is read once per invocation with an ETag-conditional GET against the copy cached in /tmp, so a warm
+    container that already holds the latest version downloads nothing. Changes are buffered in memory as operations
+    and written once by flush() with an If-Match-conditional PUT; when another invocation wrote in between, the newer
+    document is re-read and the buffered operations are replayed on top of it, so overlapping invocations never lose updates.
+
+    Parameters:
+    ----------
+    s3Client : object
+        boto3 S3 client
+    bucketName : str
+        AWS S3 Storage Bucket Name
+    key : str
+        Path to reach the JSON object
+    cachePath : str
+        Path of the warm-container copy, Example: "/tmp/RunState.json"
+    ----------
+    """
+    def __init__(self, s3Client, bucketName, key, cachePath):
+        self.s3Client = s3Client
+        self.bucketName = bucketName
+        self.key = key
+        self.cachePath = cachePath
+        self.state = None
+        self.etag = None
+        self.pendingOperations = []
+
+    def _readCache(self):
+        try:
+            with open(self.cachePath) as cacheFile:
+                cached = json.load(cacheFile)
+            return cached["etag"], cached["state"]
+        except (IOError, ValueError, KeyError):
+            return None, None
+
+    def _writeCache(self):
+        temporaryPath = self.cachePath + ".tmp"
+        with open(temporaryPath, "w") as cacheFile:
+            json.dump({"etag": self.etag, "state": self.state}, cacheFile)
+        os.replace(temporaryPath, self.cachePath)
+
+    def _fetch(self):
+        """
+        Reads the JSON object from S3 unless the /tmp copy is still current
+
+        Returns:
+        ----------
+        etag, state : tuple
+            (None, empty state) when the object does not exist yet
+        """
+        cachedEtag, cachedState = self._readCache()
+        request = {"Bucket": self.bucketName, "Key": self.key}
+        if cachedEtag:
+            request["IfNoneMatch"] = cachedEtag
+        try:
+            response = self.s3Client.get_object(**request)
+        except ClientError as error:
+            code = s3ErrorCode(error)
+            if code in ('304', 'NotModified'):
+                return cachedEtag, cachedState
+            if code in ('NoSuchKey', '404'):
+                return None, {"version": STATE_VERSION}
+            raise
+        state = json.loads(response['Body'].read().decode('utf-8'))
+        return response['ETag'], state
+
+    def load(self):
+        """
+        Reads the run state once for this invocation and drops any operations left over from a previous one
+
+        Returns:
+        ----------
+        exists : bool
+            False when no state document has been written yet
+        """
+        self.etag, self.state = self._fetch()
+        self.pendingOperations = []
+        if self.etag is not None:
+            self._writeCache()
+        return self.etag is not None
+
+    def get(self, name, default=None):
+        """
+        Returns a value of the run state, including the changes not flushed yet
+        """
+        return copy.deepcopy(self.state.get(name, default))
+
+    def _apply(self, state, operation):
+        kind, name, value = operation
+        if kind == "set":
+            state[name] = value
+        elif kind == "max":
+            state[name] = max(state.get(name) or 0, value)
+        elif kind == "union":
+            state[name] = sorted(set(state.get(name) or []) | set(value))
+        elif kind == "difference":
+            state[name] = sorted(set(state.get(name) or []) - set(value))
+        elif kind == "watermark":
+            state[name] = mergeWatermark(state.get(name), value)
+        elif kind == "maxEntries":
+            entries = dict(state.get(name) or {})
+            for key, number in value.items():
+                entries[key] = max(entries.get(key) or 0, number)
+            state[name] = entries
+        elif kind == "appendEntries":
+            lists = dict(state.get(name) or {})
+            for key, items in value["entries"].items():
+                lists[key] = ((lists.get(key) or []) + [item for item in items if item not in (lists.get(key) or [])])[-value["limit"]:]
+            state[name] = lists
+        elif kind == "removeEntries":
+            lists = dict(state.get(name) or {})
+            for key, items in value.items():
+                remaining = [item for item in lists.get(key) or [] if item not in items]
+                if remaining:
+                    lists[key] = remaining
+                else:
+                    lists.pop(key, None)
+            state[name] = lists
+        elif kind == "removeKeys":
+            entries = dict(state.get(name) or {})
+            for key in value:
+                entries.pop(key, None)
+            state[name] = entries
+        elif kind == "append":
+            items = list(state.get(name) or [])
+            state[name] = (items + [item for item in value["items"] if item not in items])[-value["limit"]:]
+
+    def _record(self, kind, name, value):
+        operation = (kind, name, copy.deepcopy(value))
+        self.pendingOperations.append(operation)
+        self._apply(self.state, operation)
+
+    def set(self, name, value):
+        """
+        Sets a value; the last writer wins when two invocations overlap
+        """
+        self._record("set", name, value)
+
+    def setMax(self, name, value):
+        """
+        Raises a numeric value; overlapping invocations keep the highest one
+        """
+        self._record("max", name, value)
+
+    def addToSet(self, name, values):
+        """
+        Adds values to a list treated as a set; overlapping invocations keep the union
+        """
+        self._record("union", name, list(values))
+
+    def removeFromSet(self, name, values):
+        """
+        Removes values from a list treated as a set
+        """
+        self._record("difference", name, list(values))
+
+    def setMaxEntries(self, name, values):
+        """
+        Raises the numbers of a dict, Example: {"tokenExpiry": 1536272042.0}; overlapping invocations keep the highest number of each key
+        """
+        self._record("maxEntries", name, dict(values))
+
+    def appendEntries(self, name, values, limit):
+        """
+        Appends items to the lists of a dict, Example: {"ops@example.com": [...]}, keeping the last 'limit' items of each list;
+        overlapping invocations keep the items of both
+        """
+        self._record("appendEntries", name, {"entries": dict(values), "limit": limit})
+
+    def removeEntries(self, name, values):
+        """
+        Removes items from the lists of a dict, dropping the lists left empty; items appended by an overlapping invocation are kept
+        """
+        self._record("removeEntries", name, dict(values))
+
+    def removeKeys(self, name, keys):
+        """
+        Removes keys from a dict; keys set by an overlapping invocation are kept
+        """
+        self._record("removeKeys", name, list(keys))
+
+    def appendToList(self, name, values, limit):
+        """
+        Appends items to a list, keeping its last 'limit' items; overlapping invocations keep the items of both
+        """
+        self._record("append", name, {"items": list(values), "limit": limit})
+
+    def setWatermark(self, name, uidValidity, lastUID):
+        """
+        Stores an IMAP UID watermark; overlapping invocations keep the highest UID of the same UIDVALIDITY
+        """
+        self._record("watermark", name, {"uidValidity": uidValidity, "lastUID": lastUID})
+
+    def flush(self, maxAttempts=5):
+        """
+        Writes the buffered changes with a single conditional PUT.
+        On a conflicting write the current document is re-read and the buffered operations are replayed before retrying.
+
+        Parameters:
+        ----------
+        maxAttempts : int
+        ----------
+
+        Returns:
+        ----------
+        written : bool
+            False when there was nothing to write
+        """
+        if not self.pendingOperations:
+            return False
+        for attempt in range(maxAttempts):
+            request = {"Bucket": self.bucketName, "Key": self.key, "ContentType": "application/json",
+                       "Body": json.dumps(self.state, sort_keys=True).encode("utf-8")}
+            if self.etag is None:
+                request["IfNoneMatch"] = "*"
+            else:
+                request["IfMatch"] = self.etag
+            try:
+                response = self.s3Client.put_object(**request)
+            except ClientError as error:
+                if s3ErrorCode(error) not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+                    raise
+                print("Run state changed by another invocation, merging (attempt " + str(attempt + 1) + ")")
+                self.etag, self.state = self._fetch()
+                for operation in self.pendingOperations:
+                    self._apply(self.state, operation)
+                continue
+            self.etag = response['ETag']
+            self.pendingOperations = []
+            self._writeCache()
+            return True
+        raise RuntimeError("Run state " + self.key + " could not be written after " + str(maxAttempts) + " attempts")
+
+
+class BloomFilter(object):
+    """
+    Fixed-size Bloom filter with a compact (zlib + base64) JSON form
+
+    Parameters:
+    ----------
+    bitCount : int
+    hashCount : int
+    bits : bytearray
+    ----------
+    """
+    def __init__(self, bitCount, hashCount, bits=None):
+        self.bitCount = bitCount
+        self.hashCount = hashCount
+        self.bits = bits if bits is not None else bytearray((bitCount + 7) // 8)
+
+    @classmethod
+    def forCapacity(cls, capacity, errorRate):
+        """
+        Sizes a filter for 'capacity' entries at the given false positive rate
+        """
+        capacity = max(capacity, 1)
+        bitCount = int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        hashCount = max(1, int(round(bitCount / float(capacity) * math.log(2))))
+        return cls(bitCount, hashCount)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+        return [(first + i * second) % self.bitCount for i in range(self.hashCount)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def toDict(self):
+        return {"bitCount": self.bitCount, "hashCount": self.hashCount,
+                "bits": b64encode(zlib.compress(bytes(self.bits), 9)).decode("ascii")}
+
+    @classmethod
+    def fromDict(cls, bloomDict):
+        return cls(bloomDict["bitCount"], bloomDict["hashCount"], bytearray(zlib.decompress(b64decode(bloomDict["bits"]))))
+
+
+class ProcessedTaskLedger(object):
+    """
+    Ledger of the TASK Numbers whose work items were already created, consulted before any work item is created for an email:
+    an email of a known TASK is a follow-up, whose existing cards are looked up and updated instead (see applyFollowUps).
+
+    Recent TASKs are kept as an exact set in the run state. Once that set reaches 'exactLimit' entries it is folded into a
+    new generation: a Bloom filter sized for the number of TASKs actually folded, so every generation keeps its false positive
+    rate however many TASKs the ledger holds. A Bloom filter hit only means "maybe processed"; the lookup of the cards
+    confirms it. The ledger rotates: only the last 'maxGenerations' generations are kept, so the oldest TASKs are
+    eventually forgotten and the run state stops growing.
+
+    Parameters:
+    ----------
+    state : RunStateStore
+    exactLimit : int
+        Number of exact entries kept before they are folded into a Bloom filter generation
+    maxGenerations : int
+        Number of Bloom filter generations kept, Example: 20 generations of 20000 TASKs
+    bloomErrorRate : float
+        False positive rate of the ledger as a whole: each generation gets an equal share of it
+    ----------
+    """
+    # Answers of check()
+    NO = "no"
+    YES = "yes"
+    MAYBE = "maybe"
+
+    def __init__(self, state, exactLimit=20000, maxGenerations=20, bloomErrorRate=0.001):
+        self.state = state
+        self.exactLimit = exactLimit
+        self.maxGenerations = max(maxGenerations, 1)
+        self.bloomErrorRate = bloomErrorRate
+        self.exact = set(state.get("processedTasks") or [])
+        self.generationDicts = state.get("processedTaskBlooms") or []
+        # the single, fixed-size filter of the earlier layout becomes the oldest generation at the next fold
+        self.legacyDict = state.get("processedTasksBloom")
+        if self.legacyDict:
+            self.generationDicts = [dict(self.legacyDict, id="legacy")] + self.generationDicts
+        self.generations = [BloomFilter.fromDict(bloomDict) for bloomDict in self.generationDicts]
+
+    def check(self, task):
+        """
+        Returns YES when the TASK is known to be processed, MAYBE on a Bloom filter hit, NO otherwise (always NO without a TASK Number)
+        """
+        if not task:
+            return self.NO
+        if task in self.exact:
+            return self.YES
+        if any(task in generation for generation in self.generations):
+            return self.MAYBE
+        return self.NO
+
+    def add(self, tasks):
+        """
+        Records TASK Numbers as processed (buffered in the run state until it is flushed); an empty TASK Number is never recorded
+        """
+        tasks = [task for task in tasks if task and task not in self.exact]
+        if not tasks:
+            return
+        self.exact.update(tasks)
+        self.state.addToSet("processedTasks", tasks)
+        if len(self.exact) >= self.exactLimit:
+            self._fold()
+
+    def _fold(self):
+        bloom = BloomFilter.forCapacity(len(self.exact), self.bloomErrorRate / self.maxGenerations)
+        for task in self.exact:
+            bloom.add(task)
+        # the ID keeps the generations of overlapping invocations apart when both are appended
+        bloomDict = dict(bloom.toDict(), id=uuid.uuid4().hex, count=len(self.exact))
+        newDicts = [bloomDict]
+        if self.legacyDict:
+            newDicts = [self.generationDicts[0], bloomDict]
+            self.state.set("processedTasksBloom", None)
+            self.legacyDict = None
+        self.state.appendToList("processedTaskBlooms", newDicts, self.maxGenerations)
+        self.state.removeFromSet("processedTasks", self.exact)
+        self.generationDicts = (self.generationDicts + [bloomDict])[-self.maxGenerations:]
+        self.generations = (self.generations + [bloom])[-self.maxGenerations:]
+        print("Folded " + str(len(self.exact)) + " processed TASKs into Bloom filter generation " + str(len(self.generationDicts)) +
+              " of " + str(self.maxGenerations))
+        self.exact = set()
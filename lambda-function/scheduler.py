@@ -0,0 +1,103 @@
+"""Deadline-aware admission of Intake Request emails within the Lambda time budget."""
+# Import the time and threading modules
+import time
+import threading
+
+
+class DeadlineScheduler(object):
+    """
+    Decides, before each email, whether there is still time to process it before the Lambda deadline.
+
+    The cost of an email is estimated as the wall time per completed email (the workers run in parallel, so this is
+    already divided by the concurrency), blended with the estimate persisted by earlier runs until enough emails of
+    this run have completed. An email is admitted only when the remaining time covers the emails already in flight,
+    this one, and a safety margin left for archiving and writing the run state. Once an email is refused every later
+    one is refused as well, so the emails left over form one contiguous tail that the next run resumes from.
+
+    Parameters:
+    ----------
+    remainingMillis : function
+        Returns the milliseconds left before the deadline, Example: context.get_remaining_time_in_millis;
+        None admits every email (daemon, command line)
+    safetySeconds : float
+        Time kept in reserve after the last email
+    defaultEmailSeconds : float
+        Cost estimate used until a measurement exists
+    ----------
+    """
+    # Number of emails of this run after which the live measurement outweighs the persisted estimate
+    PRIOR_WEIGHT = 5
+
+    def __init__(self, remainingMillis=None, safetySeconds=30.0, defaultEmailSeconds=2.0):
+        self.remainingMillis = remainingMillis
+        self.safetySeconds = safetySeconds
+        self.priorEmailSeconds = defaultEmailSeconds
+        self.lock = threading.Lock()
+        self.started = None
+        self.admitted = []
+        self.completed = 0
+        # UID of the first email refused, None while every email was admitted
+        self.stoppedAtUID = None
+
+    def usePriorEstimate(self, emailSeconds):
+        """
+        Seeds the cost estimate with the one persisted by an earlier run
+        """
+        if emailSeconds:
+            self.priorEmailSeconds = float(emailSeconds)
+
+    def estimate(self):
+        """
+        Returns the estimated wall time, in seconds, of one more email
+        """
+        with self.lock:
+            if self.started is None or not self.completed:
+                return self.priorEmailSeconds
+            liveEmailSeconds = (time.time() - self.started) / self.completed
+            return (self.priorEmailSeconds * self.PRIOR_WEIGHT + liveEmailSeconds * self.completed) / (self.PRIOR_WEIGHT + self.completed)
+
+    def admit(self, UIDNum):
+        """
+        Returns True when the email can still be processed before the deadline
+
+        Parameters:
+        ----------
+        UIDNum : str
+        ----------
+
+        Returns:
+        ----------
+        admitted : bool
+        """
+        if self.stoppedAtUID is not None:
+            return False
+        if self.remainingMillis is not None:
+            inFlight = len(self.admitted) - self.completed
+            needed = self.safetySeconds + self.estimate() * (inFlight + 1)
+            remaining = self.remainingMillis() / 1000.0
+            if remaining < needed:
+                print("Deadline near (" + str(round(remaining, 1)) + " s left, " + str(round(needed, 1)) +
+                      " s needed), deferring UID " + str(UIDNum) + " and the emails after it")
+                self.stoppedAtUID = UIDNum
+                return False
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            self.admitted.append(UIDNum)
+        return True
+
+    def done(self, emailCount):
+        """
+        Records that 'emailCount' admitted emails were completed (successfully or not)
+        """
+        with self.lock:
+            self.completed += emailCount
+
+    def deferredUIDs(self, UIDList):
+        """
+        Returns the UIDs of 'UIDList' that were refused: the UID the scheduler stopped at and every later one not admitted
+        """
+        if self.stoppedAtUID is None:
+            return []
+        admitted = set(self.admitted)
+        return [UIDNum for UIDNum in UIDList if int(UIDNum) >= int(self.stoppedAtUID) and UIDNum not in admitted]
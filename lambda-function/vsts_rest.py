@@ -0,0 +1,618 @@
+"""Thin REST client for the VSTS (Azure DevOps) Work Item Tracking endpoints, over a pool of keep-alive HTTP connections.
+
+It replaces the vstsclient package for the calls the generator makes, since vstsclient has no $batch or workitemsbatch
+call (one round trip per work item), no connection reuse across calls and no handling of the Azure DevOps rate limits;
+only its field and link type constants are still used.
+"""
+# Import the JSON module
+import json
+
+# Import Authentication Encoding Module
+from base64 import b64encode
+
+# Import the HTTP connection, threading, time and random modules
+import http.client
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlsplit
+
+
+# REST API version used for every Work Item Tracking call
+API_VERSION = "4.1"
+
+# Maximum number of sub-requests accepted by a single $batch call
+MAX_BATCH_REQUESTS = 200
+
+# Maximum number of work items read by a single workitemsbatch call
+MAX_WORKITEMS_BATCH = 200
+
+# Maximum number of work items returned by a single WIQL query
+MAX_WIQL_RESULTS = 20000
+
+# Relation from a parent work item to its child (the child holds the reverse, parent, relation)
+CHILD_LINK_TYPE = "System.LinkTypes.Hierarchy-Forward"
+
+# Status codes of throttling: the service refused the request or is unavailable, the in-flight limit is lowered
+REFUSED_STATUS = (429, 503)
+# Status code of a request the Azure DevOps rate limits rejected before processing it: always safe to send again
+REJECTED_STATUS = 429
+# Status codes of a request that may or may not have been processed: only read requests are sent again
+TRANSIENT_STATUS = (500, 502, 503, 504)
+
+
+class VstsRestError(Exception):
+    """
+    Raised when the VSTS REST API answers with a non-success status code
+    """
+    def __init__(self, status, reason, body=""):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        super(VstsRestError, self).__init__(str(status) + " " + str(reason) + ": " + str(body)[:500])
+
+    @property
+    def notFound(self):
+        """
+        True when the work item (or project) does not exist - unlike throttling or a service error
+        """
+        return self.status == 404
+
+    @property
+    def throttled(self):
+        """
+        True when the request was refused by the Azure DevOps rate limits, after every retry
+        """
+        return self.status in REFUSED_STATUS
+
+
+def retryAfterSeconds(headers):
+    """
+    Returns the delay, in seconds, asked by a 'Retry-After' header (seconds or HTTP date) or an 'X-RateLimit-Delay' header,
+    None when the response asks for no delay
+    """
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    value = headers.get("X-RateLimit-Delay")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+    return None
+
+
+def nearRateLimit(headers, reserveFraction=0.1):
+    """
+    Returns True when the 'X-RateLimit-*' headers show the service already delays requests
+    or has less than 'reserveFraction' of its budget left
+    """
+    try:
+        if float(headers.get("X-RateLimit-Delay") or 0) > 0:
+            return True
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        if limit and remaining is not None:
+            return float(remaining) < float(limit) * reserveFraction
+    except ValueError:
+        pass
+    return False
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit on the number of VSTS requests in flight, shared by the worker threads and adjusted AIMD-style:
+    the limit grows by one request per limit's worth of accepted requests (additive increase) and is halved when
+    the service throttles or reports its rate limit almost used up (multiplicative decrease). Several threads usually
+    see the same throttling episode, so the limit is halved at most once per 'cooldownSeconds'.
+    A 'Retry-After' delay holds back every thread, not only the one that received it.
+
+    Parameters:
+    ----------
+    initial : int
+        Starting limit
+    maximum : int
+        The limit never grows beyond it
+    minimum : int
+    cooldownSeconds : float
+    ----------
+    """
+    def __init__(self, initial=4, maximum=16, minimum=1, cooldownSeconds=2.0):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.cooldownSeconds = cooldownSeconds
+        self.inFlight = 0
+        self.holdUntil = 0.0
+        self.lastDecrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits for a free request slot and for the end of any 'Retry-After' delay
+        """
+        with self.condition:
+            while True:
+                delay = self.holdUntil - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                elif self.inFlight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.inFlight += 1
+                    return
+
+    def release(self, throttled=False, delay=None):
+        """
+        Frees the slot of a completed request and adjusts the limit
+
+        Parameters:
+        ----------
+        throttled : bool
+            The response was a throttling signal (429/503, or the rate limit headers were near their limit)
+        delay : float
+            Seconds every request must wait, from 'Retry-After'
+        ----------
+        """
+        with self.condition:
+            self.inFlight -= 1
+            now = time.time()
+            if delay:
+                self.holdUntil = max(self.holdUntil, now + delay)
+            if throttled:
+                if now - self.lastDecrease >= self.cooldownSeconds:
+                    self.limit = max(self.limit / 2.0, float(self.minimum))
+                    self.lastDecrease = now
+            elif self.limit < self.maximum:
+                self.limit = min(self.limit + 1.0 / self.limit, float(self.maximum))
+            self.condition.notify_all()
+
+
+class HTTPConnectionPool(object):
+    """
+    Pool of keep-alive HTTP(S) connections to one host, shared by the worker threads and kept across warm invocations.
+
+    A connection is checked out for one request at a time and returned afterwards unless the server asked to close it.
+    A pooled connection the server has silently dropped fails on its next request. When it failed while the request was
+    being sent, or the request is idempotent, it is sent once more on a fresh connection. A non-idempotent request whose
+    response was lost may already have been processed, so that error is raised to the caller instead.
+
+    Parameters:
+    ----------
+    baseUrl : str
+        Example: "https://contoso.visualstudio.com"
+    maxIdle : int
+        Number of idle connections kept open
+    timeout : float
+        Socket timeout, in seconds
+    ----------
+    """
+    def __init__(self, baseUrl, maxIdle=16, timeout=60):
+        parsedUrl = urlsplit(baseUrl)
+        self.connectionClass = http.client.HTTPSConnection if parsedUrl.scheme == "https" else http.client.HTTPConnection
+        self.host = parsedUrl.hostname
+        self.port = parsedUrl.port
+        self.pathPrefix = parsedUrl.path.rstrip("/")
+        self.maxIdle = maxIdle
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop(), True
+            self.created += 1
+        return self.connectionClass(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.maxIdle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, body=None, headers=None, idempotent=True):
+        """
+        Sends one request over a pooled connection
+
+        Parameters:
+        ----------
+        method : str
+        path : str
+        body : bytes
+        headers : dict
+        idempotent : bool
+            False for requests that create or change work items
+        ----------
+
+        Returns:
+        ----------
+        status, reason, headers, body : tuple
+        """
+        while True:
+            connection, reused = self._acquire()
+            sent = False
+            try:
+                connection.request(method, self.pathPrefix + path, body=body, headers=headers or {})
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused and (not sent or idempotent):
+                    # stale keep-alive connection - the server closed it before the request could reach it,
+                    # or the request can safely be repeated
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, response.reason, response.headers, data
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class VstsRestClient(object):
+    """
+    Minimal client for the VSTS Work Item Tracking REST API
+
+    Parameters:
+    ----------
+    vstsAccount : str
+        VSTS instance, Example: "contoso.visualstudio.com"
+    vstsAccountToken : str
+        Personal access token
+    baseUrl : str
+        Optional override for the service root, Example: "http://127.0.0.1:8080"
+    maxInFlight : int
+        Upper bound of the adaptive limit on concurrent requests
+    maxRetries : int
+        Number of times a throttled or failed request is sent again
+    backoffSeconds : float
+        Base of the jittered exponential backoff between retries
+    maxBackoffSeconds : float
+        Longest wait before one retry: a request whose 'Retry-After' asks for more fails at once (VstsRestError.throttled)
+        rather than being sent again before the service accepts it
+    ----------
+    """
+    def __init__(self, vstsAccount, vstsAccountToken, baseUrl=None, maxInFlight=16, maxRetries=5, backoffSeconds=0.5, maxBackoffSeconds=30.0):
+        self.baseUrl = (baseUrl or "https://" + vstsAccount).rstrip("/")
+        credentials = b64encode((":" + vstsAccountToken).encode("utf-8")).decode("ascii")
+        self.authHeader = "Basic " + credentials
+        self.pool = HTTPConnectionPool(self.baseUrl, maxIdle=maxInFlight)
+        self.limiter = AdaptiveLimiter(initial=min(4, maxInFlight), maximum=maxInFlight)
+        self.maxRetries = maxRetries
+        self.backoffSeconds = backoffSeconds
+        self.maxBackoffSeconds = maxBackoffSeconds
+        # optional function called after every request with (method, path, status, seconds), used for metrics;
+        # status is None when no response was received
+        self.onRequest = None
+
+    def close(self):
+        """
+        Closes the idle keep-alive connections of the client
+        """
+        self.pool.close()
+
+    def _backoff(self, attempt, retryAfter=None):
+        """
+        Returns the wait before retry number 'attempt' (0 based): the full 'Retry-After' when the service sent one,
+        otherwise a random delay up to the exponential backoff ("full jitter"), so the threads do not retry in step
+        """
+        if retryAfter is not None:
+            return retryAfter + random.uniform(0, self.backoffSeconds)
+        return random.uniform(0, min(self.backoffSeconds * 2 ** attempt, self.maxBackoffSeconds))
+
+    def _request(self, method, path, payload=None, contentType="application/json", idempotent=True):
+        """
+        Sends a single request and returns the decoded JSON response.
+
+        A request rejected by the rate limits (429) was not processed, so it is sent again - $batch creations included -
+        after its 'Retry-After' delay or a jittered exponential backoff; a 'Retry-After' beyond 'maxBackoffSeconds'
+        is raised at once instead. A request that failed in a way that leaves its outcome unknown (500, 502, 503, 504,
+        lost connection) is only sent again when it is 'idempotent', so a creation is never duplicated: a 503 may come
+        from a gateway after the service processed the request. Other errors - 404 in particular - are raised at once.
+
+        Parameters:
+        ----------
+        method : str
+        path : str
+            Path (and query string) relative to the service root
+        payload : object
+            JSON serializable request body
+        contentType : str
+        idempotent : bool
+            False for requests that create or change work items
+        ----------
+
+        Returns:
+        ----------
+        Decoded JSON response : dict
+        """
+        body = None if payload is None else json.dumps(payload).encode("utf-8")
+        headers = {"Authorization": self.authHeader, "Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = contentType
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            start = time.time()
+            try:
+                status, reason, responseHeaders, raw = self.pool.request(method, path, body, headers, idempotent)
+            except (OSError, http.client.HTTPException):
+                self.limiter.release()
+                if self.onRequest is not None:
+                    self.onRequest(method, path, None, time.time() - start)
+                if not idempotent or attempt >= self.maxRetries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            retryAfter = retryAfterSeconds(responseHeaders)
+            throttled = status in REFUSED_STATUS or nearRateLimit(responseHeaders)
+            self.limiter.release(throttled, retryAfter if status in REFUSED_STATUS else None)
+            if self.onRequest is not None:
+                self.onRequest(method, path, status, time.time() - start)
+            if status < 400:
+                break
+            retryable = status == REJECTED_STATUS or (idempotent and status in TRANSIENT_STATUS)
+            if retryAfter is not None and retryAfter > self.maxBackoffSeconds:
+                # a retry sooner than the service asked would only be throttled again
+                retryable = False
+            if not retryable or attempt >= self.maxRetries:
+                raise VstsRestError(status, reason, raw.decode("utf-8", "replace"))
+            time.sleep(self._backoff(attempt, retryAfter))
+            attempt += 1
+        if not raw:
+            return {}
+        return json.loads(raw.decode("utf-8"))
+
+    def query_workitem_ids(self, wiqlQuery, project):
+        """
+        Runs a flat WIQL query and returns the matching work item ID numbers
+
+        Parameters:
+        ----------
+        wiqlQuery : str
+        project : str
+        ----------
+
+        Returns:
+        ----------
+        List of work item ID numbers : list
+        """
+        path = "/" + quote(project) + "/_apis/wit/wiql?api-version=" + API_VERSION
+        result = self._request("POST", path, {"query": wiqlQuery})
+        return [workItem["id"] for workItem in result.get("workItems", [])]
+
+    def get_workitems(self, workItemIDs, fields=None, expand=None):
+        """
+        Reads up to MAX_WORKITEMS_BATCH work items with a single call to the workitemsbatch endpoint
+
+        Parameters:
+        ----------
+        workItemIDs : list of int
+        fields : list of str
+            Reference names of the fields to return, Example: ["GTSKanban.TASK"]; all fields when None
+        expand : str
+            Example: "Relations"; the service returns all fields then, so it cannot be combined with 'fields'
+        ----------
+
+        Returns:
+        ----------
+        List of work items : list of dict
+        """
+        if len(workItemIDs) > MAX_WORKITEMS_BATCH:
+            raise ValueError("At most " + str(MAX_WORKITEMS_BATCH) + " work items can be read in one call")
+        if fields and expand:
+            raise ValueError("The fields of a work item read cannot be selected together with $expand")
+        payload = {"ids": list(workItemIDs), "errorPolicy": "omit"}
+        if fields:
+            payload["fields"] = list(fields)
+        if expand:
+            payload["$expand"] = expand
+        result = self._request("POST", "/_apis/wit/workitemsbatch?api-version=" + API_VERSION, payload)
+        return [workItem for workItem in result.get("value", []) if workItem]
+
+    def workitem_url(self, workItemID):
+        """
+        Returns the REST URL of a work item, as used by relation operations (temporary negative IDs included)
+        """
+        return self.baseUrl + "/_apis/wit/workitems/" + str(workItemID)
+
+    def create_workitem_request(self, project, workItemType, operations):
+        """
+        Builds one work item creation sub-request for the $batch endpoint
+
+        Parameters:
+        ----------
+        project : str
+        workItemType : str
+        operations : list of dict
+            JSON Patch operations, may include an 'add /id' operation with a temporary negative ID
+        ----------
+
+        Returns:
+        ----------
+        Batch sub-request : dict
+        """
+        return {
+            "method": "PATCH",
+            "uri": "/" + quote(project) + "/_apis/wit/workitems/$" + quote(workItemType) + "?api-version=" + API_VERSION,
+            "headers": {"Content-Type": "application/json-patch+json"},
+            "body": operations,
+        }
+
+    def update_workitem_request(self, workItemID, operations):
+        """
+        Builds one sub-request of the $batch endpoint that applies JSON Patch operations to an existing work item
+
+        Parameters:
+        ----------
+        workItemID : int
+        operations : list of dict
+        ----------
+
+        Returns:
+        ----------
+        Batch sub-request : dict
+        """
+        return {
+            "method": "PATCH",
+            "uri": "/_apis/wit/workitems/" + str(workItemID) + "?api-version=" + API_VERSION,
+            "headers": {"Content-Type": "application/json-patch+json"},
+            "body": operations,
+        }
+
+    def create_workitem(self, project, workItemType, operations):
+        """
+        Creates a single work item
+
+        Parameters:
+        ----------
+        project : str
+        workItemType : str
+        operations : list of dict
+            JSON Patch operations
+        ----------
+
+        Returns:
+        ----------
+        Created work item : dict
+        """
+        path = "/" + quote(project) + "/_apis/wit/workitems/$" + quote(workItemType) + "?api-version=" + API_VERSION
+        return self._request("PATCH", path, operations, "application/json-patch+json", idempotent=False)
+
+    def add_link(self, sourceWorkItemID, targetWorkItemID, linkType, comment=""):
+        """
+        Adds a relation of type 'linkType' from one existing work item to another
+
+        Parameters:
+        ----------
+        sourceWorkItemID : int
+        targetWorkItemID : int
+        linkType : str
+            Example: "System.LinkTypes.Hierarchy-Reverse" (target is the parent of source)
+        comment : str
+        ----------
+
+        Returns:
+        ----------
+        Updated source work item : dict
+        """
+        operations = [{"op": "add", "path": "/relations/-", "value": {
+            "rel": linkType, "url": self.workitem_url(targetWorkItemID), "attributes": {"comment": comment}}}]
+        path = "/_apis/wit/workitems/" + str(sourceWorkItemID) + "?api-version=" + API_VERSION
+        return self._request("PATCH", path, operations, "application/json-patch+json", idempotent=False)
+
+    def batch(self, subRequests):
+        """
+        Submits several work item requests in one call to the $batch endpoint.
+        Sub-requests are executed in order and may refer to items created earlier in the same batch by their temporary negative ID.
+        A $batch call is not idempotent: it is only sent again after a 429, which the service returns before running any sub-request.
+
+        Parameters:
+        ----------
+        subRequests : list of dict
+        ----------
+
+        Returns:
+        ----------
+        List of (status code, decoded body) : list
+            One entry per sub-request, in order
+        """
+        result = self._request("POST", "/_apis/wit/$batch?api-version=" + API_VERSION, subRequests, idempotent=False)
+        responses = []
+        for response in result.get("value", []):
+            body = response.get("body")
+            if isinstance(body, str) and body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    pass
+            responses.append((response.get("code"), body))
+        return responses
+
+
+def wiqlQuote(value):
+    """
+    Escapes a value for use inside a single-quoted WIQL string literal
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def queryWorkItemIDsPaged(restClient, project, conditions):
+    """
+    Runs a flat WIQL query without the MAX_WIQL_RESULTS cap: the query is repeated on the IDs above the last one returned
+    until a page comes back short
+
+    Parameters:
+    ----------
+    restClient : VstsRestClient
+    project : str
+    conditions : str
+        WIQL conditions joined to the project filter, Example: " AND [GTSKanban.TASK] <> ''"
+    ----------
+
+    Returns:
+    ----------
+    workItemIDs : list of int
+        In ascending order
+    """
+    workItemIDs = []
+    lastID = 0
+    while True:
+        wiqlQuery = ("SELECT [System.Id] FROM WorkItems"
+                     " WHERE [System.TeamProject] = " + wiqlQuote(project) + conditions +
+                     " AND [System.Id] > " + str(lastID) +
+                     " ORDER BY [System.Id]")
+        page = restClient.query_workitem_ids(wiqlQuery, project)
+        workItemIDs += page
+        if len(page) < MAX_WIQL_RESULTS:
+            return workItemIDs
+        lastID = page[-1]
+
+
+def readWorkItemsChunked(restClient, workItemIDs, workers, fields=None, expand=None):
+    """
+    Reads any number of work items, MAX_WORKITEMS_BATCH items per workitemsbatch call and 'workers' calls at a time
+
+    Parameters:
+    ----------
+    restClient : VstsRestClient
+    workItemIDs : list of int
+    workers : int
+    fields, expand :
+        See VstsRestClient.get_workitems
+    ----------
+
+    Yields:
+    ----------
+    workItems : list of dict
+        The work items of one call, in the order of 'workItemIDs'
+    """
+    IDChunks = [workItemIDs[i:i + MAX_WORKITEMS_BATCH] for i in range(0, len(workItemIDs), MAX_WORKITEMS_BATCH)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for workItems in executor.map(lambda IDChunk: restClient.get_workitems(IDChunk, fields, expand), IDChunks):
+            yield workItems
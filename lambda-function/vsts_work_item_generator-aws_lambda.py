@@ -2,26 +2,84 @@
 # Import the OS Module
 import os
 
+# Import the JSON Module
+import json
+
+# Import the Regular Expression Module
+import re
+
 # Import the AWS S3 module
 import boto3
+from botocore.exceptions import ClientError
 
 # Import Decryption Module
 from base64 import b64decode
 
+# Import the hashing and URL decoding modules (pushed email objects)
+import hashlib
+from urllib.parse import unquote_plus
+
+# Import the time, threading and context manager modules
+import time
+import threading
+import contextlib
+
 # Import the IMAP and SMTP email client module
 import imaplib
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.parser import BytesHeaderParser
+from email.header import decode_header, make_header
 
 # Import the datetime module
 from datetime import datetime, timedelta
 
-# Import the VstsClient module
-from vstsclient.vstsclient import VstsClient
-from vstsclient.models import JsonPatchDocument, JsonPatchOperation
+# Import the thread pool module
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Import the vstsclient constants (work item field and link type names)
 from vstsclient.constants import SystemFields, LinkTypes
-from vstsclient._http import HTTPError
+
+# Import the Intake Request email parser
+from intake_parser import parseIntakeMessage, parseIntakePart, findStructurePart, splitHeaders, DEFAULT_TITLE
+
+# Import the mbox/Maildir export replay (backfill)
+from backfill import replayExport
+
+# Import the run state store
+from run_state import RunStateStore, ProcessedTaskLedger, s3ErrorCode
+
+# Import the outbox between the IMAP ingestion and the VSTS creation stages
+from outbox import OutboxStore
+
+# Import the VSTS REST API helper (WIQL queries, $batch requests)
+from vsts_rest import VstsRestClient, VstsRestError, MAX_BATCH_REQUESTS, MAX_WORKITEMS_BATCH, wiqlQuote, queryWorkItemIDsPaged
+
+# Import the connection manager (IMAP, SMTP and VSTS connections kept across warm invocations)
+from connection_manager import ConnectionManager, imapIsAlive, smtpIsAlive
+
+# Import the metrics module (stage timing spans, call counters, debug logging)
+from metrics import InvocationMetrics, IMAPCommandCounter
+
+# Import the deadline-aware scheduler
+from scheduler import DeadlineScheduler
+
+# Import the routing table (mailbox, sender and Subject -> VSTS project)
+from routes import RouteTable
+
+# Import the digest notifier (created cards, failures and alerts mailed once per invocation)
+from notifier import (DigestNotifier, loadRecipients, TOKEN_EXPIRY, RUN_FAILED, CREATION_FAILED, LINK_FAILED,
+                      PARSE_FAILED, CREATED)
+
+# Import the on-demand profiler (cProfile/tracemalloc results of a single invocation)
+from profiling import InvocationProfiler
+
+# Import the link repair sweep (Request/PBI pairs created without their parent/child link)
+from link_repair import repairParentLinks
+
+# Import the IMAP IDLE loop of the long-running daemon
+from idle_daemon import runIdleLoop
 
 
 # Class to communicate with customized back-end VSTS Kanban Setup
@@ -33,6 +91,64 @@ class GTSKanban(object):
     TARGET_ENV = '/fields/GTSKanban.TargetEnvironment'
 
 
+# Class to decrypt the KMS-encrypted Environment Variables lazily and cache the plaintext in the warm container
+class SecretsProvider(object):
+    """
+    Decrypts KMS-encrypted secrets on first use and caches the plaintext for the life of the warm container.
+
+    A single KMS client is built only when the first secret is needed. A cached secret is reused until its TTL expires;
+    the ciphertext is then read again and decrypted only if it changed, which allows the token to be rotated without a redeploy.
+
+    Parameters:
+    ----------
+    ttlSeconds : int
+        Number of seconds a decrypted secret is reused before its ciphertext is checked again
+    ----------
+    """
+    def __init__(self, ttlSeconds):
+        self.ttlSeconds = ttlSeconds
+        self.kmsClient = None
+        # secret name -> (ciphertext, plaintext, time the ciphertext was read)
+        self.cache = {}
+        # secret name -> function returning the current base64 ciphertext
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def register(self, secretName, ciphertextSource):
+        """
+        Overrides where the ciphertext of a secret is read from (default: the Environment Variable of the same name)
+        """
+        self.sources[secretName] = ciphertextSource
+
+    def getSecret(self, secretName):
+        """
+        Returns the decrypted value of a secret
+
+        Parameters:
+        ----------
+        secretName : str
+            Example: 'vstsWIAcToken'
+
+        Returns:
+        ----------
+        plaintext : str
+        """
+        with self.lock:
+            cached = self.cache.get(secretName)
+            if cached is not None and time.time() - cached[2] < self.ttlSeconds:
+                return cached[1]
+            ciphertext = self.sources.get(secretName, lambda: os.environ[secretName])().strip()
+            if cached is not None and cached[0] == ciphertext:
+                plaintext = cached[1]
+            else:
+                if self.kmsClient is None:
+                    self.kmsClient = boto3.client('kms')
+                plaintext = self.kmsClient.decrypt(CiphertextBlob=b64decode(ciphertext))['Plaintext'].decode("utf-8")
+                invocationMetrics.debug("Decrypted secret '" + secretName + "'")
+            self.cache[secretName] = (ciphertext, plaintext, time.time())
+            return plaintext
+
+
 # Accessing the AWS Lambda Environment Variables - concealing sensitive account information
 # Normal Values
 emailHostNameEnvVar = os.environ['emailHostName']
@@ -44,43 +160,197 @@ senderEmailEnvVar = os.environ['senderEmailAddress']
 recipientEmailEnvVar = os.environ['recipientEmailAddress']
 smtpEmailUserNameEnvVar = os.environ['smtpEmailUserName']
 
-# Encrypted Values
-ENCRYPTED_emailPasswordEnvVar = os.environ['emailPassword']
-ENCRYPTED_vstsWIAcTokenEnvVar = os.environ['vstsWIAcToken']
+# Encrypted Values - decrypted on first use by the secrets provider (see 'SecretsProvider' above)
+# Number of seconds a decrypted secret is reused before its ciphertext is read again
+secretCacheTTLEnvVar = int(os.environ.get('secretCacheTTLSeconds', '3600'))
+# Optional S3 object holding the current 'vstsWIAcToken' ciphertext, so the token can be rotated without redeploying
+vstsWIAcTokenS3KeyEnvVar = os.environ.get('vstsWIAcTokenS3Key')
 
-# Decrypted Values
-DECRYPTED_emailPasswordEnvVar = boto3.client('kms').decrypt(CiphertextBlob=b64decode(ENCRYPTED_emailPasswordEnvVar))['Plaintext']
-DECRYPTED_vstsWIAcTokenEnvVar = boto3.client('kms').decrypt(CiphertextBlob=b64decode(ENCRYPTED_vstsWIAcTokenEnvVar))['Plaintext']
 
-# Decoded, Decrypted Values
-emailPasswordEnvVar = DECRYPTED_emailPasswordEnvVar.decode("utf-8")
-vstsWIAcTokenEnvVar = DECRYPTED_vstsWIAcTokenEnvVar.decode("utf-8")
+# Metrics #######
+# "DEBUG" also logs the email payloads and every work item created, "INFO" only the summaries
+logLevelEnvVar = os.environ.get('logLevel', 'INFO')
+# CloudWatch namespace of the Embedded Metric Format record written at the end of every invocation
+metricsNamespaceEnvVar = os.environ.get('metricsNamespace', 'VSTSWorkItemGenerator')
+invocationMetrics = InvocationMetrics(metricsNamespaceEnvVar, logLevelEnvVar)
 
 
 # S3 Information #######
 # AWS S3 Bucket Connection Information
 bucket_name = "S3_BUCKET_NAME_HERE"
 s3 = boto3.resource("s3")
-
+# every S3 call (run state I/O, .txt files) is counted in the metrics of the invocation
+s3.meta.client.meta.events.register('before-call.s3', lambda **kwargs: invocationMetrics.count("S3Operations"))
+
+# JSON File with all run state: work item ID watermark, IMAP UID watermark, alert dates, processed TASKs
+# (read once per invocation, cached in /tmp between warm invocations, written once at the end of the run)
+file_name_runState = "RunState.json"
+s3_path_runState = file_name_runState
+lambda_path_runState = "/tmp/" + file_name_runState
+runStateStore = RunStateStore(s3.meta.client, bucket_name, s3_path_runState, lambda_path_runState)
+
+# Number of processed TASKs kept as an exact set before they are folded into a Bloom filter generation of the ledger
+ledgerExactLimitEnvVar = int(os.environ.get('ledgerExactLimit', '20000'))
+# Number of Bloom filter generations the ledger keeps before the oldest TASKs are forgotten
+ledgerGenerationsEnvVar = int(os.environ.get('ledgerGenerations', '20'))
+
+# "direct": the poll creates the work items of the emails it reads before archiving them;
+# "outbox": the poll stores the parsed emails in the outbox, archives them, then drains the outbox into VSTS.
+# With either mode a {"mode": "ingest"} or {"mode": "drain"} event runs one outbox stage only.
+pipelineModeEnvVar = os.environ.get('pipelineMode', 'direct').lower()
+# SQLite outbox database, kept in S3 and cached in /tmp
+outboxS3KeyEnvVar = os.environ.get('outboxS3Key', 'Outbox.sqlite')
+outboxStore = OutboxStore(s3.meta.client, bucket_name, outboxS3KeyEnvVar, "/tmp/" + os.path.basename(outboxS3KeyEnvVar),
+                          int(os.environ.get('outboxMaxAttempts', '10')))
+# Number of outbox records drained per route and invocation
+outboxDrainLimitEnvVar = int(os.environ.get('outboxDrainLimit', '1000'))
+# Days a done outbox record is kept
+outboxRetentionDaysEnvVar = float(os.environ.get('outboxRetentionDays', '7'))
+
+# Pushed emails (s3_event_handler): largest number of bytes read from an .eml object
+pushedEmailByteCapEnvVar = int(os.environ.get('pushedEmailByteCap', str(10 * 1048576)))
+# S3 prefix of the markers that make a redelivered object event a no-op
+pushedEmailMarkerPrefixEnvVar = os.environ.get('pushedEmailMarkerPrefix', 'PushedEmails/')
+# Seconds after which the claim of an invocation that never finished may be taken over (at least the function timeout)
+pushedEmailClaimSecondsEnvVar = int(os.environ.get('pushedEmailClaimSeconds', '900'))
+
+# Legacy .txt Files, only read to seed the run state the first time it is created
 # .txt File with ID Number
-file_name_idNum = "workItemIDNumber.txt"
-s3_path_idNum = file_name_idNum
-lambda_path_idNum = "/tmp/" + file_name_idNum
-
+s3_path_idNum = "workItemIDNumber.txt"
 # .txt File with Last Send Date of Reminder Email to Change VSTS Token
-file_name_emailSendDate = "TokenEmailSendDate.txt"
-s3_path_emailSendDate = file_name_emailSendDate
-lambda_path_emailSendDate = "/tmp/" + file_name_emailSendDate
+s3_path_emailSendDate = "TokenEmailSendDate.txt"
+# .txt File with the IMAP UIDVALIDITY and the highest UID already processed
+s3_path_uidWatermark = "IMAPUIDWatermark.txt"
+
+
+# IMAP client classes that count every command in the metrics of the invocation
+class MeteredIMAP4(IMAPCommandCounter, imaplib.IMAP4):
+    metrics = invocationMetrics
+
+
+class MeteredIMAP4_SSL(IMAPCommandCounter, imaplib.IMAP4_SSL):
+    metrics = invocationMetrics
+
+
+# IMAP Connection Variables #######
+# Port of the IMAP server (default: 993 with TLS, 143 without) and whether TLS is used - plain IMAP is only meant for a local stand-in
+imapPortEnvVar = int(os.environ.get('imapPort', '0'))
+imapSSLEnvVar = os.environ.get('imapSSL', 'true').lower() != 'false'
+# Number of seconds an IMAP IDLE command is left open by the daemon before it is re-issued (servers drop it after 29 minutes)
+imapIdleSecondsEnvVar = int(os.environ.get('imapIdleSeconds', '1500'))
+# Longest wait, in seconds, between two reconnect attempts of the daemon
+daemonMaxBackoffEnvVar = int(os.environ.get('daemonMaxBackoffSeconds', '300'))
+
+
+# IMAP Search Variables #######
+# "incremental" searches above the stored UID watermark, "daily" runs the per-day HEADER searches
+imapSearchModeEnvVar = os.environ.get('imapSearchMode', 'incremental')
+# Number of days searched when no usable UID watermark exists (first run or UIDVALIDITY change)
+numDaysToSearchBeforeToday = 3
+# Maximum number of UIDs addressed by a single UID FETCH command
+imapFetchBatchSize = 100
+# Largest number of bytes of the body part fetched per email (BODY.PEEK[n]<0.cap>), 0 fetches the whole part
+imapBodyByteCapEnvVar = max(int(os.environ.get('imapBodyByteCap', '262144')), 0)
+# Mailbox the processed Intake Requests are moved to
+archiveMailbox = 'Archive/ServiceCafe'
+# Mailbox the Intake Requests that failed 'maxEmailFailures' runs are moved to, "" to leave them in the INBOX past the UID watermark
+errorMailboxEnvVar = os.environ.get('errorMailbox', '')
+# Number of runs an Intake Request may fail before it is set aside, 0 to retry it forever
+maxEmailFailuresEnvVar = int(os.environ.get('maxEmailFailures', '5'))
+
+
+# Secrets provider - shared by every invocation of the warm container
+secretsProvider = SecretsProvider(secretCacheTTLEnvVar)
+if vstsWIAcTokenS3KeyEnvVar:
+    secretsProvider.register('vstsWIAcToken', lambda: s3_Read_Str_from_TXT_File(bucket_name, vstsWIAcTokenS3KeyEnvVar))
+
+# Connection manager - the IMAP session, the SMTP session and the VSTS HTTP connection pool outlive the invocation
+connectionManager = ConnectionManager()
+
+
+# Notification Variables #######
+# JSON recipients and the event kinds each one receives (see notifier.loadRecipients),
+# default: 'recipientEmailAddress' receives the alerts only, the digests of created cards are opt-in
+notifyRecipientsEnvVar = os.environ.get('notifyRecipients')
+# Seconds before a recurring failure is reported again
+notifyRepeatSecondsEnvVar = float(os.environ.get('notifyRepeatSeconds', '86400'))
+# Shortest number of seconds between two digests of created cards to the same recipient (alerts are sent right away)
+notifyDigestSecondsEnvVar = float(os.environ.get('notifyDigestSeconds', '3600'))
+# Highest number of digests sent by one invocation
+notifyMaxDigestsEnvVar = int(os.environ.get('notifyMaxDigests', '20'))
+# Events of the invocation, mailed at its end - shared by the worker threads
+notifier = DigestNotifier(loadRecipients(notifyRecipientsEnvVar, recipientEmailEnvVar), notifyRepeatSecondsEnvVar,
+                          notifyDigestSecondsEnvVar, notifyMaxDigestsEnvVar)
+
+
+# Profiling Variables #######
+# Profiling modes of every invocation ("cpu", "memory" or "cpu,memory"), "" to profile only the events with a "profile" field
+profileInvocationsEnvVar = os.environ.get('profileInvocations', '')
+# S3 prefix of the profiling results, Example: "Profiles/<invocation ID>/cpu.prof"
+profileS3PrefixEnvVar = os.environ.get('profileS3Prefix', 'Profiles/')
+# Local directory of the profiling results instead of S3 (local runs)
+profileDirectoryEnvVar = os.environ.get('profileDirectory')
 
 
 # VSTS Work Item Card Creation Variables #######
 # Project Names
 Project_GTS = "Architecture"
+# Area Path of the work items
+AreaPath_GTS = 'GTS Architecture\\Architecture'
 
 # Work item types
 REQUEST = "Request"
 PBI = "Product Backlog Item"
 
+# Optional service root of the VSTS REST API (Azure DevOps Server or a local stand-in), default: "https://" + vstsWIAccount
+vstsBaseUrlEnvVar = os.environ.get('vstsBaseUrl')
+
+# Number of emails whose work items are created by a single $batch call (2 cards per email)
+vstsEmailsPerBatchEnvVar = min(max(int(os.environ.get('vstsEmailsPerBatch', '1')), 1), MAX_BATCH_REQUESTS // 2)
+# Number of email chunks whose work items are created at the same time
+maxConcurrencyEnvVar = max(int(os.environ.get('maxConcurrency', '4')), 1)
+# Highest number of VSTS requests in flight; the client lowers it while Azure DevOps throttles and raises it back afterwards
+vstsMaxInFlightEnvVar = max(int(os.environ.get('vstsMaxInFlight', str(4 * maxConcurrencyEnvVar))), 1)
+# Number of times a throttled or failed VSTS request is sent again
+vstsMaxRetriesEnvVar = max(int(os.environ.get('vstsMaxRetries', '5')), 0)
+# Age, in days, of the oldest work items checked by the link repair
+linkRepairDaysEnvVar = int(os.environ.get('linkRepairDays', '30'))
+
+
+# Routing Variables #######
+# JSON routing table (see routes.loadRoutes), inline or as an S3 object; without one the single route below is used
+routesConfigEnvVar = os.environ.get('routesConfig')
+routesConfigS3KeyEnvVar = os.environ.get('routesConfigS3Key')
+# The single route of the original deployment, also the defaults of every configured route
+defaultRouteAttributes = {
+    "name": "default",
+    "mailbox": "INBOX",
+    "sender": scEmailSearchEnvVar,
+    "subjectPattern": "^TASK",
+    "project": Project_GTS,
+    "areaPath": AreaPath_GTS,
+    "requestType": REQUEST,
+    "pbiType": PBI,
+    "archiveMailbox": archiveMailbox,
+    "stateKey": s3_path_runState,
+    "errorMailbox": errorMailboxEnvVar,
+}
+# Routing table and per-route run state stores, built on first use and kept by the warm container
+routeTable = RouteTable(
+    lambda: routesConfigEnvVar or (s3_Read_Str_from_TXT_File(bucket_name, routesConfigS3KeyEnvVar) if routesConfigS3KeyEnvVar else None),
+    defaultRouteAttributes,
+    lambda stateKey: RunStateStore(s3.meta.client, bucket_name, stateKey, "/tmp/" + stateKey))
+routeTable.onLoad = lambda routes: invocationMetrics.debug("Routes: " + ", ".join(repr(route) for route in routes))
+
+
+# Lambda Time Budget Variables #######
+# Seconds kept in reserve after the last email for archiving, writing the run state and the token alert
+deadlineSafetySecondsEnvVar = float(os.environ.get('deadlineSafetySeconds', '30'))
+# Estimated seconds per email until the run state holds a measured value
+defaultEmailSecondsEnvVar = float(os.environ.get('defaultEmailSeconds', '2'))
+# Number of times in a row the function may re-invoke itself to drain a backlog (0 disables the re-invocation)
+maxResumeChainEnvVar = int(os.environ.get('maxResumeChain', '10'))
+
 
 def s3_Read_Str_from_TXT_File(bucket_name, s3_pathToFile):
     """
@@ -105,9 +375,9 @@ def s3_Read_Str_from_TXT_File(bucket_name, s3_pathToFile):
     return contents
 
 
-def s3_Write_IDNum_To_TXT_File(bucket_name, s3_pathToFile, workIDNumber):
+def s3_Read_Optional_Str_from_TXT_File(bucket_name, s3_pathToFile):
     """
-    Writes the most recent work id number back to the S3 Bucket
+    Reads file contents from AWS S3 Bucket, returning None when the file does not exist yet
 
     Parameters:
     ----------
@@ -115,40 +385,46 @@ def s3_Write_IDNum_To_TXT_File(bucket_name, s3_pathToFile, workIDNumber):
         AWS S3 Storage Bucket Name
     s3_pathToFile : str
         Path to reach file
-    IDNum : int
-    ----------
 
     Returns:
     ----------
-    Successful write of IDNum to .txt file
-    ----------
+    contents : str
     """
-    idNumToString = str(workIDNumber)
-    encoded_idNum = idNumToString.encode("utf-8")
-    s3.Bucket(bucket_name).put_object(Key=s3_pathToFile, Body=encoded_idNum)
+    try:
+        return s3_Read_Str_from_TXT_File(bucket_name, s3_pathToFile)
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
 
 
-def s3_Write_Str_To_TXT_File(bucket_name, s3_pathToFile, strToWrite):
+def loadRunState(state):
     """
-    Writes the input string to the input S3 Bucket
+    Reads the run state for this invocation.
+    The first time the JSON state is created it is seeded from the legacy .txt files in the S3 Bucket.
 
     Parameters:
     ----------
-    bucket_name : str
-        AWS S3 Storage Bucket Name
-    s3_pathToFile : str
-        Path to reach file
-    strToWrite : str
+    state : object
+        Run state store
     ----------
 
     Returns:
     ----------
-    Successful write of 'strToWrite' to .txt file
-    ----------
+    None
     """
-    strToWrite = str(strToWrite)
-    encoded_str = strToWrite.encode("utf-8")
-    s3.Bucket(bucket_name).put_object(Key=s3_pathToFile, Body=encoded_str)
+    if state.load():
+        return
+    print("No run state found, seeding it from the legacy .txt files")
+    workIDNumber = s3_Read_Optional_Str_from_TXT_File(bucket_name, s3_path_idNum)
+    if workIDNumber:
+        state.setMax("workItemIDNumber", int(workIDNumber))
+    emailSendDate = s3_Read_Optional_Str_from_TXT_File(bucket_name, s3_path_emailSendDate)
+    if emailSendDate:
+        state.set("tokenEmailSendDate", emailSendDate.strip())
+    watermarkUIDValidity, lastUID = parseUIDWatermark(s3_Read_Optional_Str_from_TXT_File(bucket_name, s3_path_uidWatermark))
+    if watermarkUIDValidity is not None:
+        state.setWatermark("imapUIDWatermark", watermarkUIDValidity, lastUID)
 
 
 def dateDifCalculator(dateStrFormat):
@@ -170,20 +446,20 @@ def dateDifCalculator(dateStrFormat):
     dayFiltered = YearMonthDayRaw.split("Day:")[1].strip()
     YearMonthRaw = YearMonthDayRaw.split("Day:")[0].strip()
     day = int(dayFiltered)
-    print(day)
+    invocationMetrics.debug(str(day))
 
     MonthFiltered = YearMonthRaw.split("Month:")[1].strip()
     YearRaw = YearMonthRaw.split("Month:")[0].strip()
     month = int(MonthFiltered)
-    print(month)
+    invocationMetrics.debug(str(month))
 
     YearFiltered = YearRaw.split("Year:")[1].strip()
     year = int(YearFiltered)
-    print(year)
+    invocationMetrics.debug(str(year))
 
     tokenChangeDate = datetime(year, month, day)
     daysSinceChangeObject = abs(datetime.now() - tokenChangeDate)
-    print(daysSinceChangeObject)
+    invocationMetrics.debug(str(daysSinceChangeObject))
 
     daysSinceChangeInteger = int(daysSinceChangeObject.days)
 
@@ -215,6 +491,81 @@ def tokenChangeAlarm(dateDifInt):
     return NeedToSendEmail
 
 
+def smtpSession(emailHost, emailUserName, emailPassword):
+    """
+    Returns the authenticated SMTP session, reusing the one of an earlier invocation while it still answers NOOP
+
+    Parameters:
+    ----------
+    emailHost : str
+    emailUserName : str
+    emailPassword : str
+    ----------
+
+    Returns:
+    ----------
+    mailserver : object
+    """
+    def smtpConnection():
+        # establish SMTP mail server object over port 587, later to be secured with TLS encryption
+        mailserver = smtplib.SMTP(emailHost, 587)
+        # identify ourselves to smtp mail client
+        mailserver.ehlo()
+        # secure our email with tls encryption
+        mailserver.starttls()
+        # re-identify ourselves as an encrypted connection
+        mailserver.ehlo()
+        # login to mail server account
+        mailserver.login(emailUserName, emailPassword)
+        return mailserver
+
+    return connectionManager.get("smtp", (emailHost, emailUserName), smtpConnection, smtpIsAlive,
+                                 lambda server: server.close())
+
+
+def sendEmails(emailHost, emailUserName, emailPassword, senderEmailAddress, messages):
+    """
+    Sends several emails over a single SMTP session; a session that dropped is re-established once.
+
+    Parameters:
+    ----------
+    emailHost : str
+    emailUserName : str
+    emailPassword : str
+    senderEmailAddress : str
+    messages : list of (recipientEmailAddress, emailSubject, emailBody) tuples
+    ----------
+
+    Returns:
+    ----------
+    sentTo : list of str
+        Recipients of the emails that were sent
+    """
+    smtpKey = (emailHost, emailUserName)
+    sentTo = []
+    reconnected = False
+    for recipientEmailAddress, emailSubject, emailBody in messages:
+        msg = MIMEMultipart()
+        msg['From'] = senderEmailAddress
+        msg['To'] = recipientEmailAddress
+        msg['Subject'] = emailSubject
+        msg.attach(MIMEText(emailBody))
+        while True:
+            mailserver = smtpSession(emailHost, emailUserName, emailPassword)
+            try:
+                # send email
+                mailserver.sendmail(senderEmailAddress, recipientEmailAddress, msg.as_string())
+                break
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # the session is left open for the next email instead of quitting - drop it when it failed
+                connectionManager.discard("smtp", smtpKey, lambda server: server.close())
+                if reconnected:
+                    raise
+                reconnected = True
+        sentTo.append(recipientEmailAddress)
+    return sentTo
+
+
 def sendEmail(emailHost, emailUserName, emailPassword, senderEmailAddress, recipientEmailAddress, emailSubject, emailBody):
     """
     This function sends an email.
@@ -233,28 +584,7 @@ def sendEmail(emailHost, emailUserName, emailPassword, senderEmailAddress, recip
     ----------
     None
     """
-
-    msg = MIMEMultipart()
-    msg['From'] = senderEmailAddress
-    msg['To'] = recipientEmailAddress
-    msg['Subject'] = emailSubject
-    message = emailBody
-    msg.attach(MIMEText(message))
-
-    # establish SMTP mail server object over port 587, later to be secured with TLS encryption
-    mailserver = smtplib.SMTP(emailHost, 587)
-    # identify ourselves to smtp mail client
-    mailserver.ehlo()
-    # secure our email with tls encryption
-    mailserver.starttls()
-    # re-identify ourselves as an encrypted connection
-    mailserver.ehlo()
-    # login to mail server account
-    mailserver.login(emailUserName, emailPassword)
-    # send email
-    mailserver.sendmail(senderEmailAddress, recipientEmailAddress, msg.as_string())
-    # disconnect from the mail server
-    mailserver.quit()
+    sendEmails(emailHost, emailUserName, emailPassword, senderEmailAddress, [(recipientEmailAddress, emailSubject, emailBody)])
 
 
 def email_Connection(emailHost, emailUserName, emailPassword, mailbox):
@@ -276,10 +606,15 @@ def email_Connection(emailHost, emailUserName, emailPassword, mailbox):
     Successful connection to to email account and mailbox
     ----------
     """
-    mail = imaplib.IMAP4_SSL(emailHost)  # email host name
+    if imapSSLEnvVar:
+        mail = MeteredIMAP4_SSL(emailHost, imapPortEnvVar or imaplib.IMAP4_SSL_PORT)  # email host name
+    else:
+        # plain IMAP, for a local IMAP stand-in only
+        mail = MeteredIMAP4(emailHost, imapPortEnvVar or imaplib.IMAP4_PORT)
 
     # Email account credentials
-    mail.login(emailUserName, emailPassword)  # email username and password
+    typ, data = mail.login(emailUserName, emailPassword)  # email username and password
+    refreshCapabilities(mail, data)
 
     # Connect to mailbox.
     mail.select(mailbox)
@@ -287,19 +622,73 @@ def email_Connection(emailHost, emailUserName, emailPassword, mailbox):
     return mail
 
 
-def email_Disconnect(mail):
+def refreshCapabilities(mail, loginData):
     """
-    Disconnects from the email account by closing the active mailbox and shutting down connection to the server (logging out)
+    Replaces the capabilities imaplib read from the greeting with the ones of the authenticated session: most servers
+    only advertise MOVE, UIDPLUS or IDLE after LOGIN. They are kept on the connection, so a pooled session reuses them.
+    The [CAPABILITY ...] response code of the LOGIN completion is used when the server sends one, otherwise they are
+    asked for with one CAPABILITY command.
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection, logged in
+    loginData : list of bytes
+        Data of the LOGIN completion, Example: [b'[CAPABILITY IMAP4rev1 MOVE] Logged in']
+    ----------
+
+    Returns:
+    ----------
+    capabilities : tuple of str
     """
-    # Close currently selected mailbox - Deleted messages are removed from writable mailbox
-    mail.close()
-    # Shutdown connection to server
-    mail.logout()
+    match = re.match(rb'\[CAPABILITY ([^\]]*)\]', (loginData or [b""])[-1] or b"")
+    if match is not None:
+        capabilityStr = match.group(1)
+    else:
+        typ, data = mail.capability()
+        if typ != 'OK' or not data or not data[-1]:
+            return mail.capabilities
+        capabilityStr = data[-1]
+    mail.capabilities = tuple(capabilityStr.decode("ascii", "replace").upper().split())
+    return mail.capabilities
 
 
-def VSTS_Client_Connection(vstsAccount, vstsAccountToken):
+def pooledEmailConnection(emailHost, emailUserName, mailbox, routeName="default"):
     """
-    Logs into the VSTS account
+    Returns the IMAP session of an earlier (warm) invocation when it still answers NOOP, otherwise logs in again.
+    The password is only decrypted when a new session has to be established.
+
+    Parameters:
+    ----------
+    emailHost: str
+    emailUserName : str
+    mailbox : str
+    routeName : str
+        Every route gets a session of its own, since the routes are processed in parallel
+    ----------
+
+    Returns:
+    ----------
+    mail : object
+        IMAP Email Account Connection, with 'mailbox' selected
+    """
+    return connectionManager.get(
+        "imap", (emailHost, emailUserName, mailbox, routeName),
+        lambda: email_Connection(emailHost, emailUserName, secretsProvider.getSecret('emailPassword'), mailbox),
+        imapIsAlive, lambda mail: mail.shutdown())
+
+
+def discardEmailConnection(emailHost, emailUserName, mailbox, routeName="default"):
+    """
+    Drops the pooled IMAP session after an error left it in an unknown state, so the next invocation logs in again
+    """
+    connectionManager.discard("imap", (emailHost, emailUserName, mailbox, routeName), lambda mail: mail.shutdown())
+
+
+def VSTS_Rest_Client_Connection(vstsAccount, vstsAccountToken):
+    """
+    Returns the VSTS REST API client of the warm container, so its keep-alive HTTP connections are reused across invocations.
+    A rotated token gets a client (and connection pool) of its own, and the client of the old token is closed.
 
     Parameters:
     ----------
@@ -309,12 +698,29 @@ def VSTS_Client_Connection(vstsAccount, vstsAccountToken):
 
     Returns:
     ----------
-    Successful client connection to to VSTS account
-    ----------
+    restClient : object
+        VSTS REST API connection
     """
-    client_GTS = VstsClient(vstsAccount, vstsAccountToken)
+    def restClientConnection():
+        restClient = VstsRestClient(vstsAccount, vstsAccountToken, vstsBaseUrlEnvVar,
+                                    maxInFlight=vstsMaxInFlightEnvVar, maxRetries=vstsMaxRetriesEnvVar)
+        restClient.onRequest = countVstsRequest
+        return restClient
+
+    return connectionManager.get("vsts", (vstsAccount, vstsAccountToken), restClientConnection,
+                                 close=lambda restClient: restClient.close(), exclusive=True)
 
-    return client_GTS
+
+def countVstsRequest(method, path, status, seconds):
+    """
+    Counts a VSTS REST API call (and its failure or throttling) in the metrics of the invocation
+    """
+    invocationMetrics.count("VSTSCalls")
+    if status is None or status >= 400:
+        invocationMetrics.count("VSTSErrors")
+    if status in (429, 503):
+        invocationMetrics.count("VSTSThrottled")
+    invocationMetrics.debug("VSTS " + method + " " + path + " -> " + str(status) + " in " + str(round(seconds * 1000)) + " ms")
 
 
 def Email_Search(mail, emailAddressToSearch, numDaysToSearchBeforeToday=0):
@@ -355,310 +761,1661 @@ def Email_Search(mail, emailAddressToSearch, numDaysToSearchBeforeToday=0):
         listOfUIDLists.append(uidListCooked)
         i += 1
 
-    # Searches and prints all email uids in mailbox
-    allUIDs = mail.uid('search', None, "ALL")  # search and return uids instead
-    print("\nAll UIDs:")
-    print(allUIDs)
-
-    # Searches for Unread messages
-    unread = mail.search(None, '(UNSEEN)')
-    print("UNREAD MESSAGES:")
-    print(unread)
-
-    # Searches and prints all email uids in mailbox from SC email
-    scUIDs = mail.search(None, '(HEADER From \"<' + emailAddressToSearch + '>\")')
-    print("\nSC UIDs:")
-    print(scUIDs)
-
     # Concatenates the 'Today' and 'Yesteday' email ID lists
     for uidList in listOfUIDLists:
         FullUIDListRaw = FullUIDListRaw + uidList
-    print("\nFullUIDListRaw:")
-    print(FullUIDListRaw)
 
     # Filters Null elements out of the concatenated list
     FullUIDListFiltered = list(filter(lambda a: a != '', FullUIDListRaw))
-    print("\nFullUIDListFiltered:")
-    print(FullUIDListFiltered)
+    print("\nFullUIDListFiltered: " + str(len(FullUIDListFiltered)) + " UIDs")
 
     return FullUIDListFiltered
 
 
-def messageData(mail, UIDNum):
+def mailboxUIDValidity(mail, mailbox):
     """
-    Acquire the Email Inbox Number for Current Message from UIDNum (for deletion of the email after processing),
-    Acquire message data, Obtain Message Subject, then process and filter
+    Returns the UIDVALIDITY value of the selected mailbox.
+    The value is taken from the SELECT response when available, otherwise a STATUS command is issued.
 
     Parameters:
     ----------
     mail : object
         IMAP Email Account Connection
-    UIDNum : String
-        Email Message ID Number
-
-    Returns:
-    ----------
-    emailInboxNumAsBytes : byte
-        For deletion of message
-    Subject : str
-        For creation of Work Item Card
-    filtered_body : str
-        For creation of Work Item Card
-    """
-    # Acquires message data as tuple
-    data = mail.uid('fetch', UIDNum, '(RFC822)')
-    print(data)
-    if data[0] == "OK":
-        # Acquire the Email Inbox Number for Current Message for later deletion - Literally what number
-        # (1 through 'Number of emails') email (in order from oldest to newest) this is in the Inbox
-        emailInboxNum = data[1][0][0].decode("utf-8").split(" ")[0]
-        # Acquire email contents for processing
-        raw_email = data[1][0][1].decode("utf-8")
-    else:
-        # Acquire the Email Inbox Number for Current Message for later deletion - Literally what number
-        # (1 through 'Number of emails') email (in order from oldest to newest) this is in the Inbox
-        emailInboxNum = data[0][0].decode("utf-8").split(" ")[0]
-        # Acquire email contents for processing
-        raw_email = data[0][1].decode("utf-8")
-    emailInboxNumAsBytes = bytes(emailInboxNum, 'utf-8')
-    body_email = raw_email.split("MIME-Version: 1.0")[1]
-    Subject = raw_email.split("Subject: ")[1].split("Content-Type: ")[0]
-    # Leave the final, filtered body with HTML tags for formatting purposes
-    filtered_body = body_email.replace("=", "").replace("\r", "").replace("\n", "").replace("\t", "")
+    mailbox : str
+    ----------
 
-    return emailInboxNumAsBytes, Subject, filtered_body
+    Returns:
+    ----------
+    uidValidity : int
+    """
+    typ, data = mail.response('UIDVALIDITY')
+    if data[0] is None:
+        typ, data = mail.status(mailbox, '(UIDVALIDITY)')
+        data = [re.search(rb'UIDVALIDITY (\d+)', data[0]).group(1)]
+    return int(data[-1])
 
 
-def WICardData(filtered_body, Subject):
+def parseUIDWatermark(watermarkStr):
     """
-    Generate data for VSTS Work Item Card
+    Parses the IMAP UID watermark string stored in the S3 Bucket
 
     Parameters:
     ----------
-    filtered_body : str
-        Filtered body of email message
-    Subject : str
-        Subject of email message
+    watermarkStr : str
+        Example: "UIDVALIDITY: 1536272042 UID: 5120"
 
     Returns:
     ----------
-    TITLE, DESCRIPTION, TASK, GBL_Exists, GBL, PYXIS_Exists, PYXIS : tuple
-        Tuple of all the data needed for the Work ID Card JSON Document
+    uidValidity, lastUID : tuple
+        (None, 0) when the string is empty or malformed
     """
-    # Description for VSTS Work Item
-    DESCRIPTION = filtered_body
-    # Title for VSTS Work Item
-    try:
-        TITLE = filtered_body.split("Request Name: ")[1].split("<br>")[0]
-    except IndexError:
-        TITLE = "NEW VSTS WORK ITEM"
-    # GBL Number for VSTS Work Item
-    if filtered_body.find("GBL#: ") > -1:
-        GBL = filtered_body.split("GBL#: ")[1].split("<br>")[0]
-        GBL_Exists = True
-    else:
-        GBL_Exists = False
-    # Pyxis Number for VSTS Work Item
-    if filtered_body.find("PyxIS#: ") > -1:
-        PYXIS = filtered_body.split("PyxIS#: ")[1].split("<br>")[0]
-        PYXIS_Exists = True
+    match = re.search(r'UIDVALIDITY:\s*(\d+)\s+UID:\s*(\d+)', watermarkStr or "")
+    if match is None:
+        return None, 0
+    return int(match.group(1)), int(match.group(2))
+
+
+def advanceUIDWatermark(lastUID, UIDList, unprocessedUIDs):
+    """
+    Returns the new highest processed UID: the highest UID examined, but never at or past an Intake Request
+    that is still waiting in the INBOX, so that message is found again by the next incremental search
+
+    Parameters:
+    ----------
+    lastUID : int
+        Current watermark
+    UIDList : list of str
+        UIDs examined by this run
+    unprocessedUIDs : set of str
+        UIDs of the Intake Requests whose work items could not be created
+    ----------
+
+    Returns:
+    ----------
+    highestUID : int
+    """
+    highestUID = max([lastUID] + [int(uid) for uid in UIDList])
+    if unprocessedUIDs:
+        highestUID = min(highestUID, min(int(uid) for uid in unprocessedUIDs) - 1)
+    return max(highestUID, lastUID)
+
+
+def countEmailFailures(state, uidValidity, failedUIDs, processedUIDs):
+    """
+    Counts one more failed run for every email of 'failedUIDs' in the 'emailFailures' entry of the run state
+    (Example: {"1536272042:5121": 2}) and forgets the counts of the processed emails and of an earlier UIDVALIDITY
+
+    Parameters:
+    ----------
+    state : object
+        Run state store of the route
+    uidValidity : int
+    failedUIDs : set of str
+        UIDs of the Intake Requests that were admitted by this run but not processed
+    processedUIDs : list of str
+    ----------
+
+    Returns:
+    ----------
+    exhaustedUIDs : list of str
+        UIDs that have now failed 'maxEmailFailures' runs, whose counts are forgotten too
+    """
+    if maxEmailFailuresEnvVar <= 0:
+        return []
+    prefix = str(uidValidity) + ":"
+    counts = state.get("emailFailures") or {}
+    newCounts = dict((prefix + UIDNum, (counts.get(prefix + UIDNum) or 0) + 1) for UIDNum in failedUIDs)
+    if newCounts:
+        state.setMaxEntries("emailFailures", newCounts)
+    exhaustedUIDs = sorted([UIDNum for UIDNum in failedUIDs if newCounts[prefix + UIDNum] >= maxEmailFailuresEnvVar], key=int)
+    staleKeys = [key for key in counts if not key.startswith(prefix)] + [prefix + UIDNum for UIDNum in processedUIDs if prefix + UIDNum in counts]
+    staleKeys += [prefix + UIDNum for UIDNum in exhaustedUIDs]
+    if staleKeys:
+        state.removeKeys("emailFailures", staleKeys)
+    return exhaustedUIDs
+
+
+def setAsideEmails(mail, route, UIDList):
+    """
+    Sets aside the Intake Requests that failed 'maxEmailFailures' runs, so they no longer hold back the UID watermark:
+    they are moved to the route's error mailbox when it has one (and left in the mailbox if the move fails),
+    the caller moves the watermark past them, and an alert is sent
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection, with the route's mailbox selected
+    route : Route
+    UIDList : list of str
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    location = "left in " + route.mailbox + ", past the UID watermark"
+    if route.errorMailbox:
+        try:
+            archiveMessages(mail, UIDList, route.errorMailbox)
+            location = "moved to " + route.errorMailbox
+        except imaplib.IMAP4.error as error:
+            print(route.name + ": the failed emails could not be moved to " + route.errorMailbox + ": " + repr(error))
+    print(route.name + ": " + str(len(UIDList)) + " Intake Requests failed " + str(maxEmailFailuresEnvVar) + " runs and were " + location)
+    notifier.record(CREATION_FAILED, route.name + ": UIDs " + ", ".join(UIDList) + " failed " + str(maxEmailFailuresEnvVar) +
+                    " runs and were " + location, "setAside:" + route.name + ":" + ",".join(UIDList))
+
+
+def Email_Search_Incremental(mail, emailAddressToSearch, uidValidity, watermarkUIDValidity, lastUID, numDaysToSearchBeforeToday=3):
+    """
+    Incremental search:
+    Issues a single UID SEARCH for the messages from 'emailAddressToSearch' that arrived after the last processed UID.
+    When the mailbox UIDVALIDITY differs from the stored one (or nothing is stored yet) the UIDs are meaningless,
+    so a single search bounded by a SINCE date window is issued instead.
+
+    Parameters:
+    ----------
+    mail : object
+    emailAddressToSearch : str
+    uidValidity : int
+        UIDVALIDITY of the selected mailbox
+    watermarkUIDValidity : int
+        UIDVALIDITY stored with the watermark, None if no watermark exists
+    lastUID : int
+        Highest UID already processed
+    numDaysToSearchBeforeToday : int
+        Size of the fallback date window
+    ----------
+
+    Returns:
+    ----------
+    List of UIDs that match search criteria, in ascending order
+    """
+    if watermarkUIDValidity == uidValidity:
+        criteria = ['UID', str(lastUID + 1) + ':*']
     else:
-        PYXIS_Exists = False
-    # TASK Number for VSTS Work Item
-    TASK = Subject.split("TASK")[1].split(" ")[0]
+        print("UIDVALIDITY changed (" + str(watermarkUIDValidity) + " -> " + str(uidValidity) + "), searching the last " + str(numDaysToSearchBeforeToday) + " days")
+        lastUID = 0
+        date_search = datetime.strftime(datetime.now() - timedelta(numDaysToSearchBeforeToday), "%d-%b-%Y")
+        criteria = ['SINCE', date_search]
+    typ, data = mail.uid('search', None, *(criteria + ['FROM', '"' + emailAddressToSearch + '"']))
+    # "n:*" always matches the newest message, even when its UID is below n, so UIDs are filtered against the watermark
+    UIDList = sorted(int(uid) for uid in data[0].split() if int(uid) > lastUID)
+    print("\nIncremental search: " + str(len(UIDList)) + " UIDs above " + str(lastUID))
 
-    return TITLE, DESCRIPTION, TASK, GBL_Exists, GBL, PYXIS_Exists, PYXIS
+    return [str(uid) for uid in UIDList]
 
 
-def createJsonWIDoc(WICardDataTuple):
+def parseFetchResponse(data):
     """
-    Creates JSON Patch Document for VSTS Work ID Card Creation
+    Groups the pieces of a multi-message (UID) FETCH response by message
+
+    imaplib returns a literal as a (prefix, literal) tuple and the text that follows it as plain bytes,
+    so the pieces are regrouped on the "<sequence number> (" that starts every message.
 
     Parameters:
     ----------
-    WICardDataTuple : tuple
-        Tuple of all the data needed for the Work ID Card JSON Document
+    data : list
+        Data part of the imaplib FETCH response
+    ----------
 
     Returns:
     ----------
-    doc : object
-        JSON Patch Document for VSTS Work ID Card Creation
+    List of (UIDNum, metadata, literals) : list
+        UIDNum : str
+        metadata : bytes
+            All non-literal text of the message response
+        literals : list of bytes
     """
-    # Work ID Tuple Elements for JSON Patch Document
-    TITLE = WICardDataTuple[0]
-    DESCRIPTION = WICardDataTuple[1]
-    TASK = WICardDataTuple[2]
-    GBL_Exists = WICardDataTuple[3]
-    GBL = WICardDataTuple[4]
-    PYXIS_Exists = WICardDataTuple[5]
-    PYXIS = WICardDataTuple[6]
+    messages = []
+    for item in data:
+        if item is None:
+            continue
+        prefix = item[0] if isinstance(item, tuple) else item
+        if re.match(rb'\d+ \(', prefix):
+            messages.append([prefix, []])
+        elif messages:
+            messages[-1][0] += prefix
+        else:
+            continue
+        if isinstance(item, tuple):
+            messages[-1][1].append(item[1])
+
+    parsed = []
+    for metadata, literals in messages:
+        uidMatch = re.search(rb'UID (\d+)', metadata)
+        if uidMatch is not None:
+            parsed.append((uidMatch.group(1).decode("ascii"), metadata, literals))
+    return parsed
+
 
-    # Create a JsonPatchDocument and provide the values for the work item fields
-    doc = JsonPatchDocument()
-    doc.add(JsonPatchOperation('add', SystemFields.TITLE, TITLE))
-    doc.add(JsonPatchOperation('add', SystemFields.DESCRIPTION, DESCRIPTION))
-    # doc.add(JsonPatchOperation('add', GTSKanban.RITM, RITM))
-    doc.add(JsonPatchOperation('add', GTSKanban.TASK, TASK))
-    AreaPath = 'GTS Architecture\\Architecture'
-    doc.add(JsonPatchOperation('add', SystemFields.AREA_PATH, AreaPath))
-    if GBL_Exists:
-        doc.add(JsonPatchOperation('add', GTSKanban.GBL, GBL))
-    if PYXIS_Exists:
-        doc.add(JsonPatchOperation('add', GTSKanban.PYXIS, PYXIS))
+# One token of an IMAP response: parenthesis, quoted string, literal marker or atom
+IMAP_TOKEN_PATTERN = re.compile(rb'(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}|([^\s()"{]+)')
 
-    return doc
 
+def parseIMAPList(metadata, literals):
+    """
+    Parses the text of a FETCH response into nested lists, Example:
+        b'1 (UID 7 BODYSTRUCTURE ("text" "html" ("charset" "utf-8") NIL NIL "base64" 1024 14 NIL NIL NIL))'
+        -> ['1', ['UID', '7', 'BODYSTRUCTURE', ['text', 'html', ['charset', 'utf-8'], None, None, 'base64', '1024', '14', None, None, None]]]
+
+    Parameters:
+    ----------
+    metadata : bytes
+        Non-literal text of the response, as returned by parseFetchResponse
+    literals : list of bytes
+        Literals of the response, in order - each one stands for a "{size}" marker of 'metadata'
+    ----------
 
-def parentToChildConnection(vstsClient, workIDNumber, WICardDataTuple):
+    Returns:
+    ----------
+    items : list
+        str for quoted strings, literals and atoms, None for NIL
     """
-    Iterates through the work items to find the 2 that were just created in order to create the parent/child connection.
+    stack = [[]]
+    literalIterator = iter(literals)
+    for match in IMAP_TOKEN_PATTERN.finditer(metadata):
+        openParenthesis, closeParenthesis, quoted, literalSize, atom = match.groups()
+        if openParenthesis:
+            stack.append([])
+        elif closeParenthesis:
+            if len(stack) > 1:
+                closed = stack.pop()
+                stack[-1].append(closed)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode("utf-8", "replace"))
+        elif literalSize is not None:
+            stack[-1].append(next(literalIterator, b"").decode("utf-8", "replace"))
+        else:
+            stack[-1].append(None if atom.upper() == b"NIL" else atom.decode("utf-8", "replace"))
+    return stack[0]
 
-    There are a few ways to shorten this code and combine blocks and snippets. I have them separated for debugging. I have different 'checks'
-    in place to help with confirming the exact issue.
+
+def fetchItem(items, name):
+    """
+    Returns the value of a FETCH data item (Example: "BODYSTRUCTURE") from the response parsed by parseIMAPList, None when absent
+    """
+    for item in items:
+        if isinstance(item, list):
+            for index in range(0, len(item) - 1):
+                if str(item[index]).upper() == name:
+                    return item[index + 1]
+    return None
+
+
+def chunkList(items, chunkSize):
+    """
+    Splits a list into consecutive chunks of at most 'chunkSize' elements
+    """
+    return [items[i:i + chunkSize] for i in range(0, len(items), chunkSize)]
+
+
+def fetchSubjects(mail, UIDList):
+    """
+    Phase 1 of the message fetch:
+    Fetches only the Subject header of every candidate message with one pipelined UID FETCH per chunk of UIDs
 
     Parameters:
     ----------
-    workIDNumber : int
-        Read from S3 Bucket -> Last Work Item to be created
-    WICardDataTuple : tuple
-        Tuple of all the data needed for the Work ID Card JSON Document
+    mail : object
+        IMAP Email Account Connection
+    UIDList : list of str
+    ----------
 
     Returns:
     ----------
-    Successful Creation of Work Item Parent/Child Connection
+    subjects : dict
+        UIDNum -> decoded Subject
     """
-    TASK = WICardDataTuple[2]
-    i = workIDNumber
-    foundREQUEST = False
-    foundPBI = False
-    while foundREQUEST is False or foundPBI is False:
-        try:
-            checkingWI = vstsClient.get_workitem(i)
-            workItemExists = True
-            print(checkingWI)
-        except HTTPError:
-            workItemExists = False
-            print("Passed - HTTPError Exception: Workitem " + str(i) + " does not exist")
-            pass
-        if workItemExists:
-            try:
-                if "GTSKanban.TASK" in checkingWI.fields:
-                    if checkingWI.fields["GTSKanban.TASK"] == TASK:
-                        if checkingWI.fields["System.WorkItemType"] == REQUEST or foundREQUEST is False:
-                            foundREQUEST = True
-                            print("\t" + "\t" + "We found the REQUEST Work Item")
-                            REQUEST_WIID = checkingWI.fields["System.Id"]
-                        elif checkingWI.fields["System.WorkItemType"] == PBI or foundPBI is False:
-                            foundPBI = True
-                            print("\t" + "\t" + "We found the PBI Work Item")
-                            PBI_WIID = checkingWI.fields["System.Id"]
-                        print("\t" + "\t" + str(checkingWI.fields["System.Id"]))
-                        print("\t" + "\t" + checkingWI.fields["GTSKanban.TASK"])
-                        print("\t" + "\t" + checkingWI.fields["System.Title"])
-                        # write the most recent work id number back to the S3 Bucket
-                        # the purpose of this block of code is to save the most recent work item ID number in an S3 bucket, this way
-                        # when the program is run it does not have to iterate from a set start ID number in the program, but the last
-                        # ID number called in the program. This matters for both efficiency and the time it takes for the program to complete.
-                        # Since the AWS Lambda function will timeout after 15 minutes, it's important to have the program finish as quickly as possible.
-                        s3_Write_IDNum_To_TXT_File(bucket_name, s3_path_idNum, checkingWI.fields["System.Id"])
-                    else:
-                        print(checkingWI.fields["System.Id"])
-                        if "GTSKanban.TASK" in checkingWI.fields:
-                            print("\t" + checkingWI.fields["GTSKanban.TASK"])
+    subjects = {}
+    for UIDChunk in chunkList(UIDList, imapFetchBatchSize):
+        typ, data = mail.uid('fetch', ",".join(UIDChunk), '(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+        for UIDNum, metadata, literals in parseFetchResponse(data):
+            headers = BytesHeaderParser().parsebytes(b"".join(literals))
+            subjects[UIDNum] = str(make_header(decode_header(headers.get('Subject', ""))))
+    return subjects
+
+
+def fetchMessageBodies(mail, UIDList, subjects):
+    """
+    Phase 2 of the message fetch:
+    For every chunk of UIDs that survived the Subject filter, one UID FETCH reads the BODYSTRUCTURE of the messages,
+    which locates their HTML part (text/plain as a fallback). Then one UID FETCH per distinct part number downloads
+    only that part, cut at 'imapBodyByteCap' bytes with a partial fetch (BODY.PEEK[n]<0.cap>), so attachments and
+    embedded images are never transferred. The parts stay bytes until they are parsed.
+    Messages are yielded in UID order as each chunk arrives, so processing can start before the last chunk is fetched.
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection
+    UIDList : list of str
+    subjects : dict
+        UIDNum -> Subject, as returned by fetchSubjects
+    ----------
+
+    Yields:
+    ----------
+    record : IntakeRecord
+        Work Item Card data of the message, the raw message is not kept
+    """
+    partialRange = "<0." + str(imapBodyByteCapEnvVar) + ">" if imapBodyByteCapEnvVar else ""
+    for UIDChunk in chunkList(UIDList, imapFetchBatchSize):
+        with invocationMetrics.span("fetch"):
+            typ, data = mail.uid('fetch', ",".join(UIDChunk), '(UID BODYSTRUCTURE)')
+        textParts = {}
+        for UIDNum, metadata, literals in parseFetchResponse(data):
+            structure = fetchItem(parseIMAPList(metadata, literals), "BODYSTRUCTURE")
+            textParts[UIDNum] = findStructurePart(structure) if isinstance(structure, list) else None
+
+        # most messages of a chunk share the same layout, so this is usually a single FETCH
+        sectionUIDs = {}
+        for UIDNum in UIDChunk:
+            if textParts.get(UIDNum) is not None:
+                sectionUIDs.setdefault(textParts[UIDNum][0], []).append(UIDNum)
+        bodies = {}
+        for section, UIDs in sectionUIDs.items():
+            with invocationMetrics.span("fetch"):
+                typ, data = mail.uid('fetch', ",".join(UIDs), '(UID BODY.PEEK[' + section + ']' + partialRange + ')')
+            for UIDNum, metadata, literals in parseFetchResponse(data):
+                bodies[UIDNum] = b"".join(literals)
+
+        for UIDNum in UIDChunk:
+            if UIDNum not in textParts:
+                # deleted or moved since the search
+                continue
+            with invocationMetrics.span("parse"):
+                if textParts[UIDNum] is None:
+                    record = parseIntakePart(b"", UIDNum, subjects.get(UIDNum), "plain", "")
                 else:
-                    print(checkingWI.fields["System.Id"])
-                    if "GTSKanban.TASK" in checkingWI.fields:
-                        print("\t" + checkingWI.fields["GTSKanban.TASK"])
-            except UnboundLocalError:
-                print("Passed - UnboundLocalError Exception: Workitem " + str(i) + " does not exist")
-                pass
-        i = i + 1
-
-    request_WorkItemData = vstsClient.get_workitem(REQUEST_WIID)
-    pbi_WorkItemData = vstsClient.get_workitem(PBI_WIID)
-    # Create parent/child link between [Request (parent)] and [Product Backlog Item (child)]
-    vstsClient.add_link(pbi_WorkItemData.id, request_WorkItemData.id, LinkTypes.PARENT, "Parent/Child connection created automatically")
+                    section, subtype, transferEncoding, charset, size = textParts[UIDNum]
+                    truncated = bool(imapBodyByteCapEnvVar) and size > imapBodyByteCapEnvVar
+                    if truncated:
+                        print("Body of UID " + UIDNum + " cut from " + str(size) + " to " + str(imapBodyByteCapEnvVar) + " bytes")
+                        invocationMetrics.count("TruncatedBodies")
+                    record = parseIntakePart(bodies.pop(UIDNum, b""), UIDNum, subjects.get(UIDNum), subtype, transferEncoding, charset, truncated)
+            invocationMetrics.debug("Parsed UID " + UIDNum + ": " + repr(record) + " GBL=" + str(record.gbl) + " PyxIS=" + str(record.pyxis) + "\n" + record.description)
+            yield record
 
 
-def lambda_handler(event, context):
-    # Establish connection to mail server, login to account, and select INBOX to be working mailbox
-    mail = email_Connection(emailHostNameEnvVar, emailUserNameEnvVar, emailPasswordEnvVar, "INBOX")
-
-    # Initialize the VSTS client using the VSTS instance and personal access token
-    # *******THIS TOKEN NEEDS TO BE REPLACED/RENEWED/UPDATED YEARLY*******
-    client_GTS = VstsClient(vstsWIAccountEnvVar, vstsWIAcTokenEnvVar)  # account instance + account token
-    print(client_GTS)
-
-    # Search the INBOX for emails from SC from the current day's date and previous day's date
-    UID_List = Email_Search(mail, scEmailSearchEnvVar, 3)
-
-    # Iterates through list of qualifying UIDs, extracts message data, moves message from Inbox to Archive,
-    # creates Work ID Cards, reads/writes VSTS Work Item ID Number from/to S3 bucket, creates parent/child
-    # connection between respective Work ID Cards
-    for UIDNum in UID_List:
-        emailInboxNumAsBytes, Subject, filtered_body = messageData(mail, UIDNum)
-        # Checks to make sure the message is an Intake Request
-        if Subject[:4] == "TASK":
-            # Steps to Move a copy of SC Email to 'Archive/ServiceCafe' Folder - copy, store, expunge
-            # creates a copy of the current SC Email in the 'Archive/ServiceCafe' Folder
-            mail.copy(emailInboxNumAsBytes, 'Archive/ServiceCafe')
-            print('copied')
-            # Sets a flag for the original message to be deleted
-            mail.store(emailInboxNumAsBytes, '+FLAGS', '\\Deleted')
-            print('flagged')
-            # Deletes all messages with the 'Delete' flag
+def iterChunks(iterable, chunkSize):
+    """
+    Groups the elements of any iterable into lists of at most 'chunkSize' elements, consuming it lazily
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def archiveMessages(mail, UIDList, archiveMailbox):
+    """
+    Moves all processed messages to the archive mailbox in one step, addressing them by UID:
+        - UID MOVE when the server advertises the MOVE capability
+        - otherwise one UID COPY, one UID STORE +FLAGS \\Deleted and one (UID) EXPUNGE for the whole set
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection
+    UIDList : list of str
+    archiveMailbox : str
+        Example: 'Archive/ServiceCafe'
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    if not UIDList:
+        return
+    UIDSet = ",".join(UIDList)
+    if 'MOVE' in mail.capabilities:
+        typ, data = mail.uid('move', UIDSet, archiveMailbox)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error("UID MOVE to " + archiveMailbox + " failed: " + str(data))
+    else:
+        typ, data = mail.uid('copy', UIDSet, archiveMailbox)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error("UID COPY to " + archiveMailbox + " failed: " + str(data))
+        mail.uid('store', UIDSet, '+FLAGS', '(\\Deleted)')
+        # UID EXPUNGE (UIDPLUS) only removes the messages of this batch, plain EXPUNGE removes every message flagged as deleted
+        if 'UIDPLUS' in mail.capabilities:
+            mail.uid('expunge', UIDSet)
+        else:
             mail.expunge()
-            print('deleted')
-
-            # Generate data for VSTS Work Item Card as a Tuple
-            WICardDataTuple = WICardData(filtered_body, Subject)
-
-            # Creates JSON Patch Document for VSTS Work ID Card Creation
-            WIJsonPatchDoc = createJsonWIDoc(WICardDataTuple)
-            print("JSON Patch Document Created")
-            print('\n')
-            print(WIJsonPatchDoc)
-            print('\n')
-
-            # Create a new work item - REQUEST Card - by specifying the project and work item type
-            new_WorkitemREQUEST = client_GTS.create_workitem(
-                Project_GTS,                                # Working Team project name
-                REQUEST,                                    # Work item type (e.g. Epic, Feature, User Story etc.)
-                WIJsonPatchDoc)                             # JsonPatchDocument with operations
-            # Create a new work item - PBI (Product Backlog Item) Card - by specifying the project and work item type
-            new_WorkitemPBI = client_GTS.create_workitem(
-                Project_GTS,                                # Working Team project name
-                PBI,                                        # Work item type (e.g. Epic, Feature, User Story etc.)
-                WIJsonPatchDoc)                             # JsonPatchDocument with operations
-
-            # read file contents from AWS S3 Bucket to determine what ID Number to begin the iteratation process on
-            workIDNumber = int(s3_Read_Str_from_TXT_File(bucket_name, s3_path_idNum))
-            print(workIDNumber)
-
-            # iterates through the work items and creates a parent/child connection between the 2 that were just created
-            parentToChildConnection(client_GTS, workIDNumber, WICardDataTuple)
-
-    # Closes the active mailbox (INBOX) and shuts down connection to the server (logs out)
-    email_Disconnect(mail)
-
-    # this block of code checks the 'TOKEN_CHANGE_DATE' Environment Variable to see if an alert email needs to be sent out, then,
-    # if an alert does need to be sent, it checks to see the most recent time one was sent. If it was sent more than two days ago
-    # another email is sent. This occurs until the 'TOKEN_CHANGE_DATE' and the 'vstsWIAcToken' Environment Variables are updated.
+    print("Archived " + str(len(UIDList)) + " messages to " + archiveMailbox)
+
+
+def createWIPatchOperations(record, areaPath=AreaPath_GTS):
+    """
+    Creates the JSON Patch operations for VSTS Work ID Card Creation
+
+    Parameters:
+    ----------
+    record : IntakeRecord
+        All the data needed for the Work ID Card JSON Document
+    areaPath : str
+        Area Path of the work item, Example: 'GTS Architecture\\Architecture'
+
+    Returns:
+    ----------
+    operations : list of dict
+        JSON Patch operations, Example: {"op": "add", "path": "/fields/System.Title", "value": "..."}
+    """
+    # Provide the values for the work item fields
+    operations = []
+    operations.append({"op": "add", "path": SystemFields.TITLE, "value": record.title})
+    operations.append({"op": "add", "path": SystemFields.DESCRIPTION, "value": record.description})
+    # operations.append({"op": "add", "path": GTSKanban.RITM, "value": RITM})
+    operations.append({"op": "add", "path": GTSKanban.TASK, "value": record.task})
+    operations.append({"op": "add", "path": SystemFields.AREA_PATH, "value": areaPath})
+    if record.gbl is not None:
+        operations.append({"op": "add", "path": GTSKanban.GBL, "value": record.gbl})
+    if record.pyxis is not None:
+        operations.append({"op": "add", "path": GTSKanban.PYXIS, "value": record.pyxis})
+
+    return operations
+
+
+def createWorkItemPairsBatch(restClient, route, records):
+    """
+    Creates the Request card, the PBI card and their parent/child link for one or more emails with a single $batch call.
+
+    Each email gets two temporary negative IDs; the PBI creation carries a 'System.LinkTypes.Hierarchy-Reverse'
+    relation to the temporary ID of its Request, so the link is created within the same call.
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+        VSTS project, Area Path and work item types of the cards
+    records : list of IntakeRecord
+        Work ID Card data of each email, at most MAX_BATCH_REQUESTS / 2 emails
+    ----------
+
+    Returns:
+    ----------
+    List of (REQUEST_WIID, PBI_WIID) : list
+        One entry per email, in order; an ID Number is None when that card could not be created
+    """
+    subRequests = []
+    for index, record in enumerate(records):
+        operations = createWIPatchOperations(record, route.areaPath)
+        requestTempID = -(2 * index + 1)
+        pbiTempID = -(2 * index + 2)
+        subRequests.append(restClient.create_workitem_request(
+            route.project, route.requestType,
+            [{"op": "add", "path": "/id", "value": str(requestTempID)}] + operations))
+        subRequests.append(restClient.create_workitem_request(
+            route.project, route.pbiType,
+            [{"op": "add", "path": "/id", "value": str(pbiTempID)}] + operations +
+            [{"op": "add", "path": "/relations/-", "value": {
+                "rel": LinkTypes.PARENT,
+                "url": restClient.workitem_url(requestTempID),
+                "attributes": {"comment": "Parent/Child connection created automatically"}}}]))
+
+    responses = restClient.batch(subRequests)
+
+    createdIDs = []
+    for index in range(len(records)):
+        pairIDs = []
+        for code, body in responses[2 * index:2 * index + 2]:
+            if code == 200 and isinstance(body, dict):
+                pairIDs.append(body["id"])
+            else:
+                print("Work item creation failed for TASK" + records[index].task + ": " + str(code) + " " + str(body)[:500])
+                notifier.record(CREATION_FAILED, route.name + ": TASK" + records[index].task + " - " + str(code) + " " + str(body)[:200],
+                                "creationFailed:" + route.name + ":" + records[index].task)
+                pairIDs.append(None)
+        pairIDs += [None] * (2 - len(pairIDs))
+        createdIDs.append(tuple(pairIDs))
+    return createdIDs
+
+
+def findWorkItemIDByTask(restClient, project, TASK, workItemType):
+    """
+    Looks up the ID Number of the most recent work item of the given type carrying the given TASK Number through a single WIQL query.
+    Used when the ID Number returned by create_workitem is not available (for instance after a run crashed mid-way).
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    project : str
+        VSTS project name
+    TASK : str
+        TASK Number stored in the 'GTSKanban.TASK' field
+    workItemType : str
+        Example: "Request"
+    ----------
+
+    Returns:
+    ----------
+    workItemID : int
+        None when no matching work item exists
+    """
+    wiqlQuery = ("SELECT [System.Id] FROM WorkItems"
+                 " WHERE [System.TeamProject] = " + wiqlQuote(project) +
+                 " AND [System.WorkItemType] = " + wiqlQuote(workItemType) +
+                 " AND [GTSKanban.TASK] = " + wiqlQuote(TASK) +
+                 " ORDER BY [System.Id] DESC")
+    workItemIDs = restClient.query_workitem_ids(wiqlQuery, project)
+    if workItemIDs:
+        return workItemIDs[0]
+    return None
+
+
+def parentToChildConnection(restClient, route, record, REQUEST_WIID=None, PBI_WIID=None):
+    """
+    Creates the parent/child connection between the Request and PBI work items that were just created.
+
+    The ID Numbers returned by create_workitem are used directly; a missing ID Number is looked up with a WIQL query on
+    'GTSKanban.TASK' so the number of HTTP calls per email stays fixed no matter how far the account's ID counter has moved.
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+        VSTS project and work item types of the cards
+    record : IntakeRecord
+        All the data needed for the Work ID Card JSON Document
+    REQUEST_WIID : int
+        ID Number of the Request work item, if known
+    PBI_WIID : int
+        ID Number of the PBI work item, if known
+
+    Returns:
+    ----------
+    REQUEST_WIID, PBI_WIID : tuple
+        ID Numbers of the linked work items
+    """
+    TASK = record.task
+    if REQUEST_WIID is None:
+        REQUEST_WIID = findWorkItemIDByTask(restClient, route.project, TASK, route.requestType)
+    if PBI_WIID is None:
+        PBI_WIID = findWorkItemIDByTask(restClient, route.project, TASK, route.pbiType)
+    if REQUEST_WIID is None or PBI_WIID is None:
+        raise LookupError("Work items for TASK" + TASK + " not found - Request: " + str(REQUEST_WIID) + " PBI: " + str(PBI_WIID))
+
+    # Create parent/child link between [Request (parent)] and [Product Backlog Item (child)]
+    restClient.add_link(PBI_WIID, REQUEST_WIID, LinkTypes.PARENT, "Parent/Child connection created automatically")
+    invocationMetrics.debug("Linked Request " + str(REQUEST_WIID) + " (parent) and PBI " + str(PBI_WIID) + " (child) for TASK" + TASK)
+
+    return REQUEST_WIID, PBI_WIID
+
+
+def processIntakeChunk(restClient, route, messageChunk):
+    """
+    Creates the Work ID Cards and their parent/child connection for a chunk of Intake Request emails.
+    Runs on a worker thread of the intake pipeline, so it only talks to VSTS - never to the IMAP connection.
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+    messageChunk : list of IntakeRecord
+    ----------
+
+    Returns:
+    ----------
+    processedRecords : list of IntakeRecord
+        Emails whose work items exist and that can be archived
+    createdIDNumbers : list of int
+        ID Numbers of the work items created
+    """
+    # Creates the REQUEST Card, the PBI (Product Backlog Item) Card and their parent/child connection for every email of the chunk in one call
+    with invocationMetrics.span("create"):
+        createdIDs = createWorkItemPairsBatch(restClient, route, messageChunk)
+
+    processedRecords = []
+    createdIDNumbers = []
+    for record, (REQUEST_WIID, PBI_WIID) in zip(messageChunk, createdIDs):
+        if REQUEST_WIID is None:
+            # the email stays in the INBOX and is retried on the next run
+            continue
+        if PBI_WIID is None:
+            # Create the missing PBI Card on its own, then link it to its REQUEST Card.
+            # A failure only affects this email: the other emails of the chunk keep their work items and are archived.
+            try:
+                with invocationMetrics.span("create"):
+                    new_WorkitemPBI = restClient.create_workitem(
+                        route.project,                                      # Working Team project name
+                        route.pbiType,                                      # Work item type (e.g. Epic, Feature, User Story etc.)
+                        createWIPatchOperations(record, route.areaPath))    # JSON Patch operations
+            except VstsRestError as error:
+                print("PBI creation failed for TASK" + record.task + ", the email is retried on the next run: " + str(error))
+                notifier.record(CREATION_FAILED, route.name + ": PBI of TASK" + record.task + " (Request " + str(REQUEST_WIID) + ") - " + str(error)[:200],
+                                "creationFailed:" + route.name + ":" + record.task)
+                continue
+            PBI_WIID = new_WorkitemPBI["id"]
+            try:
+                with invocationMetrics.span("link"):
+                    parentToChildConnection(restClient, route, record, REQUEST_WIID, PBI_WIID)
+            except (VstsRestError, LookupError) as error:
+                # both cards exist, so the email is archived anyway - only the parent/child link is missing
+                print("Parent/child link failed for TASK" + record.task + " (Request " + str(REQUEST_WIID) +
+                      ", PBI " + str(PBI_WIID) + "): " + str(error))
+                notifier.record(LINK_FAILED, route.name + ": TASK" + record.task + " - Request " + str(REQUEST_WIID) + ", PBI " + str(PBI_WIID),
+                                "linkFailed:" + str(PBI_WIID))
+        invocationMetrics.debug("Created Request " + str(REQUEST_WIID) + " and PBI " + str(PBI_WIID) + " for TASK" + record.task)
+        notifier.record(CREATED, route.name + ": TASK" + record.task + " \"" + record.title + "\" - Request " + str(REQUEST_WIID) + ", PBI " + str(PBI_WIID))
+        processedRecords.append(record)
+        createdIDNumbers += [REQUEST_WIID, PBI_WIID]
+
+    return processedRecords, createdIDNumbers
+
+
+def isFollowUp(ledger, record, seenTasks):
+    """
+    Consults the processed-TASK ledger before any work item is created for an email.
+    An email whose TASK was seen earlier in the same poll, or that the ledger knows (a Bloom filter hit included), is a
+    follow-up (reminder, reassignment, update or a retried email): its cards are looked up in one batch once the new TASKs
+    of the poll are created, see applyFollowUps, instead of one WIQL query per email.
+
+    Parameters:
+    ----------
+    ledger : ProcessedTaskLedger
+    record : IntakeRecord
+    seenTasks : set
+        TASK Numbers already queued during this poll
+    ----------
+
+    Returns:
+    ----------
+    followUp : bool
+        Always False for an email without a TASK Number: there is no card to match it with, so it gets cards of its own
+    """
+    if not record.task:
+        return False
+    if record.task in seenTasks:
+        return True
+    return ledger.check(record.task) != ProcessedTaskLedger.NO
+
+
+# Work Item Card fields a follow-up email may change: the TASK Number and Area Path never change
+FOLLOW_UP_FIELDS = (SystemFields.TITLE, SystemFields.DESCRIPTION, GTSKanban.GBL, GTSKanban.PYXIS)
+
+
+def followUpFields(record):
+    """
+    Returns the field values of the Work Item Cards according to a follow-up email, by reference name
+    (Example: {"System.Title": "..."}); a field the email does not carry is left out, so it is never cleared
+    """
+    fields = {}
+    for operation in createWIPatchOperations(record):
+        if operation["path"] not in FOLLOW_UP_FIELDS:
+            continue
+        if operation["path"] == SystemFields.TITLE and operation["value"] == DEFAULT_TITLE:
+            continue
+        fields[operation["path"][len("/fields/"):]] = operation["value"]
+    return fields
+
+
+def loadTaskCards(restClient, route, tasks):
+    """
+    Builds the TASK -> cards index of the TASKs of a poll with one paged WIQL query per 100 TASKs and one workitemsbatch
+    call per MAX_WORKITEMS_BATCH cards, reading only the fields a follow-up may change
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+    tasks : list of str
+    ----------
+
+    Returns:
+    ----------
+    cards : dict
+        TASK -> {work item type: work item}, the most recent card of each type
+    """
+    wanted = set(tasks)
+    workItemIDs = []
+    for taskChunk in chunkList(sorted(wanted), 100):
+        workItemIDs += queryWorkItemIDsPaged(restClient, route.project,
+                                             " AND [System.WorkItemType] IN (" + wiqlQuote(route.requestType) + ", " + wiqlQuote(route.pbiType) + ")" +
+                                             " AND [GTSKanban.TASK] IN (" + ", ".join(wiqlQuote(TASK) for TASK in taskChunk) + ")")
+    fieldNames = ["System.WorkItemType", "GTSKanban.TASK"] + [path[len("/fields/"):] for path in FOLLOW_UP_FIELDS]
+    cards = {}
+    for IDChunk in chunkList(sorted(set(workItemIDs)), MAX_WORKITEMS_BATCH):
+        for workItem in restClient.get_workitems(IDChunk, fieldNames):
+            TASK = str(workItem["fields"].get("GTSKanban.TASK"))
+            if TASK in wanted:
+                # IDs are read in ascending order, so the most recent card of a type wins
+                cards.setdefault(TASK, {})[workItem["fields"].get("System.WorkItemType")] = workItem
+    return cards
+
+
+def applyFollowUps(restClient, route, followUps):
+    """
+    Coalesces the follow-up emails of each TASK into one JSON Patch per existing card holding only the fields that changed,
+    according to the most recent email of the TASK; the patches of all TASKs are sent through $batch calls
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+    followUps : dict
+        TASK -> follow-up IntakeRecords, in UID order
+    ----------
+
+    Returns:
+    ----------
+    updatedRecords : list of IntakeRecord
+        Emails whose cards are up to date and that can be archived
+    unknownGroups : list of list of IntakeRecord
+        Emails of the TASKs that have no Request card (a Bloom filter false positive, or a creation that failed earlier in the poll)
+    """
+    cards = loadTaskCards(restClient, route, list(followUps))
+    subRequests = []
+    owners = []
+    updatedTasks = []
+    unknownGroups = []
+    for TASK, records in followUps.items():
+        taskCards = cards.get(TASK, {})
+        if route.requestType not in taskCards:
+            unknownGroups.append(records)
+            continue
+        fields = followUpFields(records[-1])
+        for workItem in taskCards.values():
+            operations = [{"op": "add", "path": "/fields/" + name, "value": value}
+                          for name, value in fields.items() if workItem["fields"].get(name) != value]
+            if operations:
+                subRequests.append(restClient.update_workitem_request(workItem["id"], operations))
+                owners.append(TASK)
+        updatedTasks.append(TASK)
+
+    failedTasks = set()
+    for indexChunk in chunkList(list(range(len(subRequests))), MAX_BATCH_REQUESTS):
+        responses = restClient.batch([subRequests[index] for index in indexChunk])
+        for index, (code, body) in zip(indexChunk, responses):
+            if code != 200:
+                print("Update failed for TASK" + owners[index] + ": " + str(code) + " " + str(body)[:500])
+                failedTasks.add(owners[index])
+    invocationMetrics.count("WorkItemsUpdated", len(subRequests) - sum(owners.count(TASK) for TASK in failedTasks))
+    invocationMetrics.debug("Follow-ups: " + str(len(updatedTasks)) + " TASKs, " + str(len(subRequests)) + " cards changed")
+
+    updatedRecords = [record for TASK in updatedTasks if TASK not in failedTasks for record in followUps[TASK]]
+    return updatedRecords, unknownGroups
+
+
+def runIntakePipeline(restClient, route, records, archiveUIDList, ledger, scheduler):
+    """
+    Pipelined processing of the Intake Requests:
+    the calling thread consumes the parsed emails (fetched from IMAP as it goes, or read from the outbox), sets aside the
+    follow-up emails of TASKs that already have cards (see isFollowUp) and feeds chunks of new emails to a pool of
+    'maxConcurrency' workers, which create and link the work items of different TASKs at the same time.
+    Once the new TASKs are created, the follow-ups of each TASK are coalesced into updates of the changed fields (applyFollowUps).
+    The UIDs of the emails whose work items were confirmed are appended to 'archiveUIDList' as the workers finish,
+    so the caller can archive exactly those emails even when the pipeline fails part-way.
+
+    Parameters:
+    ----------
+    restClient : object
+        VSTS REST API connection
+    route : Route
+        VSTS project, Area Path and work item types of the cards
+    records : iterable of IntakeRecord
+        Example: fetchMessageBodies(mail, TASK_UID_List, subjects)
+    archiveUIDList : list
+        Receives the UIDs of the processed emails
+    ledger : ProcessedTaskLedger
+        Processed TASKs, updated as the workers finish
+    scheduler : DeadlineScheduler
+        Admits each email only while it can be processed before the Lambda deadline
+    ----------
+
+    Returns:
+    ----------
+    createdIDNumbers : list of int
+        ID Numbers of all work items created
+    """
+    createdIDNumbers = []
+    errors = []
+    chunkSizes = {}
+    # TASK -> follow-up emails, in UID order
+    followUps = {}
+
+    def collect(futures):
+        for future in futures:
+            scheduler.done(chunkSizes.pop(future))
+            try:
+                processedRecords, chunkIDNumbers = future.result()
+            except Exception as error:
+                print("Intake chunk failed: " + repr(error))
+                errors.append(error)
+                continue
+            archiveUIDList.extend(record.uid for record in processedRecords)
+            ledger.add(record.task for record in processedRecords)
+            createdIDNumbers.extend(chunkIDNumbers)
+            invocationMetrics.count("WorkItemsCreated", len(chunkIDNumbers))
+
+    def newRecords(records):
+        seenTasks = set()
+        for record in records:
+            if not scheduler.admit(record.uid):
+                # this email and the ones after it are left for the next run
+                break
+            if not record.task or record.title == DEFAULT_TITLE:
+                notifier.record(PARSE_FAILED, route.name + ": \"" + str(record.subject) + "\" has " +
+                                ("no TASK Number" if not record.task else "no Request Name, titled " + DEFAULT_TITLE),
+                                "parseFailed:" + route.name + ":" + str(record.uid))
+            if isFollowUp(ledger, record, seenTasks):
+                scheduler.done(1)
+                invocationMetrics.debug("Follow-up email for TASK" + record.task)
+                invocationMetrics.count("FollowUpEmails")
+                followUps.setdefault(record.task, []).append(record)
+                continue
+            if record.task:
+                seenTasks.add(record.task)
+            yield record
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=maxConcurrencyEnvVar) as executor:
+        try:
+            for messageChunk in iterChunks(newRecords(records), vstsEmailsPerBatchEnvVar):
+                # keeps the queue of parsed emails bounded while the workers catch up
+                while len(pending) >= 2 * maxConcurrencyEnvVar:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(processIntakeChunk, restClient, route, messageChunk)
+                chunkSizes[future] = len(messageChunk)
+                pending.add(future)
+        finally:
+            done, pending = wait(pending)
+            collect(done)
+
+    if followUps:
+        try:
+            with invocationMetrics.span("update"):
+                updatedRecords, unknownGroups = applyFollowUps(restClient, route, followUps)
+            archiveUIDList.extend(record.uid for record in updatedRecords)
+            ledger.add(record.task for record in updatedRecords)
+            # TASKs without cards get one card pair, from their most recent email, and all their emails are archived
+            for groupChunk in chunkList(unknownGroups, vstsEmailsPerBatchEnvVar):
+                processedRecords, chunkIDNumbers = processIntakeChunk(restClient, route, [records[-1] for records in groupChunk])
+                processedTasks = set(record.task for record in processedRecords)
+                archiveUIDList.extend(record.uid for records in groupChunk if records[-1].task in processedTasks for record in records)
+                ledger.add(processedTasks)
+                createdIDNumbers.extend(chunkIDNumbers)
+                invocationMetrics.count("WorkItemsCreated", len(chunkIDNumbers))
+        except Exception as error:
+            print("Follow-up updates failed: " + repr(error))
+            errors.append(error)
+
+    if errors:
+        raise errors[0]
+    return createdIDNumbers
+
+
+def processInbox(mail, restClient_GTS, state, route, scheduler=None, outbox=None):
+    """
+    Searches the mailbox of a route for Intake Requests, creates their Work ID Cards and archives the processed emails.
+    With an 'outbox' the parsed emails are stored in the outbox instead (see ingestToOutbox) and archived once it is written to S3.
+
+    Emails the scheduler defers (Lambda deadline near) are saved in the 'resumeCursor' of the run state with the UIDVALIDITY,
+    and processed first by the next run without being searched again; the UID watermark moves past them.
+
+    Parameters:
+    ----------
+    mail : object
+        IMAP Email Account Connection, with the route's mailbox selected
+    restClient_GTS : object
+        VSTS REST API connection
+    state : object
+        Run state store of the route
+    route : Route
+        Mailbox, sender and Subject pattern of the Intake Requests, VSTS project, Area Path and work item types of their cards
+    scheduler : DeadlineScheduler
+        Admits each email only while it can be processed before the Lambda deadline, None admits every email
+    outbox : OutboxStore
+        None creates the work items directly
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    if scheduler is None:
+        scheduler = DeadlineScheduler()
+    scheduler.usePriorEstimate(state.get("perEmailSeconds"))
+
+    # Search the INBOX for emails from SC - above the stored UID watermark, or within the last few days
+    with invocationMetrics.span("search"):
+        if imapSearchModeEnvVar == "incremental":
+            uidValidity = mailboxUIDValidity(mail, route.mailbox)
+            watermark = state.get("imapUIDWatermark") or {}
+            watermarkUIDValidity, lastUID = watermark.get("uidValidity"), watermark.get("lastUID", 0)
+            UID_List = Email_Search_Incremental(mail, route.sender, uidValidity, watermarkUIDValidity, lastUID, numDaysToSearchBeforeToday)
+            # Intake Requests deferred by the previous run, only valid for the same UIDVALIDITY
+            cursor = state.get("resumeCursor") or {}
+            cursorUIDs = [str(uid) for uid in cursor.get("uids", [])] if cursor.get("uidValidity") == uidValidity else []
+        else:
+            cursorUIDs = []
+            UID_List = Email_Search(mail, route.sender, numDaysToSearchBeforeToday)
+
+    # Fetches the Subject of every candidate first, then the full message only for the Intake Requests (Subject matches the route's pattern);
+    # the resumed emails need their Subject too, it carries the TASK Number
+    with invocationMetrics.span("fetch"):
+        subjects = fetchSubjects(mail, sorted(set(UID_List) | set(cursorUIDs), key=int))
+    TASK_UID_List = [UIDNum for UIDNum in UID_List if route.isIntakeSubject(subjects.get(UIDNum, ""))]
+    print(route.name + ": " + str(len(TASK_UID_List)) + " of " + str(len(UID_List)) + " messages are Intake Requests, " + str(len(cursorUIDs)) + " resumed")
+    TASK_UID_List = sorted(set(TASK_UID_List) | set(cursorUIDs), key=int)
+    invocationMetrics.count("IntakeEmails", len(TASK_UID_List))
+
+    # Iterates through the Intake Requests, creates Work ID Cards, creates parent/child connection between
+    # respective Work ID Cards, then moves all processed messages from Inbox to Archive at once
+    archiveUIDList = []
+    try:
+        if outbox is not None:
+            ingestToOutbox(outbox, route, fetchMessageBodies(mail, TASK_UID_List, subjects), archiveUIDList, scheduler)
+        else:
+            # Creates the Work ID Cards of up to 'maxConcurrency' chunks of emails at the same time
+            ledger = ProcessedTaskLedger(state, ledgerExactLimitEnvVar, ledgerGenerationsEnvVar)
+            createdIDNumbers = runIntakePipeline(restClient_GTS, route, fetchMessageBodies(mail, TASK_UID_List, subjects),
+                                                 archiveUIDList, ledger, scheduler)
+
+            # the most recent work id number is kept in the run state as a record of the last work item created
+            if createdIDNumbers:
+                state.setMax("workItemIDNumber", max(createdIDNumbers))
+    finally:
+        # Moves every processed SC Email to the route's archive Folder ('Archive/ServiceCafe') in one step
+        with invocationMetrics.span("archive"):
+            archiveMessages(mail, archiveUIDList, route.archiveMailbox)
+
+    # Keeps the measured cost of an email for the scheduler of the next run (storing an email in the outbox costs much less)
+    if scheduler.completed and outbox is None:
+        state.set("perEmailSeconds", round(scheduler.estimate(), 3))
+
+    if imapSearchModeEnvVar == "incremental":
+        deferredUIDs = scheduler.deferredUIDs(TASK_UID_List)
+        failedUIDs = set(scheduler.admitted) - set(archiveUIDList)
+        # An email that keeps failing (Example: a card VSTS rejects) is set aside, so it cannot hold the watermark back forever
+        setAsideUIDs = countEmailFailures(state, uidValidity, failedUIDs, archiveUIDList)
+        if setAsideUIDs:
+            setAsideEmails(mail, route, setAsideUIDs)
+            failedUIDs -= set(setAsideUIDs)
+        # Saves the highest UID examined so the next run only searches newer mail;
+        # deferred and resumed emails are carried by the cursor, so only new failures hold the watermark back
+        if UID_List or watermarkUIDValidity != uidValidity:
+            unprocessedUIDs = (set(TASK_UID_List) - set(archiveUIDList)) - set(deferredUIDs) - set(cursorUIDs) - set(setAsideUIDs)
+            highestUID = advanceUIDWatermark(lastUID if watermarkUIDValidity == uidValidity else 0, UID_List, unprocessedUIDs)
+            state.setWatermark("imapUIDWatermark", uidValidity, highestUID)
+        # Resumed emails that failed again stay in the cursor, resumed emails no longer in the mailbox are dropped
+        carriedUIDs = sorted(set(deferredUIDs) | (failedUIDs & set(cursorUIDs)), key=int)
+        if carriedUIDs or cursorUIDs:
+            state.set("resumeCursor", {"uidValidity": uidValidity, "uids": [int(uid) for uid in carriedUIDs]})
+            print(route.name + ": " + str(len(carriedUIDs)) + " Intake Requests left for the next run")
+
+
+def ingestToOutbox(outbox, route, records, archiveUIDList, scheduler):
+    """
+    Ingestion stage of the outbox pipeline: stores the parsed emails in the outbox and writes it to S3; only then are
+    their UIDs appended to 'archiveUIDList', so an email leaves the INBOX only once its record is durable
+
+    Parameters:
+    ----------
+    outbox : OutboxStore
+    route : Route
+    records : iterable of IntakeRecord
+    archiveUIDList : list
+        Receives the UIDs of the stored emails
+    scheduler : DeadlineScheduler
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    storedUIDs = []
+    for recordChunk in iterChunks(records, imapFetchBatchSize):
+        admitted = []
+        for record in recordChunk:
+            if not scheduler.admit(record.uid):
+                break
+            admitted.append(record)
+        with invocationMetrics.span("ingest"):
+            added = outbox.add(route.name, admitted)
+        scheduler.done(len(admitted))
+        storedUIDs += [record.uid for record in admitted]
+        invocationMetrics.count("OutboxRecordsAdded", added)
+        if len(admitted) < len(recordChunk):
+            break
+    with invocationMetrics.span("stateIO"):
+        outbox.flush()
+    archiveUIDList.extend(storedUIDs)
+    print(route.name + ": " + str(len(storedUIDs)) + " Intake Requests stored in the outbox")
+
+
+def drainOutbox(outbox, restClient, route, state, scheduler):
+    """
+    Drain stage of the outbox pipeline: creates (or updates, for follow-ups) the work items of up to 'outboxDrainLimit'
+    pending records of a route through the intake pipeline, then marks the confirmed records done. No IMAP access is needed,
+    so a failed drain is simply retried by the next one.
+
+    Parameters:
+    ----------
+    outbox : OutboxStore
+    restClient : object
+        VSTS REST API connection
+    route : Route
+    state : object
+        Run state store of the route (processed-TASK ledger)
+    scheduler : DeadlineScheduler
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    records = outbox.pending(route.name, outboxDrainLimitEnvVar)
+    if not records:
+        return
+    # the outbox key of each record stands in for its UID
+    doneKeys = []
+    try:
+        ledger = ProcessedTaskLedger(state, ledgerExactLimitEnvVar, ledgerGenerationsEnvVar)
+        createdIDNumbers = runIntakePipeline(restClient, route, records, doneKeys, ledger, scheduler)
+        if createdIDNumbers:
+            state.setMax("workItemIDNumber", max(createdIDNumbers))
+    finally:
+        outbox.markDone(doneKeys)
+        failedKeys = outbox.markAttempted(sorted(set(scheduler.admitted) - set(doneKeys)))
+        for key in failedKeys:
+            print("Outbox record " + key + " set aside after " + str(outbox.maxAttempts) + " failed drains")
+        outbox.purge(outboxRetentionDaysEnvVar * 86400)
+        with invocationMetrics.span("stateIO"):
+            outbox.flush()
+        invocationMetrics.count("OutboxRecordsDrained", len(doneKeys))
+        print(route.name + ": " + str(len(doneKeys)) + " of " + str(len(records)) + " outbox records drained")
+
+
+def tokenChangeAlert(state):
+    """
+    Checks the 'TOKEN_CHANGE_DATE' Environment Variable to see if an alert email needs to be sent out, and if so records
+    the alert with the notifier, which mails it with the digest of the run. The alert is throttled by the notifier,
+    so it is sent again every two days until the 'TOKEN_CHANGE_DATE' and the 'vstsWIAcToken' Environment Variables are updated.
+
+    Parameters:
+    ----------
+    state : object
+        Run state store, holds the date the last alert was sent on before the notifier took over
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
     tokenChangedDays = dateDifCalculator(TokChangeDateEnvVar)
     if tokenChangeAlarm(tokenChangedDays):
-        dateLastEmailAlertSent = s3_Read_Str_from_TXT_File(bucket_name, s3_path_emailSendDate)
-        print(dateLastEmailAlertSent)
-        if dateDifCalculator(dateLastEmailAlertSent) > 2:
-            # VSTS Token Replacement Alert Email Creation:
-            # - subject and body for alert email
-            emailAlertSubject = "VSTS Account Token Change Alert!"
-            emailAlertBody = "The Login Token for the Visual Studio Team Services (VSTS) Work Item Generator will be expiring soon. It is PERTINENT that the token be regenerated and updated in the Environment Variables section of the AWS (US East (Ohio) region) Lambda Function, \"VSTSWorkItemGenerator\".\n\n Environment Variables requiring an update:\n\n - vstsWIAcToken : contains the VSTS account token \n - TOKEN_CHANGE_DATE : contains the date on which the VSTS account token was updated\n\nSee VSTS_Work_Item_Generator Documentation for instructions on how to perform this update."
-            # sends email alert to the respective recipient(s)
-            sendEmail(emailHostNameEnvVar, smtpEmailUserNameEnvVar, emailPasswordEnvVar, senderEmailEnvVar, recipientEmailEnvVar, emailAlertSubject, emailAlertBody)
-            print("Email sent. It has been more than 3 days since the last email was sent.")
-            # generates a string that contains the date the email alert was just sent on
-            emailSendDate = "Year: " + str(datetime.now().year) + " Month: " + str(datetime.now().month) + " Day: " + str(datetime.now().day)
-            # writes the email send date string to the S3 contained .txt file
-            s3_Write_Str_To_TXT_File(bucket_name, s3_path_emailSendDate, emailSendDate)
-        else:
+        dateLastEmailAlertSent = state.get("tokenEmailSendDate")
+        invocationMetrics.debug("Last alert sent on: " + str(dateLastEmailAlertSent))
+        if dateLastEmailAlertSent is not None and dateDifCalculator(dateLastEmailAlertSent) <= 2:
+            # sent by sendEmail before the notifier kept the alert dates
             print("Email not sent. It has not been more than 3 days since the last email was sent.")
+            return
+        # VSTS Token Replacement Alert Email body
+        emailAlertBody = "The Login Token for the Visual Studio Team Services (VSTS) Work Item Generator will be expiring soon. It is PERTINENT that the token be regenerated and updated in the Environment Variables section of the AWS (US East (Ohio) region) Lambda Function, \"VSTSWorkItemGenerator\".\n\n Environment Variables requiring an update:\n\n - vstsWIAcToken : contains the VSTS account token \n - TOKEN_CHANGE_DATE : contains the date on which the VSTS account token was updated\n\nSee VSTS_Work_Item_Generator Documentation for instructions on how to perform this update."
+        notifier.record(TOKEN_EXPIRY, emailAlertBody, "tokenExpiry", 2 * 86400)
+
+
+def deliverNotifications(state):
+    """
+    Mails the digests of the events recorded by this invocation over a single SMTP session (see notifier.DigestNotifier).
+    A delivery failure is logged and never fails the run: the events stay in the run state for the next digest.
+
+    Parameters:
+    ----------
+    state : object
+        Run state store (loaded), keeps the alert throttling and the events held back
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    if not notifier.pendingEvents() and not state.get("notifierBacklog"):
+        return
+
+    def send(messages):
+        return sendEmails(emailHostNameEnvVar, smtpEmailUserNameEnvVar, secretsProvider.getSecret('emailPassword'), senderEmailEnvVar, messages)
+
+    try:
+        with invocationMetrics.span("alert"):
+            sent, throttled = notifier.deliver(state, send)
+    except Exception as error:
+        print("Notifications failed: " + repr(error))
+        return
+    invocationMetrics.count("DigestsSent", sent)
+    invocationMetrics.count("AlertsThrottled", throttled)
+    if sent:
+        print(str(sent) + " notification digest(s) sent")
+
+
+def resumeBacklog(event, context):
+    """
+    Re-invokes this Lambda function asynchronously so the Intake Requests deferred by the scheduler are processed
+    right away instead of at the next scheduled run. The chain of re-invocations is capped by 'maxResumeChain'.
+
+    Parameters:
+    ----------
+    event : dict
+        Event of the current invocation, carries the 'resumeDepth' of a re-invocation
+    context : object
+        Lambda context object
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    resumeDepth = int((event or {}).get("resumeDepth", 0)) + 1
+    functionArn = getattr(context, "invoked_function_arn", None)
+    if functionArn is None or resumeDepth > maxResumeChainEnvVar:
+        print("Backlog left for the next scheduled run (re-invocation " + str(resumeDepth) + " of " + str(maxResumeChainEnvVar) + ")")
+        return
+    # the re-invocation runs the same stage (Example: {"mode": "drain"})
+    payload = dict(event) if isinstance(event, dict) else {}
+    payload["resumeDepth"] = resumeDepth
+    # a profiled invocation does not profile the whole chain
+    payload.pop("profile", None)
+    boto3.client('lambda').invoke(FunctionName=functionArn, InvocationType='Event', Payload=json.dumps(payload).encode("utf-8"))
+    print("Re-invoked " + functionArn + " to resume the backlog (re-invocation " + str(resumeDepth) + ")")
+
+
+def routeStateStore(route):
+    """
+    Returns the run state store of a route; the route using the original run state object shares 'runStateStore'
+    """
+    if route.stateKey == s3_path_runState:
+        return runStateStore
+    return routeTable.stateStore(route)
+
+
+@contextlib.contextmanager
+def invocationScope(functionName, loadState=True):
+    """
+    Wraps one invocation of a handler: starts its metrics and notifier, and whatever its outcome mails the digests of
+    its events, writes the shared run state and emits its metrics record.
+    Example: with invocationScope("VSTSWorkItemGenerator"): ...
+
+    Parameters:
+    ----------
+    functionName : str
+        Function name dimension of the metrics record
+    loadState : bool
+        Reads the shared run state before the invocation runs; when False it is only read at the end, when there are
+        notifications to deliver
+    ----------
+    """
+    # Starts the metrics of this invocation (stage timing spans and call counters)
+    invocationMetrics.reset()
+    notifier.reset()
+    stateLoaded = False
+    try:
+        if loadState:
+            # Reads the run state (watermarks, alert dates) once for this invocation
+            with invocationMetrics.span("stateIO"):
+                loadRunState(runStateStore)
+            stateLoaded = True
+        yield
+    finally:
+        try:
+            if stateLoaded or notifier.pendingEvents():
+                if not stateLoaded:
+                    with invocationMetrics.span("stateIO"):
+                        loadRunState(runStateStore)
+                # One digest per recipient for the whole run, over a single SMTP session
+                deliverNotifications(runStateStore)
+                # Writes all run state changes of this invocation with a single conditional PUT
+                with invocationMetrics.span("stateIO"):
+                    runStateStore.flush()
+        finally:
+            invocationMetrics.debug("Connections (created/reused): " + str(connectionManager.report()))
+            # One structured metrics record per invocation (CloudWatch Embedded Metric Format)
+            invocationMetrics.emit({"FunctionName": functionName})
+
+
+def processRoute(route, restClient_GTS, scheduler, stage="direct"):
+    """
+    Processes the mailbox of one route on its own IMAP session and with its own run state (watermark, ledger, resume cursor).
+    Runs on a worker thread, one per route.
+
+    Parameters:
+    ----------
+    route : Route
+    restClient_GTS : object
+        VSTS REST API connection, shared by the routes
+    scheduler : DeadlineScheduler
+        Scheduler of this route
+    stage : str
+        "direct" (no outbox), "ingest" (IMAP to outbox), "drain" (outbox to VSTS) or "outbox" (ingest, then drain)
+    ----------
+
+    Returns:
+    ----------
+    None
+    """
+    state = routeStateStore(route)
+    # the shared run state object is read and written by lambda_handler itself
+    ownState = state is not runStateStore
+    try:
+        if ownState:
+            with invocationMetrics.span("stateIO"):
+                state.load()
+        if stage != "drain":
+            with invocationMetrics.span("connect"):
+                # Reuse the IMAP session of the warm container (NOOP-checked), or connect, login and select the route's mailbox
+                mail = pooledEmailConnection(emailHostNameEnvVar, emailUserNameEnvVar, route.mailbox, route.name)
+            try:
+                processInbox(mail, restClient_GTS, state, route, scheduler, None if stage == "direct" else outboxStore)
+            except (imaplib.IMAP4.error, OSError):
+                # the IMAP session stays open between invocations - drop it when it may be mid-command
+                discardEmailConnection(emailHostNameEnvVar, emailUserNameEnvVar, route.mailbox, route.name)
+                raise
+        if stage in ("drain", "outbox"):
+            # the emails ingested above are not admitted twice: the drain gets a scheduler of its own with the same deadline
+            drainScheduler = DeadlineScheduler(scheduler.remainingMillis, scheduler.safetySeconds, scheduler.priorEmailSeconds)
+            drainOutbox(outboxStore, restClient_GTS, route, state, drainScheduler)
+            if drainScheduler.stoppedAtUID is not None:
+                scheduler.stoppedAtUID = scheduler.stoppedAtUID or drainScheduler.stoppedAtUID
+    finally:
+        if ownState:
+            with invocationMetrics.span("stateIO"):
+                state.flush()
+
+
+def writeProfileResult(invocationID, name, data):
+    """
+    Stores one profiling result under the invocation ID, in 'profileDirectory' when it is set, else in the S3 Bucket
+
+    Parameters:
+    ----------
+    invocationID : str
+    name : str
+        Example: "cpu.prof"
+    data : bytes
+    ----------
+
+    Returns:
+    ----------
+    location : str
+        Example: "s3://bucket/Profiles/<invocation ID>/cpu.prof"
+    """
+    if profileDirectoryEnvVar:
+        directory = os.path.join(profileDirectoryEnvVar, invocationID)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), "wb") as resultFile:
+            resultFile.write(data)
+        return os.path.join(directory, name)
+    key = profileS3PrefixEnvVar + invocationID + "/" + name
+    s3.meta.client.put_object(Bucket=bucket_name, Key=key, Body=data)
+    return "s3://" + bucket_name + "/" + key
+
+
+# Profiler of the invocations whose event has a "profile" field (Example: {"profile": "cpu,memory"}) or of every
+# invocation when 'profileInvocations' is set; the other invocations run the handler unchanged
+invocationProfiler = InvocationProfiler(writeProfileResult)
+
+
+@invocationProfiler.profiled(lambda: profileInvocationsEnvVar)
+def lambda_handler(event, context):
+    # A scheduled {"mode": "repairLinks", "days": 30} event runs the link repair instead of the mailbox poll
+    if isinstance(event, dict) and event.get("mode") == "repairLinks":
+        return repairLinksHandler(event, context)
+    # {"mode": "ingest"} and {"mode": "drain"} events run one stage of the outbox pipeline, other events a full poll
+    mode = event.get("mode") if isinstance(event, dict) else None
+    stage = mode if mode in ("ingest", "drain") else ("outbox" if pipelineModeEnvVar == "outbox" else "direct")
+    routes = routeTable.getRoutes()
+    # One scheduler per route: each stops admitting emails when the remaining time no longer covers one more email plus a safety margin
+    schedulers = [DeadlineScheduler(getattr(context, "get_remaining_time_in_millis", None),
+                                    deadlineSafetySecondsEnvVar, defaultEmailSecondsEnvVar) for route in routes]
+    with invocationScope(getattr(context, "function_name", "VSTSWorkItemGenerator")):
+        if stage != "direct":
+            with invocationMetrics.span("stateIO"):
+                outboxStore.load()
+
+        with invocationMetrics.span("connect"):
+            # Initialize the VSTS REST client using the VSTS instance and personal access token
+            # *******THIS TOKEN NEEDS TO BE REPLACED/RENEWED/UPDATED YEARLY*******
+            vstsWIAcToken = secretsProvider.getSecret('vstsWIAcToken')
+            restClient_GTS = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, vstsWIAcToken)  # account instance + account token
+
+        # Searches the mailbox of every route in parallel, creates the Work ID Cards and archives the processed emails;
+        # the run takes as long as the slowest route, and a failing route does not stop the others
+        with ThreadPoolExecutor(max_workers=len(routes)) as executor:
+            futures = [executor.submit(processRoute, route, restClient_GTS, scheduler, stage) for route, scheduler in zip(routes, schedulers)]
+        errors = []
+        for route, future in zip(routes, futures):
+            if future.exception() is not None:
+                print("Route " + route.name + " failed: " + repr(future.exception()))
+                notifier.record(RUN_FAILED, route.name + ": " + repr(future.exception())[:300],
+                                "runFailed:" + route.name + ":" + type(future.exception()).__name__)
+                errors.append(future.exception())
+
+        # Records the VSTS token change alert when it is due
+        tokenChangeAlert(runStateStore)
+        if errors:
+            raise errors[0]
+
+    # The resume cursors are written, so a re-invocation can pick up the deferred emails
+    if any(scheduler.stoppedAtUID is not None for scheduler in schedulers):
+        resumeBacklog(event, context)
+
+
+def repairLinksHandler(event, context):
+    """
+    Lambda entry point of the link repair: runs repairParentLinks on every route
+
+    Parameters:
+    ----------
+    event : dict
+        Example: {"mode": "repairLinks", "days": 30, "dryRun": false}
+    ----------
+
+    Returns:
+    ----------
+    summaries : dict
+        Route name -> summary returned by repairParentLinks
+    """
+    with invocationScope(getattr(context, "function_name", "VSTSWorkItemGenerator"), loadState=False):
+        restClient = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+        summaries = {}
+        for route in routeTable.getRoutes():
+            with invocationMetrics.span("repair"):
+                summaries[route.name] = repairRouteLinks(restClient, route, int(event.get("days", linkRepairDaysEnvVar)), bool(event.get("dryRun")))
+        return summaries
+
+
+def repairRouteLinks(restClient, route, days, dryRun):
+    """
+    Runs the link repair on one route (see link_repair.repairParentLinks) and records its failed links with the notifier
+
+    Returns:
+    ----------
+    summary : dict
+        Summary returned by repairParentLinks
+    """
+    summary = repairParentLinks(restClient, route, days, dryRun, maxConcurrencyEnvVar)
+    for REQUEST_WIID, PBI_WIID, code in summary["failedLinks"]:
+        notifier.record(LINK_FAILED, route.name + ": link repair of Request " + str(REQUEST_WIID) + ", PBI " + str(PBI_WIID) +
+                        " - " + str(code), "linkFailed:" + str(PBI_WIID))
+    invocationMetrics.count("LinksRepaired", summary["linked"])
+    return summary
+
+
+def processPushedEmail(rawEmail, key, restClient):
+    """
+    Runs one raw email delivered without IMAP (Example: an .eml object stored by an SES receipt rule) through the intake
+    pipeline of the route it belongs to. An email of a TASK that already has cards is a follow-up, so processing the same
+    email again changes nothing.
+
+    Parameters:
+    ----------
+    rawEmail : bytes
+    key : str
+        Name of the email in the logs, Example: "s3://bucket/incoming/0123.eml"
+    restClient : object
+        VSTS REST API connection
+    ----------
+
+    Returns:
+    ----------
+    processed : bool
+        False when the work items could not be created or updated
+    """
+    route, subject = routeTable.match(splitHeaders(rawEmail)[0])
+    if route is None:
+        print("Skipping " + key + ", not an Intake Request: " + subject)
+        return True
+    with invocationMetrics.span("parse"):
+        record = parseIntakeMessage(rawEmail, key, subject)
+    state = routeStateStore(route)
+    with invocationMetrics.span("stateIO"):
+        state.load()
+    processedKeys = []
+    try:
+        ledger = ProcessedTaskLedger(state, ledgerExactLimitEnvVar, ledgerGenerationsEnvVar)
+        runIntakePipeline(restClient, route, [record], processedKeys, ledger, DeadlineScheduler())
+    finally:
+        with invocationMetrics.span("stateIO"):
+            state.flush()
+    print(route.name + ": " + key + (" processed" if processedKeys else " not processed") + " (TASK" + record.task + ")")
+    return bool(processedKeys)
+
+
+def claimPushedEmail(markerKey):
+    """
+    Claims an object event with a conditional PUT of its marker, so an event delivered twice is processed once.
+    A claim older than 'pushedEmailClaimSeconds' was left by an invocation that never finished and is taken over.
+
+    Returns:
+    ----------
+    claimed : bool
+        False when the email was already processed or is being processed by another invocation
+    """
+    s3Client = s3.meta.client
+    marker = json.dumps({"status": "claimed", "at": time.time()}).encode("utf-8")
+    try:
+        s3Client.put_object(Bucket=bucket_name, Key=markerKey, Body=marker, IfNoneMatch="*")
+        return True
+    except ClientError as error:
+        if s3ErrorCode(error) not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+            raise
+    response = s3Client.get_object(Bucket=bucket_name, Key=markerKey)
+    current = json.loads(response['Body'].read().decode('utf-8'))
+    if current.get("status") == "done" or time.time() - current.get("at", 0) < pushedEmailClaimSecondsEnvVar:
+        return False
+    try:
+        s3Client.put_object(Bucket=bucket_name, Key=markerKey, Body=marker, IfMatch=response['ETag'])
+        print("Took over the stale claim " + markerKey)
+        return True
+    except ClientError as error:
+        if s3ErrorCode(error) not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+            raise
+        return False
+
+
+@invocationProfiler.profiled(lambda: profileInvocationsEnvVar)
+def s3_event_handler(event, context):
+    """
+    Push-based alternative to the IMAP poll of lambda_handler: processes the raw emails (.eml objects) named by an
+    S3 object event, Example: the objects an SES receipt rule stores for the ServiceNow mail.
+    Only the object of the event is read (at most 'pushedEmailByteCap' bytes). Each object is claimed with a marker
+    under 'pushedEmailMarkerPrefix' before it is processed and the marker is marked done afterwards, so a redelivered
+    event is a no-op; a failure releases the claim and is raised, so S3/Lambda retry the event.
+
+    Parameters:
+    ----------
+    event : dict
+        S3 event notification, Example: {"Records": [{"s3": {"bucket": {"name": "..."}, "object": {"key": "...", "eTag": "..."}}}]}
+    context : object
+        Lambda context object
+    ----------
+
+    Returns:
+    ----------
+    results : dict
+        "s3://bucket/key" -> "processed", "duplicate" or "failed"
+    """
+    results = {}
+    with invocationScope(getattr(context, "function_name", "VSTSWorkItemGenerator"), loadState=False):
+        with invocationMetrics.span("connect"):
+            restClient = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+        for eventRecord in event.get("Records", []):
+            objectBucket = eventRecord["s3"]["bucket"]["name"]
+            objectKey = unquote_plus(eventRecord["s3"]["object"]["key"])
+            name = "s3://" + objectBucket + "/" + objectKey
+            identity = name + "@" + str(eventRecord["s3"]["object"].get("eTag", ""))
+            markerKey = pushedEmailMarkerPrefixEnvVar + hashlib.sha1(identity.encode("utf-8")).hexdigest() + ".json"
+            if not claimPushedEmail(markerKey):
+                print("Skipping " + name + ", already processed")
+                invocationMetrics.count("DuplicateEvents")
+                results[name] = "duplicate"
+                continue
+            try:
+                with invocationMetrics.span("fetch"):
+                    response = s3.meta.client.get_object(Bucket=objectBucket, Key=objectKey, Range="bytes=0-" + str(pushedEmailByteCapEnvVar - 1))
+                    rawEmail = response['Body'].read()
+                processed = processPushedEmail(rawEmail, name, restClient)
+            except Exception:
+                s3.meta.client.delete_object(Bucket=bucket_name, Key=markerKey)
+                raise
+            if not processed:
+                s3.meta.client.delete_object(Bucket=bucket_name, Key=markerKey)
+                results[name] = "failed"
+                continue
+            s3.meta.client.put_object(Bucket=bucket_name, Key=markerKey,
+                                      Body=json.dumps({"status": "done", "at": time.time(), "object": identity}).encode("utf-8"))
+            results[name] = "processed"
+    failed = [name for name, result in results.items() if result == "failed"]
+    if failed:
+        # makes the invocation fail, so the event is delivered again
+        raise RuntimeError("Work items could not be created for " + ", ".join(failed))
+    return results
+
+
+def runIdleDaemon(routeName=None):
+    """
+    Long-running alternative to the scheduled lambda_handler runs: watches the mailbox of a route with IMAP IDLE
+    (see idle_daemon.runIdleLoop) and processes only the mail that arrived, through the same functions as lambda_handler
+
+    Parameters:
+    ----------
+    routeName : str
+        Route whose mailbox is watched, the first route of the routing table when None
+    ----------
+
+    Returns:
+    ----------
+    Never returns
+    """
+    route = routeTable.find(routeName)
+    state = routeStateStore(route)
+
+    def connect():
+        mail = email_Connection(emailHostNameEnvVar, emailUserNameEnvVar, secretsProvider.getSecret('emailPassword'), route.mailbox)
+        print("Daemon connected to " + emailHostNameEnvVar + ", watching " + route.mailbox)
+        return mail
+
+    def processNewMail(mail):
+        with invocationScope("VSTSWorkItemGenerator-daemon"):
+            restClient_GTS = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+            ownState = state is not runStateStore
+            if ownState:
+                with invocationMetrics.span("stateIO"):
+                    state.load()
+            try:
+                # the incremental search only returns the messages above the UID watermark - the ones that just arrived
+                processInbox(mail, restClient_GTS, state, route)
+                tokenChangeAlert(runStateStore)
+            finally:
+                if ownState:
+                    with invocationMetrics.span("stateIO"):
+                        state.flush()
+
+    runIdleLoop(connect, processNewMail, imapIdleSecondsEnvVar, daemonMaxBackoffEnvVar)
+
+
+def runBackfill(exportPath, routeName=None, checkpointPath=None, batchEmails=MAX_BATCH_REQUESTS // 2, workers=None, updateLedger=True):
+    """
+    Replays an mbox file or Maildir export of missed Intake Requests into VSTS, see backfill.replayExport
+
+    Parameters:
+    ----------
+    exportPath : str
+        mbox file or Maildir directory
+    routeName : str
+        Route the emails belong to, the first route of the routing table when None
+    checkpointPath : str
+        Default: exportPath + ".checkpoint.json"
+    batchEmails : int
+        Emails per $batch call, at most MAX_BATCH_REQUESTS / 2
+    workers : int
+        Concurrent $batch calls, Default: 'maxConcurrency'
+    updateLedger : bool
+        Also records the created TASKs in the route's processed-TASK ledger, so the Lambda function treats those emails as
+        follow-ups of the existing cards
+    ----------
+
+    Returns:
+    ----------
+    checkpoint : dict
+        Position reached and the number of emails created, skipped and failed
+    """
+    route = routeTable.find(routeName)
+    restClient = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+
+    def recordTasks(createdTasks):
+        state = routeStateStore(route)
+        state.load()
+        ProcessedTaskLedger(state, ledgerExactLimitEnvVar, ledgerGenerationsEnvVar).add(createdTasks)
+        state.flush()
+        print("Recorded " + str(len(createdTasks)) + " backfilled TASKs in the ledger of route " + route.name)
+
+    return replayExport(exportPath, route, restClient, lambda records: processIntakeChunk(restClient, route, records),
+                        checkpointPath, batchEmails, workers or maxConcurrencyEnvVar, recordTasks if updateLedger else None)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argumentParser = argparse.ArgumentParser(description="VSTS Work Item Generator")
+    subcommands = argumentParser.add_subparsers(dest="command")
+    daemonCommand = subcommands.add_parser("daemon", help="Watch the mailbox of a route with IMAP IDLE instead of scheduled polling")
+    daemonCommand.add_argument("--route", help="Route name (default: the first route of the routing table)")
+    repairCommand = subcommands.add_parser("repair-links", help="Link the Request/PBI pairs created in the last days that were never linked")
+    repairCommand.add_argument("--route", help="Route name (default: every route)")
+    repairCommand.add_argument("--days", type=int, default=linkRepairDaysEnvVar, help="Age, in days, of the oldest work items checked")
+    repairCommand.add_argument("--dry-run", action="store_true", help="Only report the missing links")
+    drainCommand = subcommands.add_parser("drain-outbox", help="Drain a local copy of the outbox into VSTS (Example: a replay against stand-ins)")
+    drainCommand.add_argument("outbox", help="SQLite outbox database")
+    drainCommand.add_argument("--route", help="Route name (default: every route)")
+    pushCommand = subcommands.add_parser("push-eml", help="Process raw .eml files the way s3_event_handler processes pushed emails")
+    pushCommand.add_argument("files", nargs="+", help=".eml files")
+    backfillCommand = subcommands.add_parser("backfill", help="Replay an mbox file or Maildir export of missed Intake Requests into VSTS")
+    backfillCommand.add_argument("export", help="mbox file or Maildir directory")
+    backfillCommand.add_argument("--route", help="Route name (default: the first route of the routing table)")
+    backfillCommand.add_argument("--checkpoint", help="Checkpoint file (default: <export>.checkpoint.json)")
+    backfillCommand.add_argument("--batch-emails", type=int, default=MAX_BATCH_REQUESTS // 2, help="Emails per $batch call")
+    backfillCommand.add_argument("--workers", type=int, default=maxConcurrencyEnvVar, help="Concurrent $batch calls")
+    backfillCommand.add_argument("--no-ledger", action="store_true", help="Do not record the created TASKs in the run state")
+    arguments = argumentParser.parse_args()
+
+    if arguments.command == "daemon":
+        runIdleDaemon(arguments.route)
+    elif arguments.command == "repair-links":
+        restClient = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+        for route in ([routeTable.find(arguments.route)] if arguments.route else routeTable.getRoutes()):
+            print(json.dumps(repairRouteLinks(restClient, route, arguments.days, arguments.dry_run)))
+    elif arguments.command == "drain-outbox":
+        localOutbox = OutboxStore(None, None, None, arguments.outbox)
+        localOutbox.load()
+        restClient = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+        for route in ([routeTable.find(arguments.route)] if arguments.route else routeTable.getRoutes()):
+            state = routeStateStore(route)
+            state.load()
+            while localOutbox.pending(route.name, 1):
+                drainedBefore = localOutbox.counts().get((route.name, "pending"), 0)
+                drainOutbox(localOutbox, restClient, route, state, DeadlineScheduler())
+                if localOutbox.counts().get((route.name, "pending"), 0) >= drainedBefore:
+                    break
+            state.flush()
+        print(json.dumps(dict((route + "/" + status, count) for (route, status), count in sorted(localOutbox.counts().items()))))
+    elif arguments.command == "push-eml":
+        restClient = VSTS_Rest_Client_Connection(vstsWIAccountEnvVar, secretsProvider.getSecret('vstsWIAcToken'))
+        for fileName in arguments.files:
+            with open(fileName, "rb") as emlFile:
+                processPushedEmail(emlFile.read(pushedEmailByteCapEnvVar), fileName, restClient)
+    elif arguments.command == "backfill":
+        runBackfill(arguments.export, arguments.route, arguments.checkpoint, arguments.batch_emails, arguments.workers, not arguments.no_ledger)
+    else:
+        argumentParser.print_help()
@@ -0,0 +1,119 @@
+"""Fixtures of the behaviour tests: the Lambda function loaded against the in-process stand-ins of benchmarks/fake_services.py."""
+# Import the OS, system, module loading and test modules
+import os
+import sys
+import types
+import importlib.util
+
+import pytest
+
+testsDirectory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(testsDirectory, "..", "benchmarks"))
+sys.path.insert(0, os.path.join(testsDirectory, "..", "lambda-function"))
+
+# Address the Intake Requests of the tests are sent from (bench_poll.SENDER)
+SENDER = "servicenow@example.com"
+
+
+class StubAWSClient(object):
+    """
+    boto3 client stand-in: KMS returns the ciphertext as the plaintext, every other call fails - the tests replace the
+    clients they need
+    """
+    def __init__(self, serviceName):
+        self.serviceName = serviceName
+        self.meta = types.SimpleNamespace(events=types.SimpleNamespace(register=lambda *args, **kwargs: None))
+
+    def decrypt(self, CiphertextBlob):
+        return {"Plaintext": CiphertextBlob}
+
+    def __getattr__(self, name):
+        raise RuntimeError("No " + self.serviceName + " access in the tests: " + name)
+
+
+class StubClientError(Exception):
+    def __init__(self, error_response, operation_name):
+        super(StubClientError, self).__init__(str(error_response) + " (" + operation_name + ")")
+        self.response = error_response
+        self.operation_name = operation_name
+
+
+def stubModule(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def installStubModules():
+    """
+    Installs stand-ins for the packages of the deployment package that are not installed (boto3, botocore, vstsclient),
+    so the suite runs without them; the installed packages are always used when present
+    """
+    if importlib.util.find_spec("boto3") is None:
+        stubModule("boto3", client=StubAWSClient,
+                   resource=lambda serviceName: types.SimpleNamespace(meta=types.SimpleNamespace(client=StubAWSClient(serviceName))))
+    if importlib.util.find_spec("botocore") is None:
+        stubModule("botocore", __path__=[])
+        stubModule("botocore.exceptions", ClientError=StubClientError)
+    if importlib.util.find_spec("vstsclient") is None:
+        stubModule("vstsclient", __path__=[])
+        stubModule("vstsclient.vstsclient", VstsClient=lambda *args: None)
+        stubModule("vstsclient.constants",
+                   SystemFields=type("SystemFields", (object,), {"TITLE": "/fields/System.Title",
+                                                                 "DESCRIPTION": "/fields/System.Description",
+                                                                 "AREA_PATH": "/fields/System.AreaPath"}),
+                   LinkTypes=type("LinkTypes", (object,), {"PARENT": "System.LinkTypes.Hierarchy-Reverse"}))
+        jsonPatchDocument = type("JsonPatchDocument", (object,), {"__init__": lambda self: setattr(self, "operations", []),
+                                                                  "add": lambda self, operation: self.operations.append(operation)})
+        jsonPatchOperation = type("JsonPatchOperation", (object,), {"__init__": lambda self, op, path, value: self.__dict__.update(op=op, path=path, value=value)})
+        stubModule("vstsclient.models", JsonPatchDocument=jsonPatchDocument, JsonPatchOperation=jsonPatchOperation)
+        stubModule("vstsclient._http", HTTPError=type("HTTPError", (Exception,), {}))
+
+
+installStubModules()
+
+
+class CountdownContext(object):
+    """
+    Lambda context whose time budget runs out after 'admitCount' scheduler checks, so a run defers the emails after
+    the first 'admitCount' ones regardless of how fast they are processed
+    """
+    function_name = "VSTSWorkItemGenerator-test"
+    aws_request_id = "test"
+
+    def __init__(self, admitCount=None):
+        self.admitCount = admitCount
+        self.checks = 0
+
+    def get_remaining_time_in_millis(self):
+        self.checks += 1
+        if self.admitCount is not None and self.checks > self.admitCount:
+            return 0
+        return 900000
+
+
+@pytest.fixture
+def services():
+    from fake_services import FakeIMAPServer, FakeVstsServer, FakeS3Client
+    imapServer = FakeIMAPServer().start()
+    vstsServer = FakeVstsServer().start()
+    yield imapServer, vstsServer, FakeS3Client()
+    for server in (imapServer, vstsServer):
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def generator(services, tmp_path):
+    """
+    The Lambda function module pointed at the stand-ins of benchmarks/fake_services.py, with a cold run state and outbox of its own
+    """
+    import bench_poll
+    imapServer, vstsServer, s3Client = services
+    generator = bench_poll.loadGenerator(imapServer, vstsServer, s3Client)
+    generator.runStateStore = generator.RunStateStore(s3Client, generator.bucket_name, generator.s3_path_runState,
+                                                      str(tmp_path / "RunState.json"))
+    generator.outboxStore = generator.OutboxStore(s3Client, generator.bucket_name, generator.outboxS3KeyEnvVar,
+                                                  str(tmp_path / "Outbox.sqlite"))
+    return generator
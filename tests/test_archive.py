@@ -0,0 +1,66 @@
+"""Processed emails are archived with one command set per run, addressed by UID."""
+import pytest
+
+from fake_services import buildIntakeEmail
+
+from conftest import SENDER, CountdownContext
+
+
+class ArchivingMail(object):
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.commands = []
+
+    def uid(self, command, *args):
+        self.commands.append(("UID " + command.upper(),) + args)
+        return "OK", [None]
+
+    def expunge(self):
+        self.commands.append(("EXPUNGE",))
+        return "OK", [None]
+
+
+def test_one_uid_move_when_the_server_supports_move(generator):
+    mail = ArchivingMail(("IMAP4REV1", "MOVE"))
+    generator.archiveMessages(mail, ["3", "5", "9"], "Archive/ServiceCafe")
+    assert mail.commands == [("UID MOVE", "3,5,9", "Archive/ServiceCafe")]
+
+
+def test_copy_store_and_uid_expunge_without_move(generator):
+    mail = ArchivingMail(("IMAP4REV1", "UIDPLUS"))
+    generator.archiveMessages(mail, ["3", "5"], "Archive/ServiceCafe")
+    assert mail.commands == [("UID COPY", "3,5", "Archive/ServiceCafe"), ("UID STORE", "3,5", "+FLAGS", "(\\Deleted)"),
+                             ("UID EXPUNGE", "3,5")]
+
+
+def test_plain_expunge_without_uidplus(generator):
+    mail = ArchivingMail(("IMAP4REV1",))
+    generator.archiveMessages(mail, ["3"], "Archive/ServiceCafe")
+    assert mail.commands[-1] == ("EXPUNGE",)
+
+
+def test_nothing_to_archive(generator):
+    mail = ArchivingMail(("IMAP4REV1", "MOVE"))
+    generator.archiveMessages(mail, [], "Archive/ServiceCafe")
+    assert mail.commands == []
+
+
+@pytest.mark.parametrize("loginCapabilityCode", [True, False])
+def test_one_uid_move_per_run_with_the_capabilities_of_the_session(generator, services, loginCapabilityCode):
+    imapServer = services[0]
+    # the greeting does not advertise MOVE, the authenticated session does
+    imapServer.loginCapabilityCode = loginCapabilityCode
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(5)])
+    generator.lambda_handler({}, CountdownContext())
+    assert imapServer.inbox == []
+    assert imapServer.counts["UID MOVE"] == 1
+    # imaplib asks once when it connects; the session's capabilities come with LOGIN or from one more CAPABILITY
+    assert imapServer.counts["CAPABILITY"] == (1 if loginCapabilityCode else 2)
+    assert not any(command in imapServer.counts for command in ("UID COPY", "UID STORE", "EXPUNGE", "UID EXPUNGE"))
+
+    # the pooled session keeps its capabilities: the next run neither logs in nor asks for them again
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(5, 8)], imapServer.uidValidity + 1)
+    generator.lambda_handler({}, CountdownContext())
+    assert imapServer.counts["UID MOVE"] == 1
+    assert imapServer.counts["LOGIN"] == 0
+    assert imapServer.counts["CAPABILITY"] == 0
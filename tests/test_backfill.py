@@ -0,0 +1,55 @@
+"""mbox and Maildir exports streamed into VSTS by the backfill command, resumable through its checkpoint."""
+import json
+import os
+
+from fake_services import buildIntakeEmail
+from mail_export import iterExport
+
+from conftest import SENDER
+
+
+def writeMbox(path, rawMessages):
+    with open(path, "wb") as mboxFile:
+        for rawEmail in rawMessages:
+            # body lines starting with "From " are quoted in an mbox file
+            mboxFile.write(b"From " + SENDER.encode("ascii") + b" Thu Sep  6 22:14:02 2018\n" +
+                           rawEmail.replace(b"\nFrom ", b"\n>From ") + b"\n")
+
+
+def test_mbox_messages_are_streamed_unquoted(tmp_path):
+    path = str(tmp_path / "intake.mbox")
+    writeMbox(path, [b"Subject: one\n\nFrom the top\n", b"Subject: two\n\nbody\n", b"Subject: three\n\nbody\n"])
+    messages = list(iterExport(path))
+    assert [index for index, key, rawEmail in messages] == [0, 1, 2]
+    assert messages[0][2] == b"Subject: one\n\nFrom the top\n\n"
+    # the key is the byte offset of the message's "From " line
+    with open(path, "rb") as mboxFile:
+        assert mboxFile.read()[int(messages[1][1].split(":")[1]):].startswith(b"From ")
+    assert [index for index, key, rawEmail in iterExport(path, start=2)] == [2]
+
+
+def test_maildir_messages_are_read_in_delivery_order(tmp_path):
+    for folder, name, body in (("new", "1536272043.M2.host", b"second"), ("cur", "1536272042.M1.host:2,S", b"first")):
+        os.makedirs(str(tmp_path / folder), exist_ok=True)
+        (tmp_path / folder / name).write_bytes(body)
+    assert [(key, rawEmail) for index, key, rawEmail in iterExport(str(tmp_path))] == [
+        ("cur/1536272042.M1.host:2,S", b"first"), ("new/1536272043.M2.host", b"second")]
+
+
+def test_backfill_skips_existing_tasks_and_resumes(generator, services, tmp_path):
+    imapServer, vstsServer, s3Client = services
+    exportPath = str(tmp_path / "intake.mbox")
+    writeMbox(exportPath, [buildIntakeEmail(number, SENDER, 1) for number in range(3)])
+    checkpoint = generator.runBackfill(exportPath, batchEmails=2, workers=2)
+    assert (checkpoint["position"], checkpoint["created"], checkpoint["skipped"]) == (3, 3, 0)
+    assert len(vstsServer.workItems) == 6
+    assert vstsServer.linkCount() == 3
+
+    # the export grows: the finished messages are not read again, and a TASK already in VSTS is skipped
+    writeMbox(exportPath, [buildIntakeEmail(number, SENDER, 1) for number in (0, 1, 2, 2, 3)])
+    checkpoint = generator.runBackfill(exportPath, batchEmails=2, workers=2)
+    assert (checkpoint["position"], checkpoint["created"], checkpoint["skipped"]) == (5, 4, 1)
+    assert len(vstsServer.workItems) == 8
+    with open(exportPath + ".checkpoint.json") as checkpointFile:
+        assert json.load(checkpointFile)["position"] == 5
+    assert generator.runStateStore.get("processedTasks") == ["0000000", "0000001", "0000002", "0000003"]
@@ -0,0 +1,54 @@
+"""The Request, the PBI and their parent link of several emails are created by one $batch call."""
+import bench_poll
+from intake_parser import IntakeRecord
+
+
+class BatchingRestClient(object):
+    """
+    Builds the sub-requests like VstsRestClient and answers a $batch call with the queued 'codes', one per sub-request
+    """
+    baseUrl = "https://benchmark.visualstudio.com"
+
+    def __init__(self, codes=None):
+        self.codes = codes
+        self.batches = []
+
+    def workitem_url(self, workItemID):
+        return self.baseUrl + "/_apis/wit/workitems/" + str(workItemID)
+
+    def create_workitem_request(self, project, workItemType, operations):
+        return {"method": "PATCH", "uri": "/" + project + "/_apis/wit/workitems/$" + workItemType, "body": operations}
+
+    def batch(self, subRequests):
+        self.batches.append(subRequests)
+        codes = self.codes or [200] * len(subRequests)
+        return [(code, {"id": 100 + index} if code == 200 else {"message": "failed"}) for index, code in enumerate(codes)]
+
+
+def cardData(task):
+    return IntakeRecord(None, "TASK" + task, "Title " + task, "<p>Description</p>", task, "GBL-1")
+
+
+def test_two_emails_share_one_batch(generator):
+    restClient = BatchingRestClient()
+    assert generator.createWorkItemPairsBatch(restClient, generator.routeTable.getRoutes()[0], [cardData("0000001"), cardData("0000002")]) == [(100, 101), (102, 103)]
+    assert len(restClient.batches) == 1
+    subRequests = restClient.batches[0]
+    assert [subRequest["uri"].rsplit("$", 1)[1] for subRequest in subRequests] == ["Request", "Product Backlog Item"] * 2
+    assert [subRequest["body"][0] for subRequest in subRequests] == [{"op": "add", "path": "/id", "value": str(tempID)} for tempID in (-1, -2, -3, -4)]
+    # each PBI carries the parent relation to the temporary ID of its own Request
+    relations = [subRequest["body"][-1]["value"] for subRequest in subRequests[1::2]]
+    assert [relation["url"] for relation in relations] == [restClient.workitem_url(-1), restClient.workitem_url(-3)]
+    assert all(relation["rel"] == generator.LinkTypes.PARENT for relation in relations)
+
+
+def test_failed_card_has_no_id(generator):
+    restClient = BatchingRestClient([200, 500])
+    assert generator.createWorkItemPairsBatch(restClient, generator.routeTable.getRoutes()[0], [cardData("0000001")]) == [(100, None)]
+
+
+def test_emails_per_batch_is_clamped(services, monkeypatch):
+    monkeypatch.setenv("vstsEmailsPerBatch", "0")
+    assert bench_poll.loadGenerator(*services).vstsEmailsPerBatchEnvVar == 1
+    monkeypatch.setenv("vstsEmailsPerBatch", "500")
+    assert bench_poll.loadGenerator(*services).vstsEmailsPerBatchEnvVar == 100
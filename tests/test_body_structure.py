@@ -0,0 +1,36 @@
+"""Selection of the text part of a message from its IMAP BODYSTRUCTURE."""
+from intake_parser import findStructurePart
+
+
+def textPart(subtype, encoding="quoted-printable", size=100, charset="utf-8", disposition=None):
+    return ["text", subtype, ["charset", charset], None, None, encoding, str(size), "3", None, disposition, None]
+
+
+ATTACHMENT = ["application", "octet-stream", ["name", "screenshot.bin"], None, None, "base64", "4096", None,
+              ["attachment", ["filename", "screenshot.bin"]], None]
+
+
+def test_single_part_message():
+    assert findStructurePart(textPart("html", size=250)) == ("1", "html", "quoted-printable", "utf-8", 250)
+
+
+def test_html_alternative_is_preferred_over_plain_text():
+    structure = [textPart("plain"), textPart("html", "base64"), "alternative", ["boundary", "b1"], None, None]
+    assert findStructurePart(structure) == ("2", "html", "base64", "utf-8", 100)
+
+
+def test_nested_alternative_beside_an_attachment():
+    alternative = [textPart("plain"), textPart("html", size=8192), "alternative", ["boundary", "b2"], None, None]
+    structure = [alternative, ATTACHMENT, "mixed", ["boundary", "b1"], None, None]
+    assert findStructurePart(structure) == ("1.2", "html", "quoted-printable", "utf-8", 8192)
+
+
+def test_plain_text_is_the_fallback():
+    structure = [textPart("plain", "7bit", charset="iso-8859-1"), ATTACHMENT, "mixed", None, None, None]
+    assert findStructurePart(structure) == ("1", "plain", "7bit", "iso-8859-1", 100)
+
+
+def test_text_attachments_and_non_text_messages_are_skipped():
+    structure = [textPart("html", disposition=["attachment", ["filename", "report.html"]]), textPart("plain"), "mixed", None, None, None]
+    assert findStructurePart(structure)[:2] == ("2", "plain")
+    assert findStructurePart([ATTACHMENT, "mixed", None, None, None]) is None
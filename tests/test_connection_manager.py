@@ -0,0 +1,45 @@
+"""Pooled connections are closed when they are replaced, and a rotated token replaces the client of the old one."""
+from connection_manager import ConnectionManager
+
+
+class Connection(object):
+    def __init__(self, name, alive=True):
+        self.name = name
+        self.alive = alive
+        self.closed = False
+
+
+def test_dead_connection_is_closed_and_replaced():
+    manager = ConnectionManager()
+    closed = []
+    first = manager.get("imap", ("host",), lambda: Connection("first"))
+    assert manager.get("imap", ("host",), lambda: Connection("unused"), lambda connection: connection.alive) is first
+
+    first.alive = False
+    second = manager.get("imap", ("host",), lambda: Connection("second"), lambda connection: connection.alive, closed.append)
+    assert second.name == "second"
+    assert closed == [first]
+    assert manager.report() == {"imap": {"created": 2, "reused": 1}}
+
+
+def test_failing_liveness_check_closes_the_connection():
+    manager = ConnectionManager()
+    closed = []
+    first = manager.get("smtp", ("host",), lambda: Connection("first"))
+
+    def isAlive(connection):
+        raise OSError("connection reset")
+    assert manager.get("smtp", ("host",), lambda: Connection("second"), isAlive, closed.append).name == "second"
+    assert closed == [first]
+
+
+def test_new_token_evicts_the_client_of_the_old_one():
+    manager = ConnectionManager()
+    closed = []
+    old = manager.get("vsts", ("account", "old token"), lambda: Connection("old"), close=closed.append, exclusive=True)
+    other = manager.get("imap", ("host",), lambda: Connection("imap"))
+    new = manager.get("vsts", ("account", "new token"), lambda: Connection("new"), close=closed.append, exclusive=True)
+    assert closed == [old]
+    assert sorted(manager.connections) == [("imap", ("host",)), ("vsts", ("account", "new token"))]
+    assert manager.get("vsts", ("account", "new token"), lambda: Connection("unused"), close=closed.append, exclusive=True) is new
+    assert manager.get("imap", ("host",), lambda: Connection("unused")) is other
@@ -0,0 +1,37 @@
+"""Follow-up emails of a TASK that already has cards are coalesced into updates of those cards."""
+from fake_services import buildIntakeEmail
+
+from conftest import SENDER, CountdownContext
+
+
+def cardsOf(vstsServer, task):
+    return [workItem for workItem in vstsServer.workItems.values() if workItem["fields"].get("GTSKanban.TASK") == task]
+
+
+def test_follow_ups_update_the_existing_cards(generator, services):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(3)], uidValidity=1)
+    generator.lambda_handler({}, CountdownContext())
+    assert len(vstsServer.workItems) == 6
+    description = cardsOf(vstsServer, "0000001")[0]["fields"]["System.Description"]
+
+    # a reminder with the same content and two updates of TASK 1: only the most recent content is written
+    followUps = [buildIntakeEmail(0, SENDER), buildIntakeEmail(1, SENDER, 10), buildIntakeEmail(1, SENDER, 12)]
+    imapServer.reset(followUps, uidValidity=2)
+    generator.lambda_handler({}, CountdownContext())
+
+    assert len(vstsServer.workItems) == 6
+    assert imapServer.inbox == []
+    updated = cardsOf(vstsServer, "0000001")
+    assert len(updated) == 2
+    for workItem in updated:
+        assert len(workItem["fields"]["System.Description"]) > len(description)
+    assert cardsOf(vstsServer, "0000001")[0]["fields"]["System.Description"] == cardsOf(vstsServer, "0000001")[1]["fields"]["System.Description"]
+
+
+def test_follow_up_of_a_task_created_in_the_same_poll_does_not_create_cards(generator, services):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(5, SENDER), buildIntakeEmail(5, SENDER, 10)], uidValidity=1)
+    generator.lambda_handler({}, CountdownContext())
+    assert len(cardsOf(vstsServer, "0000005")) == 2
+    assert imapServer.inbox == []
@@ -0,0 +1,52 @@
+"""IMAP IDLE wakes on new mail, gives up after its timeout with the session still usable, and fails on a BYE."""
+import imaplib
+import threading
+import time
+
+import pytest
+
+from fake_services import buildIntakeEmail
+from idle_daemon import imapIdle
+
+from conftest import SENDER
+
+
+@pytest.fixture
+def mail(services):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(1, SENDER)])
+    mail = imaplib.IMAP4("127.0.0.1", imapServer.port)
+    mail.login("user", "password")
+    mail.select("INBOX")
+    yield mail
+    mail.shutdown()
+
+
+def test_new_mail_ends_the_idle(generator, services, mail):
+    imapServer = services[0]
+    threading.Timer(0.2, imapServer.deliver, [buildIntakeEmail(2, SENDER)]).start()
+    started = time.time()
+    assert imapIdle(mail, 10) is True
+    assert time.time() - started < 5
+    assert mail.noop()[0] == "OK"
+
+
+def test_mail_reported_with_the_continuation_is_not_missed(generator, services, mail):
+    # the EXISTS line arrives in the same read as "+ idling", so it sits in imaplib's buffer rather than the socket
+    services[0].deliver(buildIntakeEmail(2, SENDER))
+    started = time.time()
+    assert imapIdle(mail, 10) is True
+    assert time.time() - started < 5
+
+
+def test_idle_times_out_without_new_mail(generator, mail):
+    assert imapIdle(mail, 0.3) is False
+    # the session is back in its normal state
+    assert mail.noop()[0] == "OK"
+    assert mail.uid("SEARCH", None, "ALL")[1] == [b"1"]
+
+
+def test_bye_while_idling_aborts(generator, services, mail):
+    threading.Timer(0.2, services[0].closeIdleSessions).start()
+    with pytest.raises(imaplib.IMAP4.abort):
+        imapIdle(mail, 10)
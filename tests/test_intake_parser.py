@@ -0,0 +1,37 @@
+"""Intake Request emails are parsed in one pass over the chosen MIME part into an IntakeRecord."""
+from intake_parser import parseIntakeMessage
+
+
+def multipartEmail(htmlPart, plainPart="Plain text version\r\n"):
+    return ("From: servicenow@example.com\r\nSubject: TASK0000042 New request\r\nMIME-Version: 1.0\r\n"
+            "Content-Type: multipart/alternative; boundary=\"XYZ\"\r\n\r\n"
+            "--XYZ\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n" + plainPart +
+            "--XYZ\r\nContent-Type: text/html; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n" + htmlPart +
+            "\r\n--XYZ--\r\n").encode("utf-8")
+
+
+def test_html_part_is_decoded_and_parsed():
+    html = ("Request Name: Caf=C3=A9 dashboard<br>GBL#: GBL-7<br>PyxIS#: PX-9<br>=\r\n"
+            "Link: <a href=3D\"https://example.com/?a=3D1&b=3D2\">here</a><br>")
+    record = parseIntakeMessage(multipartEmail(html), "17")
+    assert record.uid == "17"
+    assert record.task == "0000042"
+    assert record.title == "Café dashboard"
+    assert (record.gbl, record.pyxis) == ("GBL-7", "PX-9")
+    # quoted-printable is decoded rather than stripped of every '='
+    assert "https://example.com/?a=1&b=2" in record.description
+
+
+def test_missing_fields_are_none():
+    record = parseIntakeMessage(multipartEmail("Request Name: Only a title<br>"))
+    assert record.title == "Only a title"
+    assert record.gbl is None
+    assert record.pyxis is None
+
+
+def test_plain_text_is_the_fallback():
+    rawEmail = (b"Subject: TASK0000005 New\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n"
+                b"Request Name: From plain\r\n<b>not markup</b>\r\n")
+    record = parseIntakeMessage(rawEmail)
+    assert record.title == "From plain"
+    assert "&lt;b&gt;not markup&lt;/b&gt;" in record.description
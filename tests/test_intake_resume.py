@@ -0,0 +1,59 @@
+"""A run cut short by the Lambda deadline, resumed by the next run."""
+import json
+
+from fake_services import buildIntakeEmail
+
+from conftest import SENDER, CountdownContext
+
+
+def cardTasks(vstsServer):
+    return sorted(workItem["fields"].get("GTSKanban.TASK") for workItem in vstsServer.workItems.values())
+
+
+def test_deferred_emails_are_created_by_the_resume_run(generator, services):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(6)])
+
+    generator.lambda_handler({}, CountdownContext(admitCount=2))
+    assert cardTasks(vstsServer) == ["0000000", "0000000", "0000001", "0000001"]
+    assert len(imapServer.inbox) == 4
+    assert generator.runStateStore.get("resumeCursor")["uids"] == [3, 4, 5, 6]
+
+    # no new mail: the resumed emails only come from the cursor, above the UID watermark
+    generator.lambda_handler({}, CountdownContext())
+    assert cardTasks(vstsServer) == sorted(["%07d" % number for number in range(6)] * 2)
+    assert vstsServer.linkCount() == 6
+    assert imapServer.inbox == []
+    assert generator.runStateStore.get("resumeCursor")["uids"] == []
+    assert "" not in generator.runStateStore.get("processedTasks")
+
+
+def test_emails_without_a_task_number_are_not_follow_ups_of_each_other(generator, services):
+    imapServer, vstsServer, s3Client = services
+    rawMessages = [buildIntakeEmail(number, SENDER).replace(b"TASK%07d" % number, b"TASK") for number in range(3)]
+    imapServer.reset(rawMessages)
+
+    generator.lambda_handler({}, CountdownContext())
+    assert len(vstsServer.workItems) == 6
+    assert "" not in (generator.runStateStore.get("processedTasks") or [])
+
+
+def test_scheduler_refuses_every_email_after_the_first_refused_one(generator):
+    remaining = [900000, 900000, 0, 900000]
+    scheduler = generator.DeadlineScheduler(lambda: remaining.pop(0), safetySeconds=1.0, defaultEmailSeconds=1.0)
+    assert [scheduler.admit(UIDNum) for UIDNum in ("3", "4", "5", "6")] == [True, True, False, False]
+    assert scheduler.deferredUIDs(["3", "4", "5", "6"]) == ["5", "6"]
+
+
+def test_resume_chain_is_capped(generator, monkeypatch):
+    invocations = []
+
+    class LambdaClient(object):
+        def invoke(self, FunctionName, InvocationType, Payload):
+            invocations.append((FunctionName, InvocationType, json.loads(Payload)))
+
+    monkeypatch.setattr(generator.boto3, "client", lambda serviceName: LambdaClient())
+    context = type("Context", (object,), {"invoked_function_arn": "arn:aws:lambda:function:generator"})()
+    generator.resumeBacklog({}, context)
+    generator.resumeBacklog({"resumeDepth": generator.maxResumeChainEnvVar}, context)
+    assert invocations == [("arn:aws:lambda:function:generator", "Event", {"resumeDepth": 1})]
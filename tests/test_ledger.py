@@ -0,0 +1,98 @@
+"""ProcessedTaskLedger: exact entries, the fold into rotating Bloom filter generations, and its NO/YES/MAYBE answers."""
+from fake_services import FakeS3Client
+from run_state import RunStateStore, ProcessedTaskLedger, BloomFilter
+
+
+def loadedStore(s3Client, tmp_path, name="store"):
+    store = RunStateStore(s3Client, "bucket", "RunState.json", str(tmp_path / (name + ".json")))
+    store.load()
+    return store
+
+
+def test_exact_entries_answer_yes_and_unknown_tasks_no(tmp_path):
+    ledger = ProcessedTaskLedger(loadedStore(FakeS3Client(), tmp_path), exactLimit=10)
+    ledger.add(["0000001", "0000002"])
+    assert ledger.check("0000001") == ProcessedTaskLedger.YES
+    assert ledger.check("0000003") == ProcessedTaskLedger.NO
+
+
+def test_empty_task_is_never_recorded(tmp_path):
+    store = loadedStore(FakeS3Client(), tmp_path)
+    ledger = ProcessedTaskLedger(store, exactLimit=10)
+    ledger.add(["", "0000001"])
+    assert store.get("processedTasks") == ["0000001"]
+    assert ledger.check("") == ProcessedTaskLedger.NO
+
+
+def test_folded_entries_answer_maybe_after_a_reload(tmp_path):
+    s3Client = FakeS3Client()
+    store = loadedStore(s3Client, tmp_path)
+    ledger = ProcessedTaskLedger(store, exactLimit=3)
+    ledger.add(["0000001", "0000002"])
+    ledger.add(["0000003"])
+    # the exact set reached its limit: it is folded into the Bloom filter and emptied
+    assert store.get("processedTasks") == []
+    assert len(store.get("processedTaskBlooms")) == 1
+    store.flush()
+
+    reloaded = ProcessedTaskLedger(loadedStore(s3Client, tmp_path, "reloaded"), exactLimit=3)
+    for task in ("0000001", "0000002", "0000003"):
+        assert reloaded.check(task) == ProcessedTaskLedger.MAYBE
+    assert reloaded.check("0009999") == ProcessedTaskLedger.NO
+    reloaded.add(["0000004"])
+    assert reloaded.check("0000004") == ProcessedTaskLedger.YES
+
+
+def test_overlapping_folds_keep_both_filters(tmp_path):
+    s3Client = FakeS3Client()
+    firstStore = loadedStore(s3Client, tmp_path, "first")
+    secondStore = loadedStore(s3Client, tmp_path, "second")
+    ProcessedTaskLedger(firstStore, exactLimit=2).add(["0000001", "0000002"])
+    ProcessedTaskLedger(secondStore, exactLimit=2).add(["0000003", "0000004"])
+    firstStore.flush()
+    secondStore.flush()
+
+    merged = ProcessedTaskLedger(loadedStore(s3Client, tmp_path, "merged"), exactLimit=2)
+    for task in ("0000001", "0000002", "0000003", "0000004"):
+        assert merged.check(task) == ProcessedTaskLedger.MAYBE
+
+
+def test_each_generation_is_sized_for_the_tasks_folded_into_it(tmp_path):
+    store = loadedStore(FakeS3Client(), tmp_path)
+    ledger = ProcessedTaskLedger(store, exactLimit=100, maxGenerations=10, bloomErrorRate=0.01)
+    ledger.add(["%07d" % number for number in range(100)])
+    generation = store.get("processedTaskBlooms")[0]
+    assert generation["count"] == 100
+    expected = BloomFilter.forCapacity(100, 0.001)
+    assert (generation["bitCount"], generation["hashCount"]) == (expected.bitCount, expected.hashCount)
+
+
+def test_oldest_generation_is_dropped(tmp_path):
+    s3Client = FakeS3Client()
+    store = loadedStore(s3Client, tmp_path)
+    ledger = ProcessedTaskLedger(store, exactLimit=2, maxGenerations=2)
+    for first in range(1, 7, 2):
+        ledger.add(["%07d" % first, "%07d" % (first + 1)])
+    assert len(store.get("processedTaskBlooms")) == 2
+    store.flush()
+
+    reloaded = ProcessedTaskLedger(loadedStore(s3Client, tmp_path, "reloaded"), exactLimit=2, maxGenerations=2)
+    assert [reloaded.check("%07d" % number) for number in range(1, 7)] == [ProcessedTaskLedger.NO] * 2 + [ProcessedTaskLedger.MAYBE] * 4
+
+
+def test_legacy_filter_becomes_the_oldest_generation(tmp_path):
+    s3Client = FakeS3Client()
+    store = loadedStore(s3Client, tmp_path)
+    legacy = BloomFilter.forCapacity(200000, 0.001)
+    legacy.add("0000001")
+    store.set("processedTasksBloom", legacy.toDict())
+
+    ledger = ProcessedTaskLedger(store, exactLimit=2, maxGenerations=2)
+    assert ledger.check("0000001") == ProcessedTaskLedger.MAYBE
+    ledger.add(["0000002", "0000003"])
+    assert store.get("processedTasksBloom") is None
+    assert [generation["id"] for generation in store.get("processedTaskBlooms")][0] == "legacy"
+    ledger.add(["0000004", "0000005"])
+    # the legacy filter rotates out like any other generation
+    assert ledger.check("0000001") == ProcessedTaskLedger.NO
+    assert ledger.check("0000002") == ProcessedTaskLedger.MAYBE
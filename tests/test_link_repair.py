@@ -0,0 +1,34 @@
+"""The link repair sweep finds the Request/PBI pairs created without their parent/child link and links them."""
+
+
+def createCard(vstsServer, workItemType, task, parentID=None):
+    operations = [{"op": "add", "path": "/fields/System.Title", "value": "Title"},
+                  {"op": "add", "path": "/fields/GTSKanban.TASK", "value": task}]
+    if parentID is not None:
+        operations.append({"op": "add", "path": "/relations/-", "value": {
+            "rel": "System.LinkTypes.Hierarchy-Reverse", "url": vstsServer.baseUrl + "/_apis/wit/workitems/" + str(parentID)}})
+    return vstsServer.createWorkItem(workItemType, operations, {})["id"]
+
+
+def test_missing_links_are_reported_then_created(generator, services):
+    imapServer, vstsServer, s3Client = services
+    route = generator.routeTable.getRoutes()[0]
+    linkedRequest = createCard(vstsServer, route.requestType, "0000001")
+    createCard(vstsServer, route.pbiType, "0000001", linkedRequest)
+    brokenRequest = createCard(vstsServer, route.requestType, "0000002")
+    brokenPBI = createCard(vstsServer, route.pbiType, "0000002")
+    createCard(vstsServer, route.pbiType, "0000003")
+    restClient = generator.VSTS_Rest_Client_Connection(generator.vstsWIAccountEnvVar, "benchmark")
+
+    summary = generator.repairParentLinks(restClient, route, dryRun=True)
+    assert (summary["workItems"], summary["tasks"], summary["missing"], summary["linked"]) == (5, 3, 1, 0)
+    assert summary["unpairedTasks"] == ["0000003"]
+    assert vstsServer.linkCount() == 1
+
+    summary = generator.repairParentLinks(restClient, route)
+    assert (summary["missing"], summary["linked"], summary["failed"], summary["failedLinks"]) == (1, 1, 0, [])
+    relations = vstsServer.workItems[brokenPBI]["relations"]
+    assert [(relation["rel"], relation["url"].rsplit("/", 1)[1]) for relation in relations] == [
+        ("System.LinkTypes.Hierarchy-Reverse", str(brokenRequest))]
+
+    assert generator.repairParentLinks(restClient, route)["missing"] == 0
@@ -0,0 +1,55 @@
+"""Stage spans and call counters of one invocation, emitted as a single CloudWatch Embedded Metric Format record."""
+import json
+
+import bench_poll
+from metrics import InvocationMetrics, MAX_EMF_VALUES
+
+
+def test_record_holds_every_span_and_counter():
+    metrics = InvocationMetrics("VSTSWorkItemGenerator")
+    with metrics.span("fetch"):
+        pass
+    with metrics.span("create"):
+        pass
+    with metrics.span("create"):
+        pass
+    metrics.count("VSTSCalls")
+    metrics.count("VSTSCalls", 2)
+    record = metrics.embeddedMetricRecord({"FunctionName": "test"})
+    assert record["FunctionName"] == "test"
+    assert isinstance(record["fetchTime"], float)
+    assert len(record["createTime"]) == 2
+    assert record["VSTSCalls"] == 3
+    definitions = record["_aws"]["CloudWatchMetrics"][0]
+    assert definitions["Dimensions"] == [["FunctionName"]]
+    assert {"Name": "VSTSCalls", "Unit": "Count"} in definitions["Metrics"]
+    assert {"Name": "createTime", "Unit": "Milliseconds"} in definitions["Metrics"]
+
+
+def test_overflowing_spans_keep_their_total():
+    metrics = InvocationMetrics("VSTSWorkItemGenerator")
+    metrics.spans["create"] = [1.0] * (MAX_EMF_VALUES + 20)
+    record = metrics.embeddedMetricRecord({"FunctionName": "test"})
+    assert len(record["createTime"]) == MAX_EMF_VALUES
+    assert sum(record["createTime"]) == MAX_EMF_VALUES + 20
+
+
+def test_debug_is_only_printed_at_debug_level(capsys):
+    InvocationMetrics("VSTSWorkItemGenerator", "INFO").debug("payload")
+    assert capsys.readouterr().out == ""
+    InvocationMetrics("VSTSWorkItemGenerator", "debug").debug("payload")
+    assert capsys.readouterr().out == "payload\n"
+
+
+def test_poll_emits_one_record(generator, services, capsys):
+    imapServer, vstsServer, s3Client = services
+    bench_poll.runPoll(generator, imapServer, vstsServer, s3Client, 5, 0, 0.0, 1, verbose=True)
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"')]
+    assert len(records) == 1
+    record = records[0]
+    assert record["IntakeEmails"] == 4
+    assert record["WorkItemsCreated"] == 8
+    assert record["VSTSCalls"] == sum(vstsServer.counts.values())
+    assert record["IMAPCommands"] == sum(imapServer.counts.values())
+    for stage in ("search", "fetch", "create", "archive", "stateIO"):
+        assert stage + "Time" in record
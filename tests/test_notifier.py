@@ -0,0 +1,40 @@
+"""Who receives which notification events: alerts by default, the digests of created cards on request only."""
+import pytest
+
+from notifier import ALERT_KINDS, CREATED, EVENT_KINDS, RUN_FAILED, DigestNotifier, loadRecipients
+
+
+def test_default_recipient_receives_the_alerts_only():
+    for configText in (None, "", "  "):
+        assert loadRecipients(configText, "admin@example.com") == [("admin@example.com", ALERT_KINDS)]
+    assert CREATED not in ALERT_KINDS
+
+
+def test_created_card_digests_are_opt_in():
+    recipients = loadRecipients('{"architecture@example.com": "*", "pmo@example.com": ["created"], '
+                                '"vsts-admins@example.com": ["runFailed"]}', "admin@example.com")
+    assert recipients == [("architecture@example.com", EVENT_KINDS), ("pmo@example.com", (CREATED,)),
+                          ("vsts-admins@example.com", (RUN_FAILED,))]
+
+
+def test_unknown_event_kind_is_refused():
+    with pytest.raises(ValueError):
+        loadRecipients('{"admin@example.com": ["cardCreated"]}', "admin@example.com")
+
+
+def test_created_cards_are_not_mailed_to_the_default_recipient(generator):
+    generator.runStateStore.load()
+    notifier = DigestNotifier(loadRecipients(None, "admin@example.com"))
+    notifier.record(CREATED, "TASK0000001: Request 101, PBI 102")
+    sentMessages = []
+
+    def send(messages):
+        sentMessages.extend(messages)
+        return [address for address, subject, body in messages]
+
+    assert notifier.deliver(generator.runStateStore, send) == (0, 0)
+    assert sentMessages == []
+    notifier.record(RUN_FAILED, "Run failed: timeout", "run")
+    assert notifier.deliver(generator.runStateStore, send) == (1, 0)
+    assert [address for address, subject, body in sentMessages] == ["admin@example.com"]
+    assert "TASK0000001" not in sentMessages[0][2]
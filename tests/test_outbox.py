@@ -0,0 +1,62 @@
+"""The SQLite outbox between the ingest and drain stages: durable records, merged concurrent writes, set-aside failures."""
+from fake_services import FakeS3Client, buildIntakeEmail
+from intake_parser import IntakeRecord
+from outbox import OutboxStore, outboxKey
+
+from conftest import SENDER, CountdownContext
+
+
+def newOutbox(s3Client, tmp_path, name, maxAttempts=10):
+    outbox = OutboxStore(s3Client, "bucket", "Outbox.sqlite", str(tmp_path / (name + ".sqlite")), maxAttempts)
+    outbox.load()
+    return outbox
+
+
+def record(task):
+    return IntakeRecord(task, "TASK" + task + " New request", "Title " + task, "<p>" + task + "</p>", task)
+
+
+def test_concurrent_stages_are_merged(tmp_path):
+    s3Client = FakeS3Client()
+    ingest = newOutbox(s3Client, tmp_path, "ingest")
+    assert ingest.add("default", [record("0000001"), record("0000002")]) == 2
+    assert ingest.flush() is True
+
+    drain = newOutbox(s3Client, tmp_path, "drain")
+    assert [pending.task for pending in drain.pending("default", 10)] == ["0000001", "0000002"]
+    drain.markDone([outboxKey("default", record("0000001"))])
+    assert drain.flush() is True
+
+    # the ingest stage still holds the ETag read before the drain wrote: its PUT is refused and the copies are merged
+    ingest.add("default", [record("0000003"), record("0000001")])
+    assert ingest.flush() is True
+
+    merged = newOutbox(s3Client, tmp_path, "merged")
+    assert merged.counts() == {("default", "done"): 1, ("default", "pending"): 2}
+    assert [pending.task for pending in merged.pending("default", 10)] == ["0000002", "0000003"]
+
+
+def test_record_is_set_aside_after_its_last_attempt(tmp_path):
+    outbox = newOutbox(None, tmp_path, "local", maxAttempts=2)
+    outbox.add("default", [record("0000001")])
+    key = outboxKey("default", record("0000001"))
+    assert outbox.markAttempted([key]) == []
+    assert outbox.markAttempted([key]) == [key]
+    assert outbox.pending("default", 10) == []
+    assert outbox.counts() == {("default", "failed"): 1}
+
+
+def test_ingest_then_drain_creates_every_card(generator, services):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(4)])
+
+    generator.lambda_handler({"mode": "ingest"}, CountdownContext())
+    # the emails are archived once their records are in the outbox, before any card exists
+    assert imapServer.inbox == []
+    assert vstsServer.workItems == {}
+    assert generator.outboxStore.counts() == {("default", "pending"): 4}
+
+    generator.lambda_handler({"mode": "drain"}, CountdownContext())
+    assert len(vstsServer.workItems) == 8
+    assert vstsServer.linkCount() == 4
+    assert generator.outboxStore.counts() == {("default", "done"): 4}
@@ -0,0 +1,48 @@
+"""The parent/child link uses the IDs of the cards just created, and a WIQL lookup on the TASK Number for a missing one."""
+import pytest
+
+from intake_parser import IntakeRecord
+
+
+class RecordingRestClient(object):
+    """
+    Records the links added, and answers every WIQL query with the IDs queued in 'results', in order
+    """
+    def __init__(self, *results):
+        self.results = list(results)
+        self.queries = []
+        self.links = []
+
+    def query_workitem_ids(self, wiqlQuery, project):
+        self.queries.append(wiqlQuery)
+        return self.results.pop(0)
+
+    def add_link(self, sourceWorkItemID, targetWorkItemID, linkType, comment=""):
+        self.links.append((sourceWorkItemID, targetWorkItemID, linkType))
+
+
+def cardData(task):
+    return IntakeRecord(None, "TASK" + task, "Title", "<p>Description</p>", task)
+
+
+def test_created_ids_are_linked_without_a_lookup(generator):
+    restClient = RecordingRestClient()
+    assert generator.parentToChildConnection(restClient, generator.routeTable.getRoutes()[0], cardData("0000007"), 101, 102) == (101, 102)
+    assert restClient.links == [(102, 101, generator.LinkTypes.PARENT)]
+    assert restClient.queries == []
+
+
+def test_missing_id_is_looked_up_by_task(generator):
+    restClient = RecordingRestClient([205, 180])
+    assert generator.parentToChildConnection(restClient, generator.routeTable.getRoutes()[0], cardData("0000007"), 101, None) == (101, 205)
+    assert len(restClient.queries) == 1
+    assert "[GTSKanban.TASK] = '0000007'" in restClient.queries[0]
+    assert "[System.WorkItemType] = 'Product Backlog Item'" in restClient.queries[0]
+    assert restClient.links == [(205, 101, generator.LinkTypes.PARENT)]
+
+
+def test_no_link_when_a_card_cannot_be_found(generator):
+    restClient = RecordingRestClient([], [])
+    with pytest.raises(LookupError):
+        generator.parentToChildConnection(restClient, generator.routeTable.getRoutes()[0], cardData("0000007"))
+    assert restClient.links == []
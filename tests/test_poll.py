@@ -0,0 +1,17 @@
+"""One lambda_handler poll end to end against the stand-ins of benchmarks/fake_services.py."""
+import bench_poll
+
+
+def test_poll_creates_every_card_and_archives_the_intake_mail(generator, services):
+    imapServer, vstsServer, s3Client = services
+    result = bench_poll.runPoll(generator, imapServer, vstsServer, s3Client, 10, 0, 0.0, 1)
+    # runPoll already checked two cards and one link per Intake Request
+    assert result["intake"] == 8
+    assert len(imapServer.inbox) == 2
+    assert sum(len(messages) for messages in imapServer.archived.values()) == 8
+
+
+def test_vsts_round_trips_do_not_grow_with_the_id_gap(generator, services):
+    imapServer, vstsServer, s3Client = services
+    perGap = [bench_poll.runPoll(generator, imapServer, vstsServer, s3Client, 10, idGap, 0.0, 1)["vsts"] for idGap in (0, 1000)]
+    assert perGap[0] == perGap[1]
@@ -0,0 +1,65 @@
+"""An invocation is profiled only on demand, and its results are written under the invocation ID even when it fails."""
+import marshal
+import threading
+
+import pytest
+
+from profiling import InvocationProfiler, profileModes
+
+from conftest import CountdownContext
+
+
+def test_profile_modes():
+    assert profileModes({}) == ()
+    assert profileModes({"profile": "cpu"}) == ("cpu",)
+    assert profileModes({"profile": "memory, CPU"}) == ("cpu", "memory")
+    assert profileModes({"profile": True}) == ("cpu", "memory")
+    assert profileModes({"profile": ["memory"]}) == ("memory",)
+    assert profileModes({"profile": ""}, "all") == ()
+    assert profileModes({}, "memory") == ("memory",)
+    assert profileModes(None, "cpu") == ("cpu",)
+
+
+def workerCall():
+    return sum(range(1000))
+
+
+def handler(event, context):
+    workers = [threading.Thread(target=workerCall) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if event.get("fail"):
+        raise RuntimeError("failed")
+    return "done"
+
+
+def test_only_requested_invocations_are_profiled():
+    written = {}
+    profiler = InvocationProfiler(lambda invocationID, name, data: written.setdefault((invocationID, name), data))
+    profiledHandler = profiler.profiled(lambda: "")(handler)
+
+    assert profiledHandler({}, CountdownContext()) == "done"
+    assert written == {}
+
+    assert profiledHandler({"profile": "cpu,memory"}, CountdownContext()) == "done"
+    assert sorted(written) == [("test", "cpu.prof"), ("test", "cpu.txt"), ("test", "memory.txt")]
+    # the calls of the worker threads are merged into the statistics of the invocation
+    assert any(function[2] == "workerCall" for function in marshal.loads(written[("test", "cpu.prof")]))
+    assert b"workerCall" in written[("test", "cpu.txt")]
+    assert written[("test", "memory.txt")].startswith(b"Traced memory: current ")
+
+
+def test_results_of_a_failed_invocation_are_written():
+    written = {}
+    profiler = InvocationProfiler(lambda invocationID, name, data: written.setdefault(name, data))
+    with pytest.raises(RuntimeError):
+        profiler.profiled(lambda: "cpu")(handler)({"fail": True}, CountdownContext())
+    assert sorted(written) == ["cpu.prof", "cpu.txt"]
+
+
+def test_write_failure_does_not_fail_the_invocation():
+    def failingWrite(invocationID, name, data):
+        raise IOError("bucket unavailable")
+    assert InvocationProfiler(failingWrite).profiled()(handler)({"profile": "memory"}, CountdownContext()) == "done"
@@ -0,0 +1,41 @@
+"""Raw .eml objects pushed to S3 are processed once per object event, however often the event is delivered."""
+import json
+
+from fake_services import buildIntakeEmail
+
+from conftest import SENDER, CountdownContext
+
+
+def objectEvent(*keys):
+    return {"Records": [{"s3": {"bucket": {"name": "incoming"}, "object": {"key": key, "eTag": "etag-" + key}}} for key in keys]}
+
+
+def test_redelivered_event_is_processed_once(generator, services):
+    imapServer, vstsServer, s3Client = services
+    s3Client.put_object(Bucket="incoming", Key="mail/0001.eml", Body=buildIntakeEmail(1, SENDER))
+    s3Client.put_object(Bucket="incoming", Key="mail/0002.eml", Body=buildIntakeEmail(2, SENDER, intake=False))
+
+    results = generator.s3_event_handler(objectEvent("mail/0001.eml", "mail/0002.eml"), CountdownContext())
+    assert results == {"s3://incoming/mail/0001.eml": "processed", "s3://incoming/mail/0002.eml": "processed"}
+    assert len(vstsServer.workItems) == 2
+    assert vstsServer.linkCount() == 1
+
+    results = generator.s3_event_handler(objectEvent("mail/0001.eml"), CountdownContext())
+    assert results == {"s3://incoming/mail/0001.eml": "duplicate"}
+    assert len(vstsServer.workItems) == 2
+
+
+def test_stale_claim_is_taken_over(generator, services):
+    imapServer, vstsServer, s3Client = services
+    markerKey = "marker.json"
+    assert generator.claimPushedEmail(markerKey) is True
+    # claimed by an invocation still running
+    assert generator.claimPushedEmail(markerKey) is False
+
+    s3Client.put_object(Bucket=generator.bucket_name, Key=markerKey,
+                        Body=json.dumps({"status": "claimed", "at": 0}).encode("utf-8"))
+    assert generator.claimPushedEmail(markerKey) is True
+
+    s3Client.put_object(Bucket=generator.bucket_name, Key=markerKey,
+                        Body=json.dumps({"status": "done", "at": 0}).encode("utf-8"))
+    assert generator.claimPushedEmail(markerKey) is False
@@ -0,0 +1,75 @@
+"""Several mailbox -> VSTS project routes served by one deployment, each with a run state of its own."""
+import json
+
+import pytest
+
+from fake_services import buildIntakeEmail
+from routes import RouteTable, loadRoutes
+
+from conftest import SENDER, CountdownContext
+
+
+DEFAULTS = {"name": "default", "mailbox": "INBOX", "sender": SENDER, "subjectPattern": "^TASK", "project": "Architecture",
+            "areaPath": "GTS Architecture\\Architecture", "requestType": "Request", "pbiType": "Product Backlog Item",
+            "archiveMailbox": "Archive/ServiceCafe", "stateKey": "RunState.json"}
+
+
+def test_without_a_table_the_single_default_route_is_used():
+    routes = loadRoutes(None, DEFAULTS)
+    assert [(route.name, route.stateKey) for route in routes] == [("default", "RunState.json")]
+
+
+def test_routes_take_the_defaults_and_a_state_object_of_their_own():
+    routes = loadRoutes(json.dumps([{"name": "ops", "project": "Operations"}, {"name": "legacy", "stateKey": "RunState.json"}]), DEFAULTS)
+    assert [(route.name, route.project, route.stateKey) for route in routes] == [
+        ("ops", "Operations", "RunState-ops.json"), ("legacy", "Architecture", "RunState.json")]
+    assert routes[0].isIntakeSubject("TASK0000001 New request")
+    assert not routes[0].isIntakeSubject("Your request was closed")
+
+
+@pytest.mark.parametrize("config", [
+    [],
+    [{"mailbox": "INBOX"}],
+    [{"name": "ops", "color": "red"}],
+    [{"name": "ops"}, {"name": "ops"}],
+    [{"name": "one", "stateKey": "shared.json"}, {"name": "two", "stateKey": "shared.json"}],
+])
+def test_invalid_tables_are_refused(config):
+    with pytest.raises(ValueError):
+        loadRoutes(json.dumps(config), DEFAULTS)
+
+
+def test_route_table_is_read_once_and_matches_sender_and_subject():
+    reads = []
+    table = RouteTable(lambda: reads.append(1) or json.dumps([{"name": "ops", "subjectPattern": "^OPS"}, {"name": "tasks"}]),
+                       DEFAULTS, lambda stateKey: {"key": stateKey})
+    assert table.find().name == "ops" and table.find("tasks").name == "tasks"
+    with pytest.raises(ValueError):
+        table.find("missing")
+    assert table.match({"From": "ServiceNow <" + SENDER + ">", "Subject": "TASK0000001 New request"})[0].name == "tasks"
+    assert table.match({"From": "someone@example.com", "Subject": "TASK0000001 New request"}) == (None, "TASK0000001 New request")
+    route = table.find("ops")
+    assert table.stateStore(route) is table.stateStore(route) and table.stateStore(route)["key"] == "RunState-ops.json"
+    assert reads == [1]
+
+
+def test_every_route_creates_its_own_cards(generator, services, tmp_path):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(6)])
+    generator.routeTable.routes = loadRoutes(json.dumps([
+        {"name": "low", "subjectPattern": "^TASK000000[0-2]", "areaPath": "GTS Architecture\\Low"},
+        {"name": "high", "subjectPattern": "^TASK000000[3-5]", "areaPath": "GTS Architecture\\High"},
+    ]), generator.defaultRouteAttributes)
+    for route in generator.routeTable.routes:
+        generator.routeTable.stateStores[route.stateKey] = generator.RunStateStore(s3Client, generator.bucket_name, route.stateKey,
+                                                                                   str(tmp_path / route.stateKey))
+
+    generator.lambda_handler({}, CountdownContext())
+    areaPaths = sorted((workItem["fields"]["GTSKanban.TASK"], workItem["fields"]["System.AreaPath"])
+                       for workItem in vstsServer.workItems.values())
+    assert areaPaths == sorted([("%07d" % number, "GTS Architecture\\Low") for number in range(3)] * 2 +
+                               [("%07d" % number, "GTS Architecture\\High") for number in range(3, 6)] * 2)
+    assert vstsServer.linkCount() == 6
+    assert imapServer.inbox == []
+    # every route keeps its watermark in its own run state; the shared one is not written by a run without alerts
+    assert sorted(s3Client.objects) == [(generator.bucket_name, "RunState-high.json"), (generator.bucket_name, "RunState-low.json")]
@@ -0,0 +1,88 @@
+"""RunStateStore: conditional writes, replay of the buffered operations on a conflict, and the /tmp warm cache."""
+from fake_services import FakeS3Client
+from run_state import RunStateStore
+
+
+BUCKET = "bucket"
+KEY = "RunState.json"
+
+
+def newStore(s3Client, tmp_path, name):
+    return RunStateStore(s3Client, BUCKET, KEY, str(tmp_path / (name + ".json")))
+
+
+def test_first_write_creates_the_document(tmp_path):
+    s3Client = FakeS3Client()
+    store = newStore(s3Client, tmp_path, "first")
+    assert store.load() is False
+    assert store.flush() is False
+    store.setMax("workItemIDNumber", 12)
+    assert store.flush() is True
+
+    reader = newStore(s3Client, tmp_path, "reader")
+    assert reader.load() is True
+    assert reader.get("workItemIDNumber") == 12
+
+
+def test_conflicting_writes_are_merged(tmp_path):
+    s3Client = FakeS3Client()
+    seed = newStore(s3Client, tmp_path, "seed")
+    seed.load()
+    seed.setWatermark("imapUIDWatermark", 7, 10)
+    seed.addToSet("processedTasks", ["0000001"])
+    seed.flush()
+
+    first = newStore(s3Client, tmp_path, "first")
+    second = newStore(s3Client, tmp_path, "second")
+    first.load()
+    second.load()
+
+    second.addToSet("processedTasks", ["0000002"])
+    second.setMax("workItemIDNumber", 40)
+    second.setWatermark("imapUIDWatermark", 7, 25)
+    second.flush()
+
+    # 'first' still holds the ETag read before 'second' wrote: its PUT is refused, and its operations are replayed
+    first.addToSet("processedTasks", ["0000003"])
+    first.setMax("workItemIDNumber", 30)
+    first.setWatermark("imapUIDWatermark", 7, 20)
+    first.set("tokenEmailSendDate", "Year: 2018 Month: 9 Day: 6")
+    puts = s3Client.counts["put"]
+    assert first.flush() is True
+    assert s3Client.counts["put"] == puts + 2
+
+    merged = newStore(s3Client, tmp_path, "merged")
+    merged.load()
+    assert merged.get("processedTasks") == ["0000001", "0000002", "0000003"]
+    assert merged.get("workItemIDNumber") == 40
+    assert merged.get("imapUIDWatermark") == {"uidValidity": 7, "lastUID": 25}
+    assert merged.get("tokenEmailSendDate") == "Year: 2018 Month: 9 Day: 6"
+
+
+def test_watermark_of_a_new_uidvalidity_replaces_the_old_one(tmp_path):
+    s3Client = FakeS3Client()
+    store = newStore(s3Client, tmp_path, "store")
+    store.load()
+    store.setWatermark("imapUIDWatermark", 7, 500)
+    store.setWatermark("imapUIDWatermark", 8, 3)
+    assert store.get("imapUIDWatermark") == {"uidValidity": 8, "lastUID": 3}
+
+
+def test_warm_cache_skips_the_download(tmp_path):
+    s3Client = FakeS3Client()
+    store = newStore(s3Client, tmp_path, "store")
+    store.load()
+    store.addToSet("processedTasks", ["0000001"])
+    store.flush()
+
+    # a warm container: the cached ETag is current, so the conditional GET returns 304 and no body
+    warm = newStore(s3Client, tmp_path, "store")
+    assert warm.load() is True
+    assert warm.get("processedTasks") == ["0000001"]
+
+    other = newStore(s3Client, tmp_path, "other")
+    other.load()
+    other.addToSet("processedTasks", ["0000002"])
+    other.flush()
+    assert warm.load() is True
+    assert warm.get("processedTasks") == ["0000001", "0000002"]
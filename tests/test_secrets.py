@@ -0,0 +1,49 @@
+"""KMS secrets are decrypted on first use by a single client and reused until their TTL expires."""
+from base64 import b64encode
+
+
+class CountingKMSClient(object):
+    def __init__(self):
+        self.decrypts = []
+
+    def decrypt(self, CiphertextBlob):
+        self.decrypts.append(CiphertextBlob)
+        return {"Plaintext": b"plain-" + CiphertextBlob}
+
+
+def providerWithClients(generator, monkeypatch, ttlSeconds):
+    clients = []
+
+    def client(serviceName):
+        clients.append(CountingKMSClient())
+        return clients[-1]
+
+    monkeypatch.setattr(generator.boto3, "client", client)
+    return generator.SecretsProvider(ttlSeconds), clients
+
+
+def test_nothing_is_decrypted_at_import(generator, monkeypatch):
+    provider, clients = providerWithClients(generator, monkeypatch, 3600)
+    assert clients == []
+
+
+def test_secret_is_cached_by_one_client(generator, monkeypatch):
+    provider, clients = providerWithClients(generator, monkeypatch, 3600)
+    provider.register("first", lambda: b64encode(b"one").decode("ascii"))
+    provider.register("second", lambda: b64encode(b"two").decode("ascii"))
+    assert provider.getSecret("first") == "plain-one"
+    assert provider.getSecret("first") == "plain-one"
+    assert provider.getSecret("second") == "plain-two"
+    assert len(clients) == 1
+    assert clients[0].decrypts == [b"one", b"two"]
+
+
+def test_expired_secret_is_decrypted_again_only_when_rotated(generator, monkeypatch):
+    provider, clients = providerWithClients(generator, monkeypatch, 0)
+    ciphertexts = [b64encode(b"old").decode("ascii")]
+    provider.register("token", lambda: ciphertexts[-1])
+    assert provider.getSecret("token") == "plain-old"
+    assert provider.getSecret("token") == "plain-old"
+    ciphertexts.append(b64encode(b"new").decode("ascii"))
+    assert provider.getSecret("token") == "plain-new"
+    assert clients[0].decrypts == [b"old", b"new"]
@@ -0,0 +1,58 @@
+"""Subjects of every candidate are fetched first, then the full message of the Intake Requests only."""
+
+
+def rawEmail(subject, body):
+    return ("From: servicenow@example.com\r\nSubject: " + subject + "\r\nMIME-Version: 1.0\r\n"
+            "Content-Type: text/html\r\n\r\n" + body + "\r\n").encode("utf-8")
+
+
+class FetchingMail(object):
+    """
+    IMAP connection answering UID FETCH in the shape imaplib returns: a (prefix, literal) tuple and a closing b")" per
+    message, or a single line for a BODYSTRUCTURE (every message is a single text/html part)
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.fetches = []
+
+    def uid(self, command, UIDSet, items):
+        self.fetches.append((UIDSet, items))
+        data = []
+        for sequence, UIDNum in enumerate(UIDSet.split(","), 1):
+            headers, body = self.messages[UIDNum].split(b"\r\n\r\n", 1)
+            if "BODYSTRUCTURE" in items:
+                data.append(('%d (UID %s BODYSTRUCTURE ("text" "html" ("charset" "utf-8") NIL NIL "7bit" %d 1 NIL NIL NIL))'
+                             % (sequence, UIDNum, len(body))).encode("ascii"))
+                continue
+            if "HEADER.FIELDS" in items:
+                literal = [line for line in headers.split(b"\r\n") if line.startswith(b"Subject:")][0] + b"\r\n\r\n"
+            else:
+                literal = body
+            data.append((("%d (UID %s BODY[] {%d}" % (sequence, UIDNum, len(literal))).encode("ascii"), literal))
+            data.append(b")")
+        return "OK", data
+
+
+def test_bodies_are_only_fetched_for_intake_requests(generator):
+    messages = {"1": rawEmail("TASK0000001 New request", "Request Name: One<br>"),
+                "2": rawEmail("Your request was closed", "Closed<br>"),
+                "3": rawEmail("TASK0000003 New request", "Request Name: Three<br>")}
+    mail = FetchingMail(messages)
+    subjects = generator.fetchSubjects(mail, ["1", "2", "3"])
+    assert subjects == {"1": "TASK0000001 New request", "2": "Your request was closed", "3": "TASK0000003 New request"}
+    assert mail.fetches == [("1,2,3", "(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])")]
+
+    bodies = list(generator.fetchMessageBodies(mail, ["1", "3"], subjects))
+    # the structure first, then only the HTML part of each message
+    assert [UIDSet for UIDSet, items in mail.fetches[1:]] == ["1,3", "1,3"]
+    assert mail.fetches[1][1] == "(UID BODYSTRUCTURE)"
+    assert mail.fetches[2][1].startswith("(UID BODY.PEEK[1]")
+    assert [(record.uid, record.subject) for record in bodies] == [("1", "TASK0000001 New request"), ("3", "TASK0000003 New request")]
+    assert "Request Name: Three<br>" in bodies[1].description
+
+
+def test_subjects_are_fetched_one_command_per_chunk(generator):
+    messages = dict((str(uid), rawEmail("TASK%07d" % uid, "")) for uid in range(1, 251))
+    mail = FetchingMail(messages)
+    assert len(generator.fetchSubjects(mail, sorted(messages, key=int))) == 250
+    assert [len(UIDSet.split(",")) for UIDSet, items in mail.fetches] == [100, 100, 50]
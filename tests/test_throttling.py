@@ -0,0 +1,108 @@
+"""Retry-After parsing, the adaptive in-flight limit, and which throttled or failed requests are sent again."""
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from vsts_rest import AdaptiveLimiter, VstsRestClient, VstsRestError, retryAfterSeconds
+
+
+def test_retry_after_seconds():
+    assert retryAfterSeconds({"Retry-After": "7"}) == 7.0
+    assert retryAfterSeconds({"Retry-After": "-3"}) == 0.0
+    assert 25 < retryAfterSeconds({"Retry-After": formatdate(time.time() + 30, usegmt=True)}) <= 30
+    assert retryAfterSeconds({"Retry-After": formatdate(time.time() - 30, usegmt=True)}) == 0.0
+    assert retryAfterSeconds({"X-RateLimit-Delay": "1.5"}) == 1.5
+    assert retryAfterSeconds({"Retry-After": "soon"}) is None
+    assert retryAfterSeconds({}) is None
+
+
+def test_limit_grows_additively_and_halves_once_per_cooldown():
+    limiter = AdaptiveLimiter(initial=4, maximum=6, cooldownSeconds=60)
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release()
+    assert 4.9 < limiter.limit < 5.0
+    limiter.acquire()
+    limiter.release(throttled=True)
+    halved = limiter.limit
+    assert 2.4 < halved < 2.5
+    # the other threads throttled in the same episode do not halve it again
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == halved
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 6
+
+
+def test_limit_bounds_the_requests_in_flight():
+    limiter = AdaptiveLimiter(initial=2, maximum=2)
+    limiter.acquire()
+    limiter.acquire()
+    admitted = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(), admitted.set()))
+    waiter.start()
+    assert not admitted.wait(0.1)
+    limiter.release()
+    assert admitted.wait(5)
+    waiter.join()
+
+
+def test_retry_after_holds_back_every_request():
+    limiter = AdaptiveLimiter(initial=4, maximum=4)
+    limiter.acquire()
+    limiter.release(throttled=True, delay=0.2)
+    started = time.time()
+    limiter.acquire()
+    assert time.time() - started >= 0.15
+
+
+class ScriptedPool(object):
+    """
+    Answers the requests with the queued (status, headers) responses
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = 0
+
+    def request(self, method, path, body=None, headers=None, idempotent=True):
+        self.sent += 1
+        status, responseHeaders = self.responses.pop(0)
+        return status, "reason", responseHeaders, b'{"value": []}' if status < 400 else b'{"message": "refused"}'
+
+
+def scriptedClient(*responses):
+    restClient = VstsRestClient("benchmark.visualstudio.com", "token", maxRetries=3, backoffSeconds=0.01, maxBackoffSeconds=1.0)
+    restClient.pool = ScriptedPool(*responses)
+    return restClient
+
+
+def test_rejected_batch_is_sent_again_after_the_full_retry_after():
+    restClient = scriptedClient((429, {"Retry-After": "0.3"}), (200, {}))
+    started = time.time()
+    assert restClient.batch([]) == []
+    assert time.time() - started >= 0.3
+    assert restClient.pool.sent == 2
+
+
+def test_retry_after_beyond_the_longest_backoff_is_raised():
+    restClient = scriptedClient((429, {"Retry-After": "120"}), (200, {}))
+    with pytest.raises(VstsRestError) as error:
+        restClient.query_workitem_ids("SELECT [System.Id] FROM WorkItems", "Architecture")
+    assert error.value.throttled
+    assert restClient.pool.sent == 1
+
+
+@pytest.mark.parametrize("status", [503, 500])
+def test_batch_with_an_unknown_outcome_is_not_sent_again(status):
+    restClient = scriptedClient((status, {}), (200, {}))
+    with pytest.raises(VstsRestError):
+        restClient.batch([])
+    assert restClient.pool.sent == 1
+
+    restClient = scriptedClient((status, {}), (200, {}))
+    assert restClient.query_workitem_ids("SELECT [System.Id] FROM WorkItems", "Architecture") == []
+    assert restClient.pool.sent == 2
@@ -0,0 +1,95 @@
+"""The incremental INBOX search above the UIDVALIDITY/UID watermark, and the emails that keep failing."""
+import pytest
+
+from fake_services import buildIntakeEmail
+
+from conftest import SENDER, CountdownContext
+
+
+class SearchingMail(object):
+    """
+    IMAP connection answering every UID SEARCH with 'uids'
+    """
+    def __init__(self, uids):
+        self.uids = uids
+        self.searches = []
+
+    def uid(self, command, charset, *criteria):
+        self.searches.append((command, criteria))
+        return "OK", [" ".join(str(uid) for uid in self.uids).encode("ascii")]
+
+
+def test_search_starts_above_the_watermark(generator):
+    # "n:*" also matches the newest message when its UID is below n, so UID 40 is filtered out
+    mail = SearchingMail([40, 41, 57])
+    assert generator.Email_Search_Incremental(mail, "servicenow@example.com", 7, 7, 40) == ["41", "57"]
+    assert mail.searches == [("search", ("UID", "41:*", "FROM", '"servicenow@example.com"'))]
+
+
+def test_new_uidvalidity_falls_back_to_a_date_window(generator):
+    mail = SearchingMail([3, 4])
+    assert generator.Email_Search_Incremental(mail, "servicenow@example.com", 8, 7, 40, 3) == ["3", "4"]
+    command, criteria = mail.searches[0]
+    assert criteria[0] == "SINCE"
+    assert criteria[2:] == ("FROM", '"servicenow@example.com"')
+
+
+def test_legacy_watermark_string_is_parsed(generator):
+    assert generator.parseUIDWatermark("UIDVALIDITY: 1536272042 UID: 5120") == (1536272042, 5120)
+    assert generator.parseUIDWatermark(None) == (None, 0)
+    assert generator.parseUIDWatermark("garbage") == (None, 0)
+
+
+def rejectTask(generator, monkeypatch, task):
+    """
+    Makes VSTS reject the cards of one TASK on every run, as it would an email with an invalid field
+    """
+    processIntakeChunk = generator.processIntakeChunk
+    monkeypatch.setattr(generator, "processIntakeChunk", lambda restClient, route, messageChunk: processIntakeChunk(
+        restClient, route, [record for record in messageChunk if record.task != task]))
+
+
+@pytest.mark.parametrize("errorMailbox", ["Archive/Failed", ""])
+def test_email_that_keeps_failing_is_set_aside(generator, services, monkeypatch, errorMailbox):
+    imapServer, vstsServer, s3Client = services
+    imapServer.reset([buildIntakeEmail(number, SENDER) for number in range(1, 4)])
+    monkeypatch.setattr(generator, "maxEmailFailuresEnvVar", 3)
+    monkeypatch.setitem(generator.defaultRouteAttributes, "errorMailbox", errorMailbox)
+    rejectTask(generator, monkeypatch, "0000002")
+
+    for run in range(2):
+        generator.lambda_handler({}, CountdownContext())
+        # the failed email holds the watermark back and is retried
+        assert [message.uid for message in imapServer.inbox] == [2]
+        assert generator.runStateStore.get("imapUIDWatermark")["lastUID"] == 1
+        assert list(generator.runStateStore.get("emailFailures").values()) == [run + 1]
+
+    generator.lambda_handler({}, CountdownContext())
+    assert generator.runStateStore.get("imapUIDWatermark")["lastUID"] == 2
+    assert generator.runStateStore.get("emailFailures") == {}
+    if errorMailbox:
+        assert imapServer.inbox == []
+        assert [message.uid for message in imapServer.archived[errorMailbox]] == [2]
+    else:
+        assert [message.uid for message in imapServer.inbox] == [2]
+
+    # the set-aside email is no longer searched
+    searches = imapServer.counts["UID SEARCH"]
+    generator.lambda_handler({}, CountdownContext())
+    assert imapServer.counts["UID SEARCH"] == searches + 1
+    assert len(vstsServer.workItems) == 4
+
+
+def test_processed_email_forgets_its_failures(generator, services, monkeypatch):
+    imapServer = services[0]
+    imapServer.reset([buildIntakeEmail(1, SENDER)])
+    monkeypatch.setattr(generator, "maxEmailFailuresEnvVar", 3)
+    processIntakeChunk = generator.processIntakeChunk
+    rejectTask(generator, monkeypatch, "0000001")
+    generator.lambda_handler({}, CountdownContext())
+    assert len(generator.runStateStore.get("emailFailures")) == 1
+
+    monkeypatch.setattr(generator, "processIntakeChunk", processIntakeChunk)
+    generator.lambda_handler({}, CountdownContext())
+    assert imapServer.inbox == []
+    assert generator.runStateStore.get("emailFailures") == {}
@@ -0,0 +1,124 @@
+"""The VSTS REST client against the fake Work Item Tracking API, and the resending of requests over stale pooled connections."""
+import http.client
+
+import pytest
+
+from vsts_rest import HTTPConnectionPool, VstsRestClient, VstsRestError, wiqlQuote
+
+PARENT = "System.LinkTypes.Hierarchy-Reverse"
+
+
+@pytest.fixture
+def restClient(services):
+    return VstsRestClient("benchmark.visualstudio.com", "token", services[1].baseUrl, maxRetries=0)
+
+
+def cardOperations(title, task):
+    return [{"op": "add", "path": "/fields/System.Title", "value": title},
+            {"op": "add", "path": "/fields/GTSKanban.TASK", "value": task}]
+
+
+def test_create_workitem_and_add_link(services, restClient):
+    vstsServer = services[1]
+    request = restClient.create_workitem("Architecture", "Request", cardOperations("Request", "0000001"))
+    pbi = restClient.create_workitem("Architecture", "Product Backlog Item", cardOperations("PBI", "0000001"))
+    assert vstsServer.workItems[request["id"]]["fields"]["System.WorkItemType"] == "Request"
+
+    restClient.add_link(pbi["id"], request["id"], PARENT, "created together")
+    assert vstsServer.workItems[pbi["id"]]["relations"] == [
+        {"rel": PARENT, "url": "/_apis/wit/workitems/" + str(request["id"]), "attributes": {"comment": "created together"}}]
+    assert vstsServer.counts["create"] == 2 and vstsServer.counts["link"] == 1
+
+
+def test_batch_resolves_temporary_ids_and_reports_each_sub_request(services, restClient):
+    vstsServer = services[1]
+    responses = restClient.batch([
+        restClient.create_workitem_request("Architecture", "Request", [{"op": "add", "path": "/id", "value": "-1"}] + cardOperations("Request", "0000002")),
+        restClient.create_workitem_request("Architecture", "Product Backlog Item", cardOperations("PBI", "0000002") + [
+            {"op": "add", "path": "/relations/-", "value": {"rel": PARENT, "url": restClient.workitem_url(-1)}}]),
+        restClient.update_workitem_request(999999, cardOperations("Missing", "0000003")),
+    ])
+    assert [code for code, body in responses] == [200, 200, 404]
+    requestID, pbiID = responses[0][1]["id"], responses[1][1]["id"]
+    # the sub-request bodies are decoded, and the PBI is linked to the ID the Request got
+    assert vstsServer.workItems[pbiID]["relations"][0]["url"] == "/_apis/wit/workitems/" + str(requestID)
+    assert vstsServer.counts["batch"] == 1
+
+
+def test_query_workitem_ids(services, restClient):
+    for task in ("0000004", "0000005"):
+        restClient.create_workitem("Architecture", "Request", cardOperations("Request", task))
+    query = ("SELECT [System.Id] FROM WorkItems WHERE [System.WorkItemType] = 'Request' AND [GTSKanban.TASK] = " +
+             wiqlQuote("0000005") + " ORDER BY [System.Id] DESC")
+    workItemIDs = restClient.query_workitem_ids(query, "Architecture")
+    assert len(workItemIDs) == 1
+    assert restClient.get_workitems(workItemIDs, ["GTSKanban.TASK"])[0]["fields"] == {"GTSKanban.TASK": "0000005"}
+
+
+def test_error_status_is_raised(restClient):
+    with pytest.raises(VstsRestError) as error:
+        restClient.add_link(999999, 1, PARENT)
+    assert error.value.notFound
+
+
+class FakeResponse(object):
+    status = 200
+    reason = "OK"
+    headers = {}
+    will_close = False
+
+    def read(self):
+        return b"{}"
+
+
+class FakeConnection(object):
+    """
+    Connection that fails with 'error' while sending ('failOn' = "request") or while reading the response ("getresponse")
+    """
+    def __init__(self, log, error=None, failOn=None):
+        self.log = log
+        self.error = error
+        self.failOn = failOn
+
+    def request(self, method, url, body=None, headers=None):
+        self.log.append(method)
+        if self.failOn == "request":
+            raise self.error
+
+    def getresponse(self):
+        if self.failOn == "getresponse":
+            raise self.error
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+
+def stalePool(log, failOn):
+    """
+    A pool whose only idle connection was dropped by the server
+    """
+    pool = HTTPConnectionPool("http://127.0.0.1:1")
+    pool.idle = [FakeConnection(log, http.client.RemoteDisconnected("closed"), failOn)]
+    pool.connectionClass = lambda host, port, timeout: FakeConnection(log)
+    return pool
+
+
+@pytest.mark.parametrize("failOn", ["request", "getresponse"])
+def test_idempotent_request_is_resent(failOn):
+    log = []
+    assert stalePool(log, failOn).request("GET", "/_apis/wit/workitems/1")[0] == 200
+    assert log == ["GET", "GET"]
+
+
+def test_request_that_never_reached_the_server_is_resent():
+    log = []
+    assert stalePool(log, "request").request("POST", "/_apis/wit/$batch", b"[]", idempotent=False)[0] == 200
+    assert log == ["POST", "POST"]
+
+
+def test_creation_whose_response_was_lost_is_not_resent():
+    log = []
+    with pytest.raises(http.client.RemoteDisconnected):
+        stalePool(log, "getresponse").request("POST", "/_apis/wit/$batch", b"[]", idempotent=False)
+    assert log == ["POST"]
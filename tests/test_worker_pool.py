@@ -0,0 +1,105 @@
+"""The work items of several emails are created by a bounded pool of workers; only confirmed emails are archived."""
+import threading
+import time
+
+import pytest
+
+from fake_services import FakeS3Client
+from intake_parser import IntakeRecord
+from run_state import RunStateStore, ProcessedTaskLedger
+from test_batch_creation import BatchingRestClient
+
+
+class ConcurrentRestClient(BatchingRestClient):
+    """
+    Records how many $batch calls are in flight at the same time, and fails the batches of the TASKs in 'failingTasks'
+    """
+    def __init__(self, failingTasks=()):
+        super(ConcurrentRestClient, self).__init__()
+        self.failingTasks = failingTasks
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.maxInFlight = 0
+
+    def batch(self, subRequests):
+        with self.lock:
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        try:
+            time.sleep(0.02)
+            titles = [operation["value"] for subRequest in subRequests for operation in subRequest["body"]
+                      if operation["path"] == "/fields/System.Title"]
+            if any(task in title for title in titles for task in self.failingTasks):
+                raise RuntimeError("batch failed")
+            with self.lock:
+                self.batches.append(subRequests)
+                firstID = 100 * len(self.batches)
+            return [(200, {"id": firstID + index}) for index in range(len(subRequests))]
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+
+
+def newLedger(tmp_path):
+    state = RunStateStore(FakeS3Client(), "bucket", "RunState.json", str(tmp_path / "RunState.json"))
+    state.load()
+    return ProcessedTaskLedger(state, exactLimit=100)
+
+
+@pytest.fixture
+def pipeline(generator, monkeypatch, tmp_path):
+    records = [IntakeRecord(str(uid), "TASK%07d" % uid, "Title TASK%07d" % uid, "<p>Description</p>", "%07d" % uid) for uid in range(1, 9)]
+    monkeypatch.setattr(generator, "maxConcurrencyEnvVar", 3)
+    monkeypatch.setattr(generator, "vstsEmailsPerBatchEnvVar", 2)
+    return generator, records, newLedger(tmp_path)
+
+
+def test_chunks_are_created_concurrently(pipeline):
+    generator, records, ledger = pipeline
+    UIDList = [record.uid for record in records]
+    restClient = ConcurrentRestClient()
+    archiveUIDList = []
+    createdIDNumbers = generator.runIntakePipeline(restClient, generator.routeTable.getRoutes()[0], iter(records), archiveUIDList, ledger, generator.DeadlineScheduler())
+    assert sorted(archiveUIDList, key=int) == UIDList
+    assert len(createdIDNumbers) == 16
+    assert len(restClient.batches) == 4
+    assert 1 < restClient.maxInFlight <= 3
+    assert ledger.check("0000008") == ProcessedTaskLedger.YES
+
+
+def test_failed_chunk_is_not_archived(pipeline):
+    generator, records, ledger = pipeline
+    UIDList = [record.uid for record in records]
+    restClient = ConcurrentRestClient(failingTasks=("0000003",))
+    archiveUIDList = []
+    with pytest.raises(RuntimeError):
+        generator.runIntakePipeline(restClient, generator.routeTable.getRoutes()[0], iter(records), archiveUIDList, ledger, generator.DeadlineScheduler())
+    # the chunk of TASK 3 and 4 failed, every other chunk was still confirmed
+    assert sorted(archiveUIDList, key=int) == ["1", "2", "5", "6", "7", "8"]
+    assert ledger.check("0000003") == ProcessedTaskLedger.NO
+
+
+def test_processed_tasks_go_to_the_follow_up_updates(pipeline, monkeypatch):
+    generator, records, ledger = pipeline
+    UIDList = [record.uid for record in records]
+    ledger.add(["0000001", "0000002", "0000003", "0000004"])
+    followUpTasks = []
+
+    def applyFollowUps(restClient, route, followUps):
+        followUpTasks.extend(sorted(followUps))
+        return [records[-1] for task, records in sorted(followUps.items())], []
+
+    monkeypatch.setattr(generator, "applyFollowUps", applyFollowUps)
+    restClient = ConcurrentRestClient()
+    archiveUIDList = []
+    generator.runIntakePipeline(restClient, generator.routeTable.getRoutes()[0], iter(records), archiveUIDList, ledger, generator.DeadlineScheduler())
+    assert sorted(archiveUIDList, key=int) == UIDList
+    assert followUpTasks == ["0000001", "0000002", "0000003", "0000004"]
+    # only the new TASKs were created
+    assert len(restClient.batches) == 2
+
+
+def test_watermark_stops_below_an_unprocessed_email(generator):
+    assert generator.advanceUIDWatermark(10, ["11", "12", "15"], {"12"}) == 11
+    assert generator.advanceUIDWatermark(10, ["11", "12", "15"], set()) == 15
+    assert generator.advanceUIDWatermark(10, ["11"], {"11"}) == 10